@@ -0,0 +1,185 @@
+"""
+Balance ledger for Tour de Taxa
+Keeps running income/expense totals per (afdeling_id, regnskabsaar) in the
+balances collection so dashboards don't have to re-sum every transaction
+"""
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from typing import Optional, Dict, Any, List
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sums are floats in kroner; anything below half an øre is rounding noise
+DRIFT_TOLERANCE = 0.005
+
+
+def _amounts(transaction: Dict[str, Any], sign: int) -> Dict[str, float]:
+    belob = transaction.get("belob", 0.0) * sign
+    return {
+        "indtaegter": belob if transaction.get("type") == "indtaegt" else 0.0,
+        "udgifter": belob if transaction.get("type") == "udgift" else 0.0,
+    }
+
+
+async def _inc(db, afdeling_id: str, regnskabsaar: Optional[str], indtaegter: float, udgifter: float, count: int):
+    await db.balances.update_one(
+        {"afdeling_id": afdeling_id, "regnskabsaar": regnskabsaar},
+        {"$inc": {"indtaegter": indtaegter, "udgifter": udgifter, "antal_posteringer": count}},
+        upsert=True
+    )
+
+
+async def record_created(db, transaction: Dict[str, Any]):
+    """Add a newly inserted transaction to its balance"""
+    amounts = _amounts(transaction, 1)
+    await _inc(db, transaction["afdeling_id"], transaction.get("regnskabsaar"),
+               amounts["indtaegter"], amounts["udgifter"], 1)
+
+
+async def record_created_many(db, transactions: List[Dict[str, Any]]):
+    """Add a batch of inserted transactions with one $inc per balance"""
+    deltas: Dict[tuple, Dict[str, float]] = {}
+    for transaction in transactions:
+        key = (transaction["afdeling_id"], transaction.get("regnskabsaar"))
+        delta = deltas.setdefault(key, {"indtaegter": 0.0, "udgifter": 0.0, "count": 0})
+        amounts = _amounts(transaction, 1)
+        delta["indtaegter"] += amounts["indtaegter"]
+        delta["udgifter"] += amounts["udgifter"]
+        delta["count"] += 1
+    for (afdeling_id, regnskabsaar), delta in deltas.items():
+        await _inc(db, afdeling_id, regnskabsaar, delta["indtaegter"], delta["udgifter"], delta["count"])
+
+
+async def record_updated(db, old: Dict[str, Any], new: Dict[str, Any]):
+    """Move a changed transaction's amount in a single $inc"""
+    before = _amounts(old, -1)
+    after = _amounts(new, 1)
+    indtaegter = before["indtaegter"] + after["indtaegter"]
+    udgifter = before["udgifter"] + after["udgifter"]
+    if indtaegter == 0 and udgifter == 0:
+        return
+    await _inc(db, old["afdeling_id"], old.get("regnskabsaar"), indtaegter, udgifter, 0)
+
+
+async def record_deleted(db, transaction: Dict[str, Any]):
+    """Remove a deleted transaction from its balance"""
+    amounts = _amounts(transaction, -1)
+    await _inc(db, transaction["afdeling_id"], transaction.get("regnskabsaar"),
+               amounts["indtaegter"], amounts["udgifter"], -1)
+
+
+async def get_balance(db, afdeling_id: str, regnskabsaar: Optional[str] = None) -> Dict[str, Any]:
+    """Totals for one afdeling, for one regnskabsår or summed over all of them"""
+    query = {"afdeling_id": afdeling_id}
+    if regnskabsaar:
+        query["regnskabsaar"] = regnskabsaar
+
+    totals = {"indtaegter": 0.0, "udgifter": 0.0, "antal_posteringer": 0}
+    async for balance in db.balances.find(query, {"_id": 0}):
+        for key in totals:
+            totals[key] += balance.get(key, 0)
+    return totals
+
+
+def _corrections(drift: List[Dict[str, Any]], actual: Dict[tuple, Dict[str, Any]]) -> list:
+    """Writes that move each drifted balance from what was read to what it should be.
+
+    Transactions keep $inc'ing the ledger while reconcile runs, so an existing
+    balance is corrected with a $inc of the difference rather than overwritten,
+    and a stale balance is only deleted if it still holds the values read.
+    """
+    operations = []
+    for entry in drift:
+        key = {"afdeling_id": entry["afdeling_id"], "regnskabsaar": entry["regnskabsaar"]}
+        want, have = entry["expected"], entry["actual"]
+        if (entry["afdeling_id"], entry["regnskabsaar"]) not in actual:
+            # Insert-only, so two instances building the ledger at once don't count it twice
+            operations.append(UpdateOne(key, {"$setOnInsert": {**key, **want}}, upsert=True))
+        elif want["antal_posteringer"] == 0:
+            operations.append(DeleteOne({**key, **have}))
+        else:
+            operations.append(UpdateOne(key, {"$inc": {field: want[field] - have[field] for field in want}}))
+    return operations
+
+
+async def reconcile(db, apply: bool = True) -> Dict[str, Any]:
+    """Recompute every balance from the transactions collection.
+
+    Returns the balances that differed from the ledger. With apply=True the
+    drifted balances are corrected in place and balances with no transactions
+    left are deleted, so dashboards never see an empty ledger.
+    """
+    pipeline = [
+        {"$group": {
+            "_id": {"afdeling_id": "$afdeling_id", "regnskabsaar": "$regnskabsaar"},
+            "indtaegter": {"$sum": {"$cond": [{"$eq": ["$type", "indtaegt"]}, "$belob", 0]}},
+            "udgifter": {"$sum": {"$cond": [{"$eq": ["$type", "udgift"]}, "$belob", 0]}},
+            "antal_posteringer": {"$sum": 1}
+        }}
+    ]
+    expected = {}
+    async for row in db.transactions.aggregate(pipeline):
+        key = (row["_id"]["afdeling_id"], row["_id"].get("regnskabsaar"))
+        expected[key] = {
+            "indtaegter": row["indtaegter"],
+            "udgifter": row["udgifter"],
+            "antal_posteringer": row["antal_posteringer"]
+        }
+
+    actual = {}
+    async for balance in db.balances.find({}, {"_id": 0}):
+        actual[(balance["afdeling_id"], balance.get("regnskabsaar"))] = balance
+
+    drift: List[Dict[str, Any]] = []
+    empty = {"indtaegter": 0.0, "udgifter": 0.0, "antal_posteringer": 0}
+    for key in set(expected) | set(actual):
+        want = expected.get(key, empty)
+        have = actual.get(key, empty)
+        if (abs(want["indtaegter"] - have.get("indtaegter", 0.0)) > DRIFT_TOLERANCE
+                or abs(want["udgifter"] - have.get("udgifter", 0.0)) > DRIFT_TOLERANCE
+                or want["antal_posteringer"] != have.get("antal_posteringer", 0)):
+            drift.append({
+                "afdeling_id": key[0],
+                "regnskabsaar": key[1],
+                "expected": want,
+                "actual": {k: have.get(k, 0) for k in empty}
+            })
+
+    if apply:
+        operations = _corrections(drift, actual)
+        if operations:
+            await db.balances.bulk_write(operations, ordered=False)
+        if drift:
+            logger.warning(f"Balance ledger corrected, {len(drift)} balances had drifted")
+
+    return {"checked": len(expected), "drift": drift, "applied": apply}
+
+
+async def ensure_ledger(db):
+    """Build the ledger on first start against an existing database"""
+    if await db.balances.find_one({}) is None and await db.transactions.find_one({}) is not None:
+        logger.info("Balance ledger empty, building from transactions")
+        try:
+            await reconcile(db)
+        except (DuplicateKeyError, BulkWriteError) as e:
+            # Another replica built the ledger at the same time; its upserts won
+            logger.warning(f"Balance ledger build raced another instance: {e}")
+
+
+if __name__ == "__main__":
+    # Usage: python balance_ledger.py [--dry-run]
+    import asyncio
+    import os
+    import sys
+    from pathlib import Path
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    result = asyncio.run(reconcile(client[os.environ['DB_NAME']], apply="--dry-run" not in sys.argv))
+    for entry in result["drift"]:
+        print(f"{entry['afdeling_id']} {entry['regnskabsaar']}: expected {entry['expected']}, ledger {entry['actual']}")
+    print(f"Checked {result['checked']} balances, {len(result['drift'])} drifted"
+          + ("" if result["applied"] else " (dry run, nothing changed)"))
@@ -0,0 +1,128 @@
+"""
+Bank statement import for Tour de Taxa
+Parses CSV exports from Danish netbanks line by line into transaction dicts
+"""
+from datetime import datetime
+from typing import Iterator, Dict, Any, Optional, BinaryIO
+import csv
+import re
+
+# Header names (lowercased) recognised for each field
+DATE_HEADERS = {"dato", "bank dato", "bogføringsdato", "bogført", "rentedato", "date"}
+TEXT_HEADERS = {"tekst", "beskrivelse", "posteringstekst", "text", "description"}
+AMOUNT_HEADERS = {"beløb", "belob", "amount"}
+FORMAL_HEADERS = {"formål", "formal"}
+
+DATE_FORMATS = ("%d-%m-%Y", "%d.%m.%Y", "%d/%m/%Y", "%Y-%m-%d", "%Y/%m/%d")
+
+# '1.234' and '1.000.000': dots between groups of three digits are thousands separators
+THOUSANDS_DOTS = re.compile(r"[+-]?\d{1,3}(\.\d{3})+")
+
+
+class BankImportError(ValueError):
+    """Raised for a file that can't be imported at all (e.g. missing columns)"""
+
+
+def _decode_lines(stream: BinaryIO) -> Iterator[str]:
+    # Netbanks export either UTF-8 or Windows-1252; decide per line so nothing is buffered
+    for raw in stream:
+        try:
+            yield raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            yield raw.decode("cp1252")
+
+
+def _detect_delimiter(header_line: str) -> str:
+    return max((";", ",", "\t"), key=header_line.count)
+
+
+def _find_column(header: list, names: set) -> Optional[int]:
+    for index, name in enumerate(header):
+        if name.strip().strip('"').lower() in names:
+            return index
+    return None
+
+
+def parse_date(value: str) -> str:
+    """Parse a bank date and return it as YYYY-MM-DD, the format the app stores"""
+    value = value.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    raise ValueError(f"Ukendt datoformat: '{value}'")
+
+
+def normalize_date(value: str) -> str:
+    """Return a date in a known format as YYYY-MM-DD, anything else unchanged.
+    Stored dates must be ISO so they sort correctly as strings."""
+    try:
+        return parse_date(value)
+    except ValueError:
+        return value
+
+
+def parse_amount(value: str) -> float:
+    """Parse an amount like '-1.234,56', '1234.56', '1.000' or '250,00 kr.'"""
+    cleaned = value.strip().lower().replace("kr.", "").replace("kr", "").replace(" ", "").replace("\xa0", "")
+    if not cleaned:
+        raise ValueError("Beløb mangler")
+    if "," in cleaned and "." in cleaned:
+        # The last separator is the decimal separator, the other one groups thousands
+        if cleaned.rfind(",") > cleaned.rfind("."):
+            cleaned = cleaned.replace(".", "").replace(",", ".")
+        else:
+            cleaned = cleaned.replace(",", "")
+    elif "," in cleaned:
+        # A single comma is the Danish decimal comma; several only group thousands
+        cleaned = cleaned.replace(",", ".") if cleaned.count(",") == 1 else cleaned.replace(",", "")
+    elif THOUSANDS_DOTS.fullmatch(cleaned):
+        cleaned = cleaned.replace(".", "")
+    try:
+        return float(cleaned)
+    except ValueError:
+        raise ValueError(f"Ugyldigt beløb: '{value.strip()}'")
+
+
+def iter_bank_rows(stream: BinaryIO, default_formal: str) -> Iterator[Dict[str, Any]]:
+    """Yield one dict per data row in a bank CSV export.
+
+    Each dict has the row number (the header is row 1) and either the parsed
+    transaction fields (bank_dato, tekst, formal, belob, type) or an error
+    message. Negative amounts become udgifter, positive amounts indtaegter.
+    """
+    lines = _decode_lines(stream)
+    header_line = next(lines, None)
+    if header_line is None:
+        raise BankImportError("Filen er tom")
+
+    delimiter = _detect_delimiter(header_line)
+    header = next(csv.reader([header_line], delimiter=delimiter))
+    date_col = _find_column(header, DATE_HEADERS)
+    text_col = _find_column(header, TEXT_HEADERS)
+    amount_col = _find_column(header, AMOUNT_HEADERS)
+    formal_col = _find_column(header, FORMAL_HEADERS)
+    if date_col is None or text_col is None or amount_col is None:
+        raise BankImportError("Filen skal have kolonnerne Dato, Tekst og Beløb")
+
+    for row_no, row in enumerate(csv.reader(lines, delimiter=delimiter), start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        try:
+            if len(row) <= max(date_col, text_col, amount_col):
+                raise ValueError("For få kolonner")
+            belob = parse_amount(row[amount_col])
+            formal = row[formal_col].strip() if formal_col is not None and len(row) > formal_col else ""
+            yield {
+                "row": row_no,
+                "transaction": {
+                    "bank_dato": parse_date(row[date_col]),
+                    "tekst": row[text_col].strip(),
+                    "formal": formal or default_formal,
+                    "belob": abs(belob),
+                    "type": "udgift" if belob < 0 else "indtaegt"
+                }
+            }
+        except ValueError as e:
+            yield {"row": row_no, "error": str(e)}
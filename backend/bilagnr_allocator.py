@@ -0,0 +1,64 @@
+"""
+Bilagnr allocation for Tour de Taxa
+Hands out bilag numbers from the naeste_bilagnr counter in an afdeling's
+settings with a single atomic find_one_and_update
+"""
+from pymongo import ReturnDocument
+from typing import Dict, Any, List, Tuple, Optional
+
+
+def format_bilagnr(number: int) -> str:
+    return f"B{str(number).zfill(3)}"
+
+
+def bilagnr_number(bilagnr: Optional[str]) -> Optional[int]:
+    """Numeric part of a bilagnr, the sort key for it (B999 before B1000)"""
+    digits = (bilagnr or "").lstrip("B")
+    return int(digits) if digits.isdigit() else None
+
+
+async def reserve_bilagnr(db, afdeling_id: str, defaults: Dict[str, Any], count: int = 1) -> Tuple[Dict[str, Any], List[str]]:
+    """Reserve `count` consecutive bilag numbers for an afdeling.
+
+    `defaults` are the settings values used when the afdeling has no settings
+    document yet; it is created in the same operation. Returns the settings
+    document after the reservation and the reserved bilagnr values in order.
+    """
+    if count < 1:
+        raise ValueError("count must be at least 1")
+
+    # Pipeline update so a missing document or counter starts at 1 before the increment
+    fill_defaults = {
+        key: {"$ifNull": [f"${key}", {"$literal": value}]}
+        for key, value in defaults.items()
+        if key != "naeste_bilagnr"
+    }
+    settings = await db.settings.find_one_and_update(
+        {"afdeling_id": afdeling_id},
+        [{"$set": {
+            **fill_defaults,
+            "naeste_bilagnr": {"$add": [{"$ifNull": ["$naeste_bilagnr", 1]}, count]}
+        }}],
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+    first = settings["naeste_bilagnr"] - count
+    return settings, [format_bilagnr(n) for n in range(first, first + count)]
+
+
+async def merge_duplicate_settings(db) -> int:
+    """Keep one settings document per afdeling, the one furthest along in
+    bilag numbers, so the unique afdeling_id index can be built. Returns the
+    number of documents removed."""
+    pipeline = [
+        {"$sort": {"naeste_bilagnr": -1}},
+        {"$group": {"_id": "$afdeling_id", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]
+    removed = 0
+    async for group in db.settings.aggregate(pipeline):
+        result = await db.settings.delete_many({"_id": {"$in": group["ids"][1:]}})
+        removed += result.deleted_count
+    return removed
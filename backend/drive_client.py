@@ -0,0 +1,138 @@
+"""
+Async Google Drive client for Tour de Taxa
+Runs the blocking googleapiclient calls (execute, next_chunk, token refresh)
+in a bounded thread pool, with a per-user concurrency limit and a timeout
+per call, so a slow Drive response doesn't hold up the event loop
+"""
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+from google_auth_httplib2 import AuthorizedHttp
+from google.oauth2.credentials import Credentials
+from googleapiclient.http import build_http
+from typing import Dict, Any, Callable
+import asyncio
+import threading
+import os
+
+from instrumented_pool import InstrumentedPool
+
+# Drive calls are network bound, so more threads than CPUs is fine; the cap
+# keeps a Drive outage from tying up an unbounded number of threads.
+MAX_WORKERS = int(os.environ.get('DRIVE_WORKERS', 8))
+# Concurrent Drive calls per user, so one afdeling's bulk upload can't take every thread
+PER_USER_LIMIT = int(os.environ.get('DRIVE_PER_USER_LIMIT', 2))
+# Per call; also the socket timeout, so a timed-out call's thread is freed soon after
+CALL_TIMEOUT_SECONDS = float(os.environ.get('DRIVE_CALL_TIMEOUT_SECONDS', 60))
+
+_pool = InstrumentedPool(MAX_WORKERS, thread_name_prefix="drive")
+_thread_state = threading.local()
+_timeouts = 0
+
+
+class _UserLimit:
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(PER_USER_LIMIT)
+        # Calls holding or waiting for the semaphore
+        self.users = 0
+
+
+# Only users with calls in flight have an entry, so this stays small
+_user_limits: Dict[str, _UserLimit] = {}
+
+
+class DriveTimeout(HTTPException):
+    """A Drive call didn't finish within CALL_TIMEOUT_SECONDS"""
+
+    def __init__(self):
+        super().__init__(
+            status_code=504,
+            detail=f"Google Drive svarede ikke inden for {CALL_TIMEOUT_SECONDS:.0f} sekunder"
+        )
+
+
+def _thread_http():
+    http = getattr(_thread_state, "http", None)
+    if http is None:
+        http = _thread_state.http = build_http()
+        http.timeout = CALL_TIMEOUT_SECONDS
+    return http
+
+
+class _ThreadLocalHttp:
+    """httplib2.Http stand-in that sends each request over the calling
+    thread's own connection. httplib2.Http is not thread safe, and a cached
+    service is used from every pool thread."""
+
+    def request(self, *args, **kwargs):
+        return _thread_http().request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(_thread_http(), name)
+
+
+def authorized_http(creds: Credentials) -> AuthorizedHttp:
+    """The http to build a Drive service with"""
+    return AuthorizedHttp(creds, http=_ThreadLocalHttp())
+
+
+@asynccontextmanager
+async def _user_slot(user_id: str):
+    limit = _user_limits.get(user_id)
+    if limit is None:
+        limit = _user_limits[user_id] = _UserLimit()
+    limit.users += 1
+    try:
+        async with limit.semaphore:
+            yield
+    finally:
+        limit.users -= 1
+        if not limit.users:
+            del _user_limits[user_id]
+
+
+async def run(user_id: str, func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking Drive call in the pool on behalf of a user"""
+    global _timeouts
+    async with _user_slot(user_id):
+        try:
+            return await asyncio.wait_for(_pool.run(func, *args, **kwargs), CALL_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            _timeouts += 1
+            raise DriveTimeout()
+
+
+class DriveClient:
+    """A user's Drive service with async execution of its requests.
+
+    Build requests as usual (client.files().list(...)) and await
+    client.execute(request), or client.call(func, ...) for other blocking
+    calls such as a downloader's next_chunk.
+    """
+
+    def __init__(self, user_id: str, service):
+        self.user_id = user_id
+        self.service = service
+
+    def files(self):
+        return self.service.files()
+
+    async def execute(self, request) -> Any:
+        return await run(self.user_id, request.execute)
+
+    async def call(self, func: Callable, *args, **kwargs) -> Any:
+        return await run(self.user_id, func, *args, **kwargs)
+
+
+def get_stats() -> Dict[str, Any]:
+    """Pool size, saturation and queueing metrics"""
+    return {
+        **_pool.stats(),
+        "per_user_limit": PER_USER_LIMIT,
+        "users_in_flight": len(_user_limits),
+        "timeout_seconds": CALL_TIMEOUT_SECONDS,
+        "timeouts": _timeouts,
+    }
+
+
+def shutdown():
+    _pool.shutdown()
@@ -0,0 +1,453 @@
+"""
+Excel export for Tour de Taxa
+Builds bookkeeping workbooks with write-only worksheets fed straight from
+Motor cursors, so memory stays flat regardless of the size of the year
+"""
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
+from pathlib import Path
+from datetime import timezone
+from functools import partial
+from typing import Optional, List, Dict, Any, Iterator, NamedTuple, Callable, Awaitable
+import asyncio
+import heapq
+import io
+import pickle
+import os
+import tempfile
+import time
+import zipfile
+import logging
+
+from receipt_storage import indexed_receipts
+from storage_backends import get_storage, STREAM_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+CURSOR_BATCH_SIZE = 500
+
+# Already compressed formats are stored as-is in the ZIP instead of deflated again
+STORED_SUFFIXES = {".xlsx", ".zip", ".jpg", ".jpeg", ".png", ".gif", ".heic", ".webp"}
+
+# Cell styles by name, so rows only carry the name until they are written
+STYLES = {
+    "bold": {"font": Font(bold=True)},
+    "folder_label": {"font": Font(bold=True, color="0066CC")},
+    "folder": {"font": Font(color="0066CC")},
+    "header": {
+        "fill": PatternFill(start_color="109848", end_color="109848", fill_type="solid"),
+        "font": Font(bold=True, color="FFFFFF"),
+        "alignment": Alignment(horizontal="center"),
+    },
+    "saldo": {"font": Font(bold=True, color="109848")},
+}
+
+SHEET_HEADERS = ["Bilagnr.", "Bank dato", "Tekst", "Formål", "Beløb", "Type", "Kvittering"]
+COMBINED_HEADERS = ["Hold", "Bilagnr.", "Bank dato", "Tekst", "Formål", "Beløb", "Type"]
+
+MAX_COLUMN_WIDTH = 50
+COLUMN_PADDING = 2
+# Rows measured before a sheet's column widths are fixed; longer values further down may be cut off
+WIDTH_SAMPLE_ROWS = 1000
+
+TRANSACTION_PROJECTION = {
+    "_id": 0, "id": 1, "afdeling_id": 1, "bilagnr": 1, "bank_dato": 1,
+    "tekst": 1, "formal": 1, "belob": 1, "type": 1,
+    "kvittering_url": 1, "kvittering_filename": 1
+}
+
+
+class Styled(NamedTuple):
+    value: Any
+    style: str
+
+
+def clean_sheet_name(afdeling_navn: str) -> str:
+    """Remove characters Excel doesn't allow in sheet names and limit to 31 chars"""
+    clean_name = afdeling_navn.replace("/", "-").replace("\\", "-").replace("[", "").replace("]", "")
+    return clean_name.replace("*", "").replace("?", "").replace(":", "")[:31]
+
+
+def _track_lengths(lengths: List[int], row: list):
+    """Raise the per-column maximum display lengths with the values in row"""
+    for index, value in enumerate(row):
+        if isinstance(value, Styled):
+            value = value.value
+        if value is None or value == "":
+            continue
+        length = len(str(value))
+        if index >= len(lengths):
+            lengths.extend([0] * (index + 1 - len(lengths)))
+        if length > lengths[index]:
+            lengths[index] = length
+
+
+def _to_cell(ws, value):
+    if not isinstance(value, Styled):
+        return value
+    cell = WriteOnlyCell(ws, value=value.value)
+    for attr, style in STYLES[value.style].items():
+        setattr(cell, attr, style)
+    return cell
+
+
+class SheetWriter:
+    """Appends rows to a write-only worksheet while tracking the widest value
+    per column, so setting the widths afterwards is O(columns).
+
+    A write-only sheet writes its column widths before the first row. The
+    first WIDTH_SAMPLE_ROWS rows are therefore held back and the widths are
+    set from them; every later row goes straight to the sheet. Pass `widths`
+    to skip the sample when the widths are known up front.
+    """
+
+    def __init__(self, ws, widths: Optional[List[int]] = None):
+        self.ws = ws
+        self.max_lengths: List[int] = []
+        self._sample: Optional[List[list]] = None
+        if widths is not None:
+            self._apply_widths(widths)
+        else:
+            self._sample = []
+
+    def append(self, row: list):
+        _track_lengths(self.max_lengths, row)
+        if self._sample is None:
+            self.ws.append([_to_cell(self.ws, value) for value in row])
+            return
+        self._sample.append(row)
+        if len(self._sample) >= WIDTH_SAMPLE_ROWS:
+            self._flush_sample()
+
+    @property
+    def widths(self) -> List[int]:
+        return [min(length + COLUMN_PADDING, MAX_COLUMN_WIDTH) for length in self.max_lengths]
+
+    def _apply_widths(self, widths: List[int]):
+        for index, width in enumerate(widths, start=1):
+            self.ws.column_dimensions[get_column_letter(index)].width = width
+
+    def _flush_sample(self):
+        self._apply_widths(self.widths)
+        sample, self._sample = self._sample, None
+        for row in sample:
+            self.ws.append([_to_cell(self.ws, value) for value in row])
+
+    def close(self):
+        if self._sample is not None:
+            self._flush_sample()
+
+
+def transactions_cursor(db, query: Dict[str, Any], sort: list):
+    return db.transactions.find(query, TRANSACTION_PROJECTION).sort(sort).batch_size(CURSOR_BATCH_SIZE)
+
+
+class AfdelingSheet:
+    """One afdeling's sheet: startsaldo and headers on top, transactions,
+    then aktuel saldo once the afdeling's rows are done."""
+
+    def __init__(self, wb: Workbook, afdeling_navn: str, startsaldo: float):
+        self.afdeling_navn = afdeling_navn
+        self.startsaldo = startsaldo
+        self.total_indtaegter = 0.0
+        self.total_udgifter = 0.0
+        # Transaction columns only, for sizing the combined sheet
+        self.transaction_lengths: List[int] = []
+        self.writer = SheetWriter(wb.create_sheet(clean_sheet_name(afdeling_navn)))
+
+        self.writer.append([Styled("Startsaldo", "bold"), "", "", "", Styled(startsaldo, "bold"), ""])
+        self.writer.append([
+            Styled("Kvitteringer mappe:", "folder_label"),
+            Styled(f"kvitteringer/{afdeling_navn}/", "folder"),
+            "", "", "", ""
+        ])
+        self.writer.append([])
+        self.writer.append([Styled(header, "header") for header in SHEET_HEADERS])
+
+    def add(self, t: Dict[str, Any], stored: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Append a transaction row. `stored` is its entry in the receipts
+        index, if any; the receipt to bundle is returned."""
+        if t["type"] == "indtaegt":
+            self.total_indtaegter += t["belob"]
+        elif t["type"] == "udgift":
+            self.total_udgifter += t["belob"]
+
+        receipt = None
+        receipt_name = ""
+        if t.get("kvittering_url"):
+            receipt_name = t["kvittering_url"].split("/")[-1]
+            if stored:
+                receipt = {
+                    "key": stored["key"],
+                    "mtime": stored["mtime"].replace(tzinfo=timezone.utc).timestamp(),
+                    "name": receipt_name,
+                    "afdeling": self.afdeling_navn,
+                    "bilagnr": t.get("bilagnr", "unknown")
+                }
+            else:
+                logger.warning(f"Receipt not in index: {t['kvittering_url']}")
+
+        row = [t["bilagnr"], t["bank_dato"], t["tekst"], t["formal"], t["belob"], t["type"], receipt_name]
+        _track_lengths(self.transaction_lengths, row)
+        self.writer.append(row)
+        return receipt
+
+    def finish(self):
+        aktuel_saldo = self.startsaldo + self.total_indtaegter - self.total_udgifter
+        self.writer.append([])
+        self.writer.append([Styled("Aktuel saldo", "saldo"), "", "", "", Styled(aktuel_saldo, "saldo"), "", ""])
+        self.writer.close()
+
+
+def _combined_widths(sheets) -> List[int]:
+    """Widths for "Alle hold", taken from the afdeling sheets it merges.
+
+    The transaction columns are the afdeling sheet's first six columns shifted
+    one to the right, behind the Hold column.
+    """
+    lengths = [len(header) for header in COMBINED_HEADERS]
+    for sheet in sheets:
+        lengths[0] = max(lengths[0], len(sheet.afdeling_navn))
+        for index, length in enumerate(sheet.transaction_lengths[:len(COMBINED_HEADERS) - 1], start=1):
+            lengths[index] = max(lengths[index], length)
+    return [min(length + COLUMN_PADDING, MAX_COLUMN_WIDTH) for length in lengths]
+
+
+def _spool_rows(spool) -> Iterator[tuple]:
+    spool.seek(0)
+    while True:
+        try:
+            yield pickle.load(spool)
+        except EOFError:
+            return
+
+
+def _write_combined_sheet(wb: Workbook, spools: list, widths: List[int]):
+    """Write the "Alle hold" sheet by merging the afdelinger's date-sorted rows"""
+    writer = SheetWriter(wb.create_sheet("Alle hold"), widths=widths)
+    writer.append([Styled(header, "header") for header in COMBINED_HEADERS])
+
+    # heapq.merge is stable, so equal dates keep the afdeling order
+    for row in heapq.merge(*(_spool_rows(spool) for spool in spools), key=lambda row: row[2]):
+        writer.append(list(row))
+
+
+def export_scope(role: str, user_id: str, afdeling_id: Optional[str] = None,
+                 regnskabsaar: Optional[str] = None) -> Dict[str, Any]:
+    """Work out what an export request covers.
+
+    Admins without an afdeling_id get every afdeling with a combined sheet,
+    afdelinger always get their own data.
+    """
+    combined = role == "admin" and not afdeling_id
+    year_suffix = f"_{regnskabsaar}" if regnskabsaar else ""
+    return {
+        "combined": combined,
+        "afdeling_id": None if combined else (user_id if role == "afdeling" else afdeling_id),
+        "regnskabsaar": regnskabsaar,
+        "filename": f"tour_de_taxa_bogforing{year_suffix}"
+    }
+
+
+def export_query(scope: Dict[str, Any]) -> Dict[str, Any]:
+    """Transactions filter for an export scope, for counting them up front"""
+    query = {"afdeling_id": scope["afdeling_id"]} if scope["afdeling_id"] else {}
+    if scope["regnskabsaar"]:
+        query["regnskabsaar"] = scope["regnskabsaar"]
+    return query
+
+
+async def load_afdelinger(db, scope: Dict[str, Any]) -> List[Dict[str, Any]]:
+    if scope["combined"]:
+        return await db.users.find(
+            {"role": "afdeling"}, {"_id": 0, "id": 1, "afdeling_navn": 1}
+        ).to_list(100)
+    afdeling_user = await db.users.find_one({"id": scope["afdeling_id"]}, {"_id": 0})
+    afdeling_navn = afdeling_user.get("afdeling_navn", "Bogføring") if afdeling_user else "Bogføring"
+    return [{"id": scope["afdeling_id"], "afdeling_navn": afdeling_navn}]
+
+
+def zip_entries(excel_path: str, receipt_files: List[Dict[str, Any]], scope: Dict[str, Any]) -> List[tuple]:
+    """Archive layout: the workbook plus kvitteringer_[regnskabsaar]/[afdeling]/[filename].
+
+    Entries are (opener, archive name, mtime) for iter_zip; receipts are read
+    from the storage backend.
+    """
+    storage = get_storage()
+    year_suffix = f"_{scope['regnskabsaar']}" if scope["regnskabsaar"] else ""
+    folder_name = f"kvitteringer{year_suffix}"
+    return [(partial(open, excel_path, "rb"), f"{scope['filename']}.xlsx", os.path.getmtime(excel_path))] + [
+        (
+            partial(storage.open, receipt["key"]),
+            f"{folder_name}/{receipt['afdeling']}/{receipt['name']}",
+            receipt["mtime"]
+        )
+        for receipt in receipt_files
+    ]
+
+
+class _WorkbookBuilder:
+    """The blocking half of build_workbook: every openpyxl call and spool
+    write happens here, one batch at a time in an executor thread."""
+
+    def __init__(self, afdelinger: List[Dict[str, Any]], startsaldi: Dict[str, float],
+                 receipts: Dict[str, Dict[str, Any]], combined: bool):
+        self.afdeling_ids = [afdeling["id"] for afdeling in afdelinger]
+        self.receipts = receipts
+        self.receipt_files: List[Dict[str, Any]] = []
+        self.wb = Workbook(write_only=True)
+        self.sheets = {
+            afdeling["id"]: AfdelingSheet(self.wb, afdeling["afdeling_navn"], startsaldi.get(afdeling["id"], 0.0))
+            for afdeling in afdelinger
+        }
+        self.spools = {afdeling_id: tempfile.TemporaryFile() for afdeling_id in self.sheets} if combined else {}
+
+    def add_rows(self, transactions: List[Dict[str, Any]]):
+        for t in transactions:
+            afdeling_id = t.get("afdeling_id")
+            sheet = self.sheets[afdeling_id]
+            receipt = sheet.add(t, self.receipts.get(t["id"]))
+            if receipt:
+                self.receipt_files.append(receipt)
+            if self.spools:
+                pickle.dump(
+                    (sheet.afdeling_navn, t["bilagnr"], t["bank_dato"], t["tekst"], t["formal"], t["belob"], t["type"]),
+                    self.spools[afdeling_id]
+                )
+
+    def save(self) -> str:
+        """Finish the sheets and write the workbook to a temporary file"""
+        for sheet in self.sheets.values():
+            sheet.finish()
+        if self.spools:
+            _write_combined_sheet(self.wb, [self.spools[afdeling_id] for afdeling_id in self.afdeling_ids],
+                                  _combined_widths(self.sheets.values()))
+        fd, path = tempfile.mkstemp(suffix=".xlsx", prefix="export_")
+        os.close(fd)
+        try:
+            self.wb.save(path)
+        except Exception:
+            os.unlink(path)
+            raise
+        return path
+
+    def close(self):
+        for spool in self.spools.values():
+            spool.close()
+
+
+async def build_workbook(db, afdelinger: List[Dict[str, Any]], regnskabsaar: Optional[str] = None,
+                         combined: bool = False,
+                         on_progress: Optional[Callable[[int], Awaitable[None]]] = None) -> tuple:
+    """Build the export workbook into a temporary .xlsx file.
+
+    All afdelinger are read with one cursor sorted by (afdeling_id, bank_dato).
+    Each row goes straight to its afdeling's sheet; with `combined` it is also
+    spooled to disk so the "Alle hold" sheet can be merged by date at the end.
+    The cursor is read on the event loop and every CURSOR_BATCH_SIZE rows are
+    written to the workbook in the default executor, as are finishing and
+    saving it.
+
+    `on_progress` is awaited with the number of transactions written after
+    every batch.
+
+    Returns (path, receipt_files). The caller owns the file and must delete it.
+    """
+    afdeling_ids = [afdeling["id"] for afdeling in afdelinger]
+    startsaldi = {}
+    settings_projection = {"_id": 0, "afdeling_id": 1, "startsaldo": 1}
+    async for settings in db.settings.find({"afdeling_id": {"$in": afdeling_ids}}, settings_projection):
+        startsaldi.setdefault(settings["afdeling_id"], settings.get("startsaldo", 0.0))
+
+    query = {"afdeling_id": {"$in": afdeling_ids}}
+    if regnskabsaar:
+        query["regnskabsaar"] = regnskabsaar
+
+    # Receipt files come from the receipts index rather than a stat per row
+    receipts = await indexed_receipts(db, afdeling_ids)
+    loop = asyncio.get_running_loop()
+    builder = _WorkbookBuilder(afdelinger, startsaldi, receipts, combined)
+    processed = 0
+    try:
+        batch = []
+        async for t in transactions_cursor(db, query, [("afdeling_id", 1), ("bank_dato", 1)]):
+            batch.append(t)
+            if len(batch) < CURSOR_BATCH_SIZE:
+                continue
+            await loop.run_in_executor(None, builder.add_rows, batch)
+            processed += len(batch)
+            batch = []
+            if on_progress:
+                await on_progress(processed)
+        if batch:
+            await loop.run_in_executor(None, builder.add_rows, batch)
+        path = await loop.run_in_executor(None, builder.save)
+    finally:
+        builder.close()
+    return path, builder.receipt_files
+
+
+class _ZipSink(io.RawIOBase):
+    """Write-only, unseekable target for ZipFile that hands out what was written so far.
+
+    Because it can't seek, ZipFile writes each member with a data descriptor
+    instead of going back to patch its local header.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        return len(b)
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def iter_zip(entries: List[tuple], cleanup: Optional[List[str]] = None) -> Iterator[bytes]:
+    """Stream a ZIP of (opener, archive name, mtime) entries chunk by chunk.
+
+    `opener()` returns a readable binary file. Each file is read and
+    compressed STREAM_CHUNK_SIZE bytes at a time and the compressed bytes are
+    yielded immediately, so peak memory is bounded by the chunk size. Files
+    that disappeared since the entry list was built are skipped. Paths in
+    `cleanup` are deleted when the stream ends.
+    """
+    sink = _ZipSink()
+    try:
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for opener, arcname, mtime in entries:
+                try:
+                    src = opener()
+                except FileNotFoundError:
+                    logger.warning(f"Receipt file not found: {arcname}")
+                    continue
+                zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(mtime)[:6])
+                zinfo.external_attr = 0o644 << 16
+                if Path(arcname).suffix.lower() in STORED_SUFFIXES:
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                else:
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with src, zf.open(zinfo, "w") as dest:
+                    while chunk := src.read(STREAM_CHUNK_SIZE):
+                        dest.write(chunk)
+                        if sink.pending:
+                            yield sink.drain()
+                # Rest of the compressed data and the data descriptor
+                yield sink.drain()
+        # Central directory
+        yield sink.drain()
+    finally:
+        for path in cleanup or []:
+            os.unlink(path)
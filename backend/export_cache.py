@@ -0,0 +1,230 @@
+"""
+Export cache for Tour de Taxa
+Keeps generated xlsx/zip exports on disk keyed by (scope, afdeling_id,
+regnskabsaar, data version) with size-bounded LRU eviction
+"""
+from pymongo import UpdateOne
+from storage_backends import move_file
+from typing import Optional, Iterator, Dict, Any, BinaryIO
+from pathlib import Path
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path(os.environ.get('EXPORT_CACHE_DIR', '/app/cache/exports'))
+MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+SUFFIXES = (".xlsx", ".zip")
+
+# Version document that changes on every write, used for exports spanning all afdelinger
+ALL_AFDELINGER = "*"
+
+# Guards the stats and _serving; also held while opening and deleting entries,
+# so an entry can't be evicted between being found and being opened
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+# Open count per cached file currently being read
+_serving: Dict[Path, int] = {}
+
+
+class CachedExport:
+    """An open cache entry. It is exempt from eviction until closed."""
+
+    def __init__(self, path: Path, file: BinaryIO):
+        self.path = path
+        self.file = file
+        self.size = os.fstat(file.fileno()).st_size
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[bytes]:
+        """Yield the file in chunks and close the entry when done or aborted"""
+        try:
+            while chunk := self.file.read(chunk_size):
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        with _lock:
+            _serving[self.path] -= 1
+            if not _serving[self.path]:
+                del _serving[self.path]
+
+
+def open_entry(path: Path) -> Optional[CachedExport]:
+    """Open a cached file by path, or None if it has been evicted"""
+    with _lock:
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        _serving[path] = _serving.get(path, 0) + 1
+    return CachedExport(path, file)
+
+
+async def bump_version(db, afdeling_id: Optional[str]):
+    """Invalidate cached exports for an afdeling and the all-afdelinger exports"""
+    operations = [UpdateOne({"afdeling_id": ALL_AFDELINGER}, {"$inc": {"version": 1}}, upsert=True)]
+    if afdeling_id and afdeling_id != ALL_AFDELINGER:
+        operations.append(UpdateOne({"afdeling_id": afdeling_id}, {"$inc": {"version": 1}}, upsert=True))
+    await db.data_versions.bulk_write(operations, ordered=False)
+
+
+async def get_version(db, afdeling_id: Optional[str]) -> int:
+    doc = await db.data_versions.find_one({"afdeling_id": afdeling_id or ALL_AFDELINGER}, {"_id": 0, "version": 1})
+    return doc["version"] if doc else 0
+
+
+async def cache_key(db, scope: Dict[str, Any]) -> tuple:
+    """Key for an export scope (see excel_export.export_scope) at the current data version.
+
+    Read the key before building, so a write during the build leaves the
+    result under the old version.
+    """
+    version = await get_version(db, scope["afdeling_id"])
+    return ("alle" if scope["combined"] else "afdeling", scope["afdeling_id"], scope["regnskabsaar"], version)
+
+
+def path_for(key: tuple, suffix: str) -> Path:
+    digest = hashlib.sha256(repr(key).encode()).hexdigest()
+    return (CACHE_DIR / digest).with_suffix(suffix)
+
+
+def _record(name: str):
+    with _lock:
+        _stats[name] += 1
+        hits, misses = _stats["hits"], _stats["misses"]
+    if name in ("hits", "misses"):
+        outcome = "hit" if name == "hits" else "miss"
+        logger.info(f"Export cache {outcome}, hit rate {hits / (hits + misses):.0%} ({hits}/{hits + misses})")
+
+
+def _lookup(key: tuple) -> Optional[CachedExport]:
+    for suffix in SUFFIXES:
+        path = path_for(key, suffix)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            continue
+        entry = open_entry(path)
+        if entry is None:
+            # Evicted since the utime
+            continue
+        _record("hits")
+        return entry
+    _record("misses")
+    return None
+
+
+def _store(source: str, key: tuple, suffix: str) -> CachedExport:
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = path_for(key, suffix)
+    move_file(source, path)
+    # The source may be older than other entries; as the newest it is never evicted right away
+    os.utime(path)
+    entry = open_entry(path)
+    _record("stored")
+    evict()
+    return entry
+
+
+def _close_unclaimed(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is None and future.result() is not None:
+        future.result().close()
+
+
+async def _open_in_executor(func, *args) -> Optional[CachedExport]:
+    """Run func in the default executor. If the caller is cancelled meanwhile,
+    the entry it opens is closed instead of staying exempt from eviction."""
+    future = asyncio.get_running_loop().run_in_executor(None, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(_close_unclaimed)
+        raise
+
+
+async def lookup(key: tuple) -> Optional[CachedExport]:
+    """Open the cached file for key, marking it as recently used. Close the
+    returned entry (or exhaust iter_chunks) when done with it."""
+    return await _open_in_executor(_lookup, key)
+
+
+async def store(source: str, key: tuple, suffix: str) -> CachedExport:
+    """Move a finished export file into the cache and return it opened.
+
+    Runs in the default executor: the move can be a full copy when the cache
+    is on another filesystem, and it is followed by an eviction pass.
+    """
+    return await _open_in_executor(_store, source, key, suffix)
+
+
+def tee(chunks: Iterator[bytes], key: tuple, suffix: str) -> Iterator[bytes]:
+    """Pass a streamed export through while writing it to the cache.
+
+    The file only enters the cache if the stream completes. Iterate it off
+    the event loop (StreamingResponse runs sync iterators in its threadpool).
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".part")
+    complete = False
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        complete = True
+    finally:
+        if complete:
+            _store(tmp_path, key, suffix).close()
+        else:
+            os.unlink(tmp_path)
+
+
+def evict():
+    """Delete least recently used exports until the cache fits in MAX_BYTES.
+
+    The newest entry and entries being read are kept even if that leaves the
+    cache over its limit.
+    """
+    entries = []
+    total = 0
+    for path in CACHE_DIR.iterdir():
+        if path.suffix not in SUFFIXES:
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    entries.sort()
+    for _, size, path in entries[:-1]:
+        if total <= MAX_BYTES:
+            break
+        with _lock:
+            if path in _serving:
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        total -= size
+        _record("evicted")
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        stats = dict(_stats)
+        stats["serving"] = len(_serving)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    stats["max_bytes"] = MAX_BYTES
+    return stats
@@ -0,0 +1,265 @@
+"""
+Export jobs for Tour de Taxa
+Runs Excel/ZIP exports in the background. Job state lives in the export_jobs
+collection and finished files in the storage backend, so any server process
+can pick up queued work, report progress and serve the download
+"""
+from pymongo import ReturnDocument
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import Optional, Dict, Any
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+import export_cache
+from excel_export import build_workbook, export_query, load_afdelinger, zip_entries, iter_zip
+from storage_backends import get_storage
+
+logger = logging.getLogger(__name__)
+
+# Exports are disk and CPU heavy, so only a few run at once per process
+MAX_WORKERS = int(os.environ.get('EXPORT_JOB_WORKERS', 2))
+# Fallback poll for jobs queued by other server processes
+POLL_SECONDS = float(os.environ.get('EXPORT_JOB_POLL_SECONDS', 5))
+# A running job without a progress update for this long is assumed dead and requeued
+STALE_SECONDS = int(os.environ.get('EXPORT_JOB_STALE_SECONDS', 600))
+# A running job touches updated_at this often, so a long workbook save or ZIP isn't taken for dead
+HEARTBEAT_SECONDS = STALE_SECONDS / 4
+# Finished files are deleted from storage after this long; keep it below the job
+# documents' one week TTL, or the document goes first and its file is never found
+FILE_TTL_SECONDS = int(os.environ.get('EXPORT_JOB_FILE_TTL_SECONDS', 2 * 24 * 3600))
+CLEANUP_INTERVAL_SECONDS = 3600
+# Storage key prefix for finished export files
+KEY_PREFIX = "exports/"
+
+_workers: list = []
+_wakeup: Optional[asyncio.Event] = None
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def job_status(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Public view of a job document"""
+    total = job.get("total") or 0
+    processed = job.get("processed", 0)
+    if job["status"] == "done":
+        percent = 100
+    else:
+        percent = min(99, int(processed * 100 / total)) if total else 0
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "stage": job.get("stage"),
+        "processed": processed,
+        "total": total,
+        "percent": percent,
+        "filename": job["scope"]["filename"] + (Path(job["file"]).suffix if job.get("file") else ""),
+        "error": job.get("error"),
+        "created_at": job["created_at"].isoformat(),
+        "finished_at": job["finished_at"].isoformat() if job.get("finished_at") else None
+    }
+
+
+async def enqueue(db, user_id: str, scope: Dict[str, Any]) -> Dict[str, Any]:
+    """Queue an export, reusing the user's unfinished job for the same scope"""
+    existing = await db.export_jobs.find_one(
+        {"user_id": user_id, "scope": scope, "status": {"$in": ["queued", "running"]}},
+        {"_id": 0}
+    )
+    if existing:
+        return existing
+
+    now = _now()
+    job = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "scope": scope,
+        "status": "queued",
+        "stage": None,
+        "processed": 0,
+        "total": 0,
+        "created_at": now,
+        "updated_at": now
+    }
+    await db.export_jobs.insert_one(dict(job))
+    if _wakeup:
+        _wakeup.set()
+    return job
+
+
+async def get_job(db, job_id: str) -> Optional[Dict[str, Any]]:
+    return await db.export_jobs.find_one({"id": job_id}, {"_id": 0})
+
+
+def artifact_key(job: Dict[str, Any]) -> Optional[str]:
+    """Storage key of a finished job's file, None once it has been cleaned up"""
+    key = job.get("file")
+    # Jobs from before files moved to storage hold a local cache path
+    return key if key and key.startswith(KEY_PREFIX) else None
+
+
+async def _update(db, job_id: str, fields: Dict[str, Any]):
+    await db.export_jobs.update_one({"id": job_id}, {"$set": {**fields, "updated_at": _now()}})
+
+
+async def _claim(db) -> Optional[Dict[str, Any]]:
+    """Atomically take the oldest queued (or abandoned) job"""
+    now = _now()
+    return await db.export_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued"},
+            {"status": "running", "updated_at": {"$lt": now - timedelta(seconds=STALE_SECONDS)}}
+        ]},
+        {"$set": {"status": "running", "stage": "forbereder", "started_at": now, "updated_at": now}},
+        projection={"_id": 0},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _publish(job: Dict[str, Any], entry: export_cache.CachedExport) -> str:
+    """Copy a cached export into storage under the job's key"""
+    key = f"{KEY_PREFIX}{job['id']}{entry.path.suffix}"
+    fd, tmp_path = tempfile.mkstemp(suffix=entry.path.suffix, prefix="export_")
+
+    def copy():
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(entry.file, f)
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, copy)
+        await get_storage().put_file(key, Path(tmp_path))
+    finally:
+        entry.close()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return key
+
+
+async def _build(db, job: Dict[str, Any]) -> str:
+    scope = job["scope"]
+    cache_key = await export_cache.cache_key(db, scope)
+    cached = await export_cache.lookup(cache_key)
+    if cached:
+        return await _publish(job, cached)
+
+    total = await db.transactions.count_documents(export_query(scope))
+    await _update(db, job["id"], {"stage": "posteringer", "total": total})
+
+    async def on_progress(processed: int):
+        await _update(db, job["id"], {"processed": processed})
+
+    afdelinger = await load_afdelinger(db, scope)
+    excel_path, receipt_files = await build_workbook(
+        db, afdelinger, scope["regnskabsaar"], combined=scope["combined"], on_progress=on_progress
+    )
+    if not receipt_files:
+        await _update(db, job["id"], {"processed": total})
+        return await _publish(job, await export_cache.store(excel_path, cache_key, ".xlsx"))
+
+    await _update(db, job["id"], {"stage": "kvitteringer", "processed": total})
+    entries = zip_entries(excel_path, receipt_files, scope)
+    fd, zip_path = tempfile.mkstemp(suffix=".zip", prefix="export_")
+
+    def write_zip():
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter_zip(entries, cleanup=[excel_path]):
+                f.write(chunk)
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, write_zip)
+    except BaseException:
+        os.unlink(zip_path)
+        raise
+    return await _publish(job, await export_cache.store(zip_path, cache_key, ".zip"))
+
+
+async def _heartbeat(db, job_id: str):
+    while True:
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+        try:
+            await _update(db, job_id, {})
+        except Exception as e:
+            logger.warning(f"Export job {job_id} heartbeat failed: {e}")
+
+
+async def _run(db, job: Dict[str, Any]):
+    heartbeat = asyncio.create_task(_heartbeat(db, job["id"]))
+    try:
+        key = await _build(db, job)
+    except asyncio.CancelledError:
+        # Server is shutting down; let another process or the next start finish it
+        await _update(db, job["id"], {"status": "queued", "stage": None})
+        raise
+    except Exception as e:
+        logger.exception(f"Export job {job['id']} failed")
+        await _update(db, job["id"], {"status": "failed", "error": str(e), "finished_at": _now()})
+        return
+    finally:
+        heartbeat.cancel()
+    await _update(db, job["id"], {"status": "done", "stage": None, "file": key, "finished_at": _now()})
+    logger.info(f"Export job {job['id']} done: {key}")
+
+
+async def remove_expired_files(db) -> int:
+    """Delete finished jobs' files older than FILE_TTL_SECONDS from storage"""
+    cutoff = _now() - timedelta(seconds=FILE_TTL_SECONDS)
+    storage = get_storage()
+    removed = 0
+    query = {"status": "done", "finished_at": {"$lt": cutoff}, "file": {"$ne": None}}
+    async for job in db.export_jobs.find(query, {"_id": 0, "id": 1, "file": 1}):
+        key = artifact_key(job)
+        if key:
+            await storage.delete(key)
+            removed += 1
+        await db.export_jobs.update_one({"id": job["id"]}, {"$set": {"file": None}})
+    return removed
+
+
+async def _cleaner(db):
+    while True:
+        try:
+            removed = await remove_expired_files(db)
+            if removed:
+                logger.info(f"Removed {removed} expired export files")
+        except Exception as e:
+            logger.error(f"Could not remove expired export files: {e}")
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+
+
+async def _worker(db):
+    while True:
+        _wakeup.clear()
+        try:
+            job = await _claim(db)
+        except Exception as e:
+            logger.error(f"Could not claim export job: {e}")
+            job = None
+        if job is None:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await _run(db, job)
+
+
+def start(db):
+    """Start the worker pool on the running event loop"""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    _workers.extend(asyncio.create_task(_worker(db)) for _ in range(MAX_WORKERS))
+    _workers.append(asyncio.create_task(_cleaner(db)))
+
+
+async def stop():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
@@ -3,18 +3,27 @@ Google Drive Integration Service for Tour de Taxa
 Handles OAuth flow, file upload, download, and folder management
 """
 from fastapi import HTTPException, UploadFile
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request as GoogleRequest
-from datetime import datetime, timezone
-from typing import Optional, List, Dict, Any
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from typing import Optional, List, Dict, Any, Callable, Awaitable, BinaryIO, AsyncIterator
+import asyncio
+import httplib2
 import os
-import io
-import tempfile
+import json
+import time
 import logging
 
+import drive_client
+from drive_client import DriveClient
+from ttl_cache import TTLCache
+
 logger = logging.getLogger(__name__)
 
 # Google Drive scopes - using drive.file for app-specific files only
@@ -24,6 +33,41 @@ SCOPES = ['https://www.googleapis.com/auth/drive.file']
 BASE_FOLDER_NAME = "Tour de Taxa"
 KVITTERINGER_FOLDER_NAME = "Kvitteringer"
 
+# Resumable uploads send the file in chunks of this size (Drive wants a
+# multiple of 256 KiB); memory use per upload is bounded by it
+UPLOAD_CHUNK_SIZE = max(
+    int(os.environ.get('DRIVE_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)) // (256 * 1024), 1
+) * 256 * 1024
+# Retries per chunk on 5xx/429 and connection errors, with exponential backoff
+UPLOAD_CHUNK_RETRIES = int(os.environ.get('DRIVE_UPLOAD_CHUNK_RETRIES', 3))
+
+# Downloads are fetched from Drive in ranged requests of this size and
+# passed on to the client as each arrives
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DRIVE_DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+
+# How long one process may hold a user's folder lock while resolving folders
+FOLDER_LOCK_SECONDS = 30
+
+# Per-user locks so this process resolves a user's folders once at a time
+_folder_locks: Dict[str, asyncio.Lock] = {}
+
+
+class DriveFolderMissing(Exception):
+    """A cached folder ID points at a folder that was deleted or trashed"""
+
+
+# (Drive client, credentials) per user, so a warm call needs no credentials lookup or client build
+drive_service_cache = TTLCache(
+    max_size=int(os.environ.get('DRIVE_SERVICE_CACHE_MAX_SIZE', 200)),
+    ttl_seconds=float(os.environ.get('DRIVE_SERVICE_CACHE_TTL_SECONDS', 900))
+)
+
+
+@lru_cache(maxsize=None)
+def _drive_discovery() -> dict:
+    # The Drive v3 discovery document shipped with googleapiclient, parsed once
+    return json.loads(get_static_doc('drive', 'v3'))
+
 
 def get_oauth_flow(redirect_uri: str = None) -> Flow:
     """Create OAuth flow for Google Drive"""
@@ -77,7 +121,8 @@ async def handle_oauth_callback(code: str, state: str, db) -> dict:
         redirect_uri=redirect_uri
     )
     
-    flow.fetch_token(code=code)
+    # The token exchange is a blocking HTTP request
+    await drive_client.run(state, flow.fetch_token, code=code)
     credentials = flow.credentials
     
     logger.info(f"Drive credentials obtained for user {state}, scopes: {credentials.scopes}")
@@ -111,34 +156,51 @@ async def handle_oauth_callback(code: str, state: str, db) -> dict:
         upsert=True
     )
     
+    drive_service_cache.invalidate(state)
+    # The new connection may be to another Google account
+    await db.drive_folders.delete_many({"user_id": state})
     logger.info(f"Drive credentials stored for user {state}")
     return {"success": True, "user_id": state}
 
 
 async def get_drive_service(user_id: str, db):
-    """Get Google Drive service with auto-refresh credentials"""
-    creds_doc = await db.drive_credentials.find_one({"user_id": user_id}, {"_id": 0})
-    if not creds_doc:
-        raise HTTPException(
-            status_code=400,
-            detail="Google Drive er ikke tilsluttet. Tilslut venligst din Google Drive først."
+    """Get Google Drive service with auto-refresh credentials.
+
+    Built clients are cached per user, so a warm call costs neither a
+    credentials lookup nor a client build. Returns a DriveClient, whose
+    requests are awaited.
+    """
+    cached = drive_service_cache.get(user_id)
+    if cached is not None:
+        service, creds = cached
+    else:
+        creds_doc = await db.drive_credentials.find_one({"user_id": user_id}, {"_id": 0})
+        if not creds_doc:
+            raise HTTPException(
+                status_code=400,
+                detail="Google Drive er ikke tilsluttet. Tilslut venligst din Google Drive først."
+            )
+        
+        # Create credentials object
+        creds = Credentials(
+            token=creds_doc["access_token"],
+            refresh_token=creds_doc.get("refresh_token"),
+            token_uri=creds_doc["token_uri"],
+            client_id=creds_doc["client_id"],
+            client_secret=creds_doc["client_secret"],
+            scopes=creds_doc["scopes"],
+            # google-auth compares against naive UTC
+            expiry=datetime.fromisoformat(creds_doc["expiry"]).replace(tzinfo=None) if creds_doc.get("expiry") else None
         )
-    
-    # Create credentials object
-    creds = Credentials(
-        token=creds_doc["access_token"],
-        refresh_token=creds_doc.get("refresh_token"),
-        token_uri=creds_doc["token_uri"],
-        client_id=creds_doc["client_id"],
-        client_secret=creds_doc["client_secret"],
-        scopes=creds_doc["scopes"]
-    )
+        # Static discovery: no discovery request, and the document is parsed once per process
+        service = build_from_document(_drive_discovery(), http=drive_client.authorized_http(creds))
+        drive_service_cache.set(user_id, (service, creds))
     
     # Auto-refresh if expired
     if creds.expired and creds.refresh_token:
         logger.info(f"Refreshing expired token for user {user_id}")
         try:
-            creds.refresh(GoogleRequest())
+            await drive_client.run(user_id, creds.refresh, GoogleRequest())
             
             # Update in database
             await db.drive_credentials.update_one(
@@ -149,27 +211,30 @@ async def get_drive_service(user_id: str, db):
                     "updated_at": datetime.now(timezone.utc).isoformat()
                 }}
             )
+        except drive_client.DriveTimeout:
+            raise
         except Exception as e:
             logger.error(f"Failed to refresh token: {e}")
+            drive_service_cache.invalidate(user_id)
             raise HTTPException(
                 status_code=401,
                 detail="Google Drive session udløbet. Tilslut venligst igen."
             )
     
-    return build('drive', 'v3', credentials=creds)
+    return DriveClient(user_id, service)
 
 
-async def get_or_create_folder(service, folder_name: str, parent_id: str = None) -> str:
+async def get_or_create_folder(service: DriveClient, folder_name: str, parent_id: str = None) -> str:
     """Get existing folder or create new one, return folder ID"""
     query = f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
     if parent_id:
         query += f" and '{parent_id}' in parents"
     
-    results = service.files().list(
+    results = await service.execute(service.files().list(
         q=query,
         spaces='drive',
         fields='files(id, name)'
-    ).execute()
+    ))
     
     files = results.get('files', [])
     
@@ -184,20 +249,16 @@ async def get_or_create_folder(service, folder_name: str, parent_id: str = None)
     if parent_id:
         file_metadata['parents'] = [parent_id]
     
-    folder = service.files().create(
+    folder = await service.execute(service.files().create(
         body=file_metadata,
         fields='id'
-    ).execute()
+    ))
     
     logger.info(f"Created folder '{folder_name}' with ID: {folder.get('id')}")
     return folder.get('id')
 
 
-async def ensure_folder_structure(service, afdeling_navn: str, regnskabsaar: str) -> str:
-    """
-    Ensure folder structure exists: Tour de Taxa/Kvitteringer/[Afdeling]/[Regnskabsaar]
-    Returns the final folder ID
-    """
+async def _resolve_folder_structure(service: DriveClient, afdeling_navn: str, regnskabsaar: str) -> str:
     # Get or create base folder
     base_folder_id = await get_or_create_folder(service, BASE_FOLDER_NAME)
     
@@ -213,61 +274,164 @@ async def ensure_folder_structure(service, afdeling_navn: str, regnskabsaar: str
     return year_folder_id
 
 
+async def _lock_folders(user_id: str, db) -> bool:
+    """Take the user's folder lock across server processes. Returns False if
+    it couldn't be had within FOLDER_LOCK_SECONDS."""
+    deadline = time.monotonic() + FOLDER_LOCK_SECONDS
+    while time.monotonic() < deadline:
+        now = datetime.now(timezone.utc)
+        claimed = await db.drive_credentials.find_one_and_update(
+            {"user_id": user_id, "$or": [
+                {"folders_locked_until": {"$exists": False}},
+                {"folders_locked_until": {"$lt": now}}
+            ]},
+            {"$set": {"folders_locked_until": now + timedelta(seconds=FOLDER_LOCK_SECONDS)}}
+        )
+        if claimed:
+            return True
+        if not await db.drive_credentials.count_documents({"user_id": user_id}):
+            return False
+        await asyncio.sleep(0.2)
+    return False
+
+
+async def ensure_folder_structure(
+    service: DriveClient,
+    afdeling_navn: str,
+    regnskabsaar: str,
+    user_id: str,
+    db,
+    stale_folder_id: Optional[str] = None
+) -> str:
+    """
+    Ensure folder structure exists: Tour de Taxa/Kvitteringer/[Afdeling]/[Regnskabsaar]
+    Returns the final folder ID. Resolved IDs are kept in drive_folders and
+    trusted without a Drive call; pass stale_folder_id when Drive reported the
+    cached folder missing to resolve it again.
+    """
+    key = {"user_id": user_id, "afdeling_navn": afdeling_navn, "regnskabsaar": regnskabsaar}
+    cached = await db.drive_folders.find_one(key, {"_id": 0, "folder_id": 1})
+    if cached and cached["folder_id"] != stale_folder_id:
+        return cached["folder_id"]
+    
+    # Concurrent first calls would otherwise each create the missing folders
+    async with _folder_locks.setdefault(user_id, asyncio.Lock()):
+        locked = await _lock_folders(user_id, db)
+        try:
+            # Another caller may have resolved it while we waited
+            cached = await db.drive_folders.find_one(key, {"_id": 0, "folder_id": 1})
+            if cached and cached["folder_id"] != stale_folder_id:
+                return cached["folder_id"]
+            
+            folder_id = await _resolve_folder_structure(service, afdeling_navn, regnskabsaar)
+            await db.drive_folders.update_one(
+                key,
+                {"$set": {**key, "folder_id": folder_id, "resolved_at": datetime.now(timezone.utc).isoformat()}},
+                upsert=True
+            )
+            return folder_id
+        finally:
+            if locked:
+                await db.drive_credentials.update_one({"user_id": user_id}, {"$unset": {"folders_locked_until": ""}})
+
+
+async def with_receipt_folder(
+    service: DriveClient,
+    afdeling_navn: str,
+    regnskabsaar: str,
+    user_id: str,
+    db,
+    operation: Callable[[str], Awaitable[Any]]
+) -> Any:
+    """Run operation(folder_id) in the receipt folder. If Drive reports the
+    cached folder missing, resolve it again and retry once."""
+    folder_id = await ensure_folder_structure(service, afdeling_navn, regnskabsaar, user_id, db)
+    try:
+        return await operation(folder_id)
+    except (HttpError, DriveFolderMissing) as e:
+        if isinstance(e, HttpError) and e.resp.status != 404:
+            raise
+        logger.info(f"Drive folder {folder_id} is gone, resolving it again")
+    folder_id = await ensure_folder_structure(
+        service, afdeling_navn, regnskabsaar, user_id, db, stale_folder_id=folder_id
+    )
+    return await operation(folder_id)
+
+
 async def upload_file_to_drive(
-    service,
-    file_content: bytes,
+    service: DriveClient,
+    source: BinaryIO,
     filename: str,
     folder_id: str,
     mime_type: str = None
 ) -> Dict[str, str]:
-    """Upload a file to Google Drive and return file info"""
+    """Upload a file to Google Drive and return file info.
+
+    `source` is a seekable binary file, e.g. an UploadFile's spool. It is
+    sent as a resumable upload, UPLOAD_CHUNK_SIZE bytes per request, each
+    chunk retried on its own.
+    """
+    source.seek(0)
+    file_metadata = {
+        'name': filename,
+        'parents': [folder_id]
+    }
     
-    # Write content to temp file
-    with tempfile.NamedTemporaryFile(delete=False) as tmp:
-        tmp.write(file_content)
-        tmp_path = tmp.name
+    media = MediaIoBaseUpload(
+        source,
+        mimetype=mime_type or 'application/octet-stream',
+        chunksize=UPLOAD_CHUNK_SIZE,
+        resumable=True
+    )
     
-    try:
-        file_metadata = {
-            'name': filename,
-            'parents': [folder_id]
-        }
-        
-        media = MediaFileUpload(
-            tmp_path,
-            mimetype=mime_type or 'application/octet-stream',
-            resumable=True
-        )
-        
-        file = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, name, webViewLink, webContentLink'
-        ).execute()
-        
-        logger.info(f"Uploaded file '{filename}' with ID: {file.get('id')}")
-        
-        return {
-            "file_id": file.get('id'),
-            "filename": file.get('name'),
-            "web_view_link": file.get('webViewLink'),
-            "download_link": file.get('webContentLink')
-        }
-    finally:
-        # Clean up temp file
-        os.unlink(tmp_path)
+    request = service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields='id, name, webViewLink, webContentLink'
+    )
+    # One pool call per chunk, so the call timeout applies per chunk
+    file = None
+    failures = 0
+    while file is None:
+        try:
+            status, file = await service.call(request.next_chunk)
+            failures = 0
+        except (HttpError, httplib2.HttpLib2Error, OSError) as e:
+            retryable = not isinstance(e, HttpError) or e.resp.status >= 500 or e.resp.status == 429
+            if not retryable or failures >= UPLOAD_CHUNK_RETRIES:
+                raise
+            failures += 1
+            logger.warning(f"Drive upload of '{filename}' failed ({e}), retrying chunk in {2 ** (failures - 1)}s")
+            # After a failure next_chunk first asks Drive how much it has
+            # received, then resumes from there. (next_chunk's own num_retries
+            # can't be used: it would resend an already consumed stream slice.)
+            await asyncio.sleep(2 ** (failures - 1))
+    
+    logger.info(f"Uploaded file '{filename}' with ID: {file.get('id')}")
+    
+    return {
+        "file_id": file.get('id'),
+        "filename": file.get('name'),
+        "web_view_link": file.get('webViewLink'),
+        "download_link": file.get('webContentLink')
+    }
 
 
-async def list_files_in_folder(service, folder_id: str) -> List[Dict[str, Any]]:
+async def list_files_in_folder(service: DriveClient, folder_id: str) -> List[Dict[str, Any]]:
     """List all files in a Google Drive folder"""
-    results = service.files().list(
+    results = await service.execute(service.files().list(
         q=f"'{folder_id}' in parents and trashed=false",
         spaces='drive',
         fields='files(id, name, mimeType, webViewLink, webContentLink, createdTime, size)',
         orderBy='createdTime desc'
-    ).execute()
+    ))
     
     files = results.get('files', [])
+    if not files:
+        # A deleted or trashed folder also lists as empty
+        folder = await service.execute(service.files().get(fileId=folder_id, fields='trashed'))
+        if folder.get('trashed'):
+            raise DriveFolderMissing(folder_id)
     return [
         {
             "file_id": f.get('id'),
@@ -282,33 +446,58 @@ async def list_files_in_folder(service, folder_id: str) -> List[Dict[str, Any]]:
     ]
 
 
-async def download_file_from_drive(service, file_id: str) -> tuple:
-    """Download a file from Google Drive, returns (content, filename, mime_type)"""
-    # Get file metadata
-    file_metadata = service.files().get(
+async def get_drive_file_info(service: DriveClient, file_id: str) -> Dict[str, Any]:
+    """Name, MIME type, size and validators of a Drive file"""
+    file_metadata = await service.execute(service.files().get(
         fileId=file_id,
-        fields='name, mimeType'
-    ).execute()
+        fields='name, mimeType, size, modifiedTime, md5Checksum'
+    ))
+    if file_metadata.get('size') is None:
+        # Google Docs and other native files have no binary content to download
+        raise HTTPException(status_code=404, detail="Fil ikke fundet eller ingen adgang")
     
-    # Download file content
+    return {
+        "filename": file_metadata.get('name'),
+        "mime_type": file_metadata.get('mimeType'),
+        "size": int(file_metadata['size']),
+        "mtime": datetime.fromisoformat(file_metadata['modifiedTime']).timestamp(),
+        "md5": file_metadata.get('md5Checksum')
+    }
+
+
+def _read_media_range(request, start: int, end: int) -> bytes:
+    # Runs in the Drive pool; request.http is the service's thread safe http
+    resp, content = request.http.request(request.uri, "GET", headers={"range": f"bytes={start}-{end}"})
+    if resp.status not in (200, 206):
+        raise HttpError(resp, content, uri=request.uri)
+    if resp.status == 200:
+        # Range ignored, the whole file came back
+        content = content[start:end + 1]
+    return content
+
+
+async def iter_drive_file(service: DriveClient, file_id: str, start: int, end: int) -> AsyncIterator[bytes]:
+    """Yield bytes start..end (inclusive) of a Drive file, DOWNLOAD_CHUNK_SIZE at a time"""
     request = service.files().get_media(fileId=file_id)
-    file_content = io.BytesIO()
-    downloader = MediaIoBaseDownload(file_content, request)
-    
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-    
-    file_content.seek(0)
-    return file_content.read(), file_metadata.get('name'), file_metadata.get('mimeType')
+    position = start
+    while position <= end:
+        chunk = await service.call(
+            _read_media_range, request, position, min(position + DOWNLOAD_CHUNK_SIZE - 1, end)
+        )
+        if not chunk:
+            break
+        position += len(chunk)
+        yield chunk
 
 
-async def delete_file_from_drive(service, file_id: str) -> bool:
+async def delete_file_from_drive(service: DriveClient, file_id: str) -> bool:
     """Delete a file from Google Drive"""
     try:
-        service.files().delete(fileId=file_id).execute()
+        await service.execute(service.files().delete(fileId=file_id))
         logger.info(f"Deleted file with ID: {file_id}")
         return True
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to delete file {file_id}: {e}")
         return False
@@ -329,5 +518,7 @@ async def check_drive_connection(user_id: str, db) -> Dict[str, Any]:
 
 async def disconnect_drive(user_id: str, db) -> bool:
     """Remove Google Drive connection for user"""
+    drive_service_cache.invalidate(user_id)
+    await db.drive_folders.delete_many({"user_id": user_id})
     result = await db.drive_credentials.delete_one({"user_id": user_id})
     return result.deleted_count > 0
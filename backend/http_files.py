@@ -0,0 +1,142 @@
+"""
+HTTP file serving for Tour de Taxa
+Streams stored files with validators (ETag/Last-Modified), 304 answers for
+conditional requests and single byte ranges
+"""
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Iterator, AsyncIterator, Tuple, Callable, Union
+from urllib.parse import quote
+import mimetypes
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def media_type_for(filename: str) -> str:
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def content_disposition(filename: str, disposition: str = "inline") -> str:
+    # Plain ASCII fallback plus the RFC 5987 form for æ, ø and å
+    fallback = filename.encode("ascii", "replace").decode().replace('"', "")
+    return f"{disposition}; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a Range header into an inclusive (start, end).
+
+    Returns None when the whole file should be sent: no header, another unit,
+    or several ranges (serving the full file is always allowed).
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].strip()
+    if "," in spec:
+        return None
+    start_text, sep, end_text = spec.partition("-")
+    if not sep:
+        return None
+    try:
+        if not start_text:
+            # Suffix range: the last N bytes
+            length = int(end_text)
+        else:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+    except ValueError:
+        return None
+    if not start_text:
+        if length <= 0 or size == 0:
+            raise RangeNotSatisfiable(header)
+        return max(size - length, 0), size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, size - 1)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # Weak comparison, as If-None-Match requires
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+
+def _if_range_matches(if_range: str, etag: str, last_modified: str) -> bool:
+    # If-Range needs a strong validator: a weak ETag on either side never matches,
+    # and a date must be exactly the current Last-Modified
+    value = if_range.strip()
+    if value.startswith(('"', "W/")):
+        return value == etag and not etag.startswith("W/")
+    return value == last_modified
+
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def serve_content(
+    request: Request,
+    size: int,
+    mtime: float,
+    read_range: Callable[[int, int], Union[Iterator[bytes], AsyncIterator[bytes]]],
+    filename: str,
+    etag: Optional[str] = None,
+    cache_control: str = "private, no-cache",
+    media_type: Optional[str] = None,
+    disposition: str = "inline"
+) -> Response:
+    """Respond with stored content, honouring conditional and Range requests.
+
+    `read_range(start, end)` yields the bytes start..end (inclusive); a sync
+    iterator is iterated in a worker thread, an async one on the loop.
+    `etag` should be a quoted strong validator when the caller knows one
+    (e.g. a content hash). Otherwise a weak one is built from mtime and size.
+    The media type is guessed from the filename unless given.
+    """
+    etag = etag or f'W/"{int(mtime):x}-{size:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+
+    if is_not_modified(request, etag, mtime):
+        return Response(status_code=304, headers=headers)
+
+    headers["Content-Disposition"] = content_disposition(filename, disposition)
+    media_type = media_type or media_type_for(filename)
+
+    # If-Range: only honour the range if the client's copy is still current
+    if_range = request.headers.get("if-range")
+    range_header = request.headers.get("range")
+    if if_range and not _if_range_matches(if_range, etag, headers["Last-Modified"]):
+        range_header = None
+
+    try:
+        byte_range = parse_range(range_header, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(read_range(0, size - 1), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(read_range(start, end), status_code=206, media_type=media_type, headers=headers)
+
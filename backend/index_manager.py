@@ -0,0 +1,168 @@
+"""
+MongoDB index provisioning for Tour de Taxa
+Declares the indexes each collection needs, creates missing ones at startup
+and reports drift between the declaration and the live database
+"""
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from typing import Dict, List, Any
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Declared indexes per collection. Names are explicit so drift can be matched by name.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("afdeling_navn", ASCENDING), ("role", ASCENDING)], name="afdeling_navn_role"),
+    ],
+    "afdelinger": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("navn", ASCENDING)], name="navn"),
+    ],
+    "settings": [
+        # One settings document per afdeling, or bilagnr could be reserved from either copy
+        IndexModel([("afdeling_id", ASCENDING)], name="afdeling_id", unique=True),
+    ],
+    "transactions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("afdeling_id", ASCENDING), ("regnskabsaar", ASCENDING), ("bank_dato", ASCENDING)],
+            name="afdeling_regnskabsaar_bank_dato"
+        ),
+        IndexModel(
+            [("afdeling_id", ASCENDING), ("regnskabsaar", ASCENDING), ("bilagnr_nr", ASCENDING)],
+            name="afdeling_regnskabsaar_bilagnr_nr"
+        ),
+        IndexModel([("kvittering_drive_id", ASCENDING)], name="kvittering_drive_id", sparse=True),
+        IndexModel([("kvittering_url", ASCENDING)], name="kvittering_url", sparse=True),
+    ],
+    "balances": [
+        IndexModel(
+            [("afdeling_id", ASCENDING), ("regnskabsaar", ASCENDING)],
+            name="afdeling_regnskabsaar_unique", unique=True
+        ),
+    ],
+    "drive_credentials": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "drive_folders": [
+        IndexModel(
+            [("user_id", ASCENDING), ("afdeling_navn", ASCENDING), ("regnskabsaar", ASCENDING)],
+            name="user_afdeling_regnskabsaar_unique", unique=True
+        ),
+    ],
+    "receipt_blobs": [
+        IndexModel([("sha256", ASCENDING)], name="sha256_unique", unique=True),
+    ],
+    "receipts": [
+        IndexModel([("transaction_id", ASCENDING)], name="transaction_id_unique", unique=True),
+        IndexModel([("kvittering_url", ASCENDING)], name="kvittering_url"),
+        IndexModel([("afdeling_navn", ASCENDING), ("regnskabsaar", ASCENDING)], name="afdeling_navn_regnskabsaar"),
+        IndexModel([("afdeling_id", ASCENDING)], name="afdeling_id"),
+    ],
+    "data_versions": [
+        IndexModel([("afdeling_id", ASCENDING)], name="afdeling_id_unique", unique=True),
+    ],
+    "export_jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created_at"),
+        # Finished jobs expire after a week; queued and running jobs have no finished_at
+        IndexModel([("finished_at", ASCENDING)], name="finished_at_ttl", expireAfterSeconds=7 * 24 * 3600),
+    ],
+}
+
+# Options that make two indexes with the same key behave differently
+_BOOLEAN_OPTIONS = ("unique", "sparse")
+_COMPARED_OPTIONS = _BOOLEAN_OPTIONS + ("expireAfterSeconds", "partialFilterExpression")
+# Fields of index_information() that describe the index rather than configure it
+_INFO_FIELDS = ("key", "v", "ns")
+
+
+def _options(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        opt: bool(doc.get(opt, False)) if opt in _BOOLEAN_OPTIONS else doc.get(opt)
+        for opt in _COMPARED_OPTIONS
+    }
+
+
+def _spec(model: IndexModel) -> Dict[str, Any]:
+    doc = model.document
+    return {"key": list(doc["key"].items()), **_options(doc)}
+
+
+def _live_spec(info: Dict[str, Any]) -> Dict[str, Any]:
+    return {"key": [(field, direction) for field, direction in info["key"]], **_options(info)}
+
+
+def _live_model(name: str, info: Dict[str, Any]) -> IndexModel:
+    """The IndexModel that re-creates a live index as it was"""
+    options = {opt: value for opt, value in info.items() if opt not in _INFO_FIELDS}
+    options["name"] = name
+    return IndexModel(list(info["key"]), **options)
+
+
+async def ensure_indexes(db) -> Dict[str, Any]:
+    """Create all declared indexes that are missing, and rebuild those whose
+    key or options have changed. Safe to run on every startup.
+
+    Failures (e.g. duplicates blocking a unique index) are logged and returned
+    instead of raised so the API can still start. A rebuild that fails puts
+    the old definition back, so the collection is never left without the index.
+    """
+    created = []
+    failed = []
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        for model in models:
+            name = model.document["name"]
+            previous = None
+            if name in existing:
+                if _live_spec(existing[name]) == _spec(model):
+                    continue
+                # Same name, new definition: the old index has to go before the new one can be built.
+                # MongoDB refuses a second index on the same key that differs only in options,
+                # so it cannot be built alongside under a temporary name.
+                previous = _live_model(name, existing[name])
+                await collection.drop_index(name)
+                logger.info(f"Dropped index {collection_name}.{name} to rebuild it")
+            try:
+                await collection.create_indexes([model])
+                created.append(f"{collection_name}.{name}")
+                logger.info(f"Created index {collection_name}.{name}")
+            except OperationFailure as e:
+                failed.append({"index": f"{collection_name}.{name}", "error": str(e)})
+                logger.error(f"Could not create index {collection_name}.{name}: {e}")
+                if previous is not None:
+                    await collection.create_indexes([previous])
+                    logger.warning(f"Restored the previous definition of {collection_name}.{name}")
+    return {"created": created, "failed": failed}
+
+
+async def verify_indexes(db) -> Dict[str, Any]:
+    """Compare declared indexes with the live database.
+
+    Returns per collection the declared indexes that are missing, those whose
+    key or options differ, and live indexes that are not declared.
+    """
+    report = {}
+    in_sync = True
+    for collection_name, models in INDEXES.items():
+        live = await db[collection_name].index_information()
+        live.pop("_id_", None)
+        declared = {model.document["name"]: _spec(model) for model in models}
+
+        missing = [name for name in declared if name not in live]
+        mismatched = [
+            {"name": name, "expected": declared[name], "actual": _live_spec(live[name])}
+            for name in declared
+            if name in live and _live_spec(live[name]) != declared[name]
+        ]
+        extra = [name for name in live if name not in declared]
+
+        if missing or mismatched:
+            in_sync = False
+        report[collection_name] = {"missing": missing, "mismatched": mismatched, "extra": extra}
+    return {"in_sync": in_sync, "collections": report}
@@ -0,0 +1,85 @@
+"""
+Instrumented thread pools for Tour de Taxa
+A bounded ThreadPoolExecutor for blocking calls made from async code, with
+queueing and wait-time metrics for the admin diagnostics
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+import asyncio
+import threading
+import time
+
+
+class InstrumentedPool:
+    """Runs blocking calls in a bounded thread pool and counts how many are
+    queued and active and how long they waited for a thread.
+
+    A call whose awaiting task is cancelled (e.g. by a timeout) before it got
+    a thread is dropped instead of run late.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        self._stats = {
+            "queued": 0,
+            "active": 0,
+            "completed": 0,
+            "dropped": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        submitted = time.perf_counter()
+        # Whether the call still counts as queued; whoever clears it (the
+        # thread picking it up or the caller giving up) adjusts the counter
+        call = {"queued": True}
+        with self._lock:
+            self._stats["queued"] += 1
+
+        def task():
+            wait_ms = (time.perf_counter() - submitted) * 1000
+            with self._lock:
+                if not call["queued"]:
+                    return None
+                call["queued"] = False
+                self._stats["queued"] -= 1
+                self._stats["active"] += 1
+                self._stats["total_wait_ms"] += wait_ms
+                self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._stats["active"] -= 1
+                    self._stats["completed"] += 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, task)
+        finally:
+            with self._lock:
+                if call["queued"]:
+                    call["queued"] = False
+                    self._stats["queued"] -= 1
+                    self._stats["dropped"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool size, saturation and queueing metrics"""
+        with self._lock:
+            stats = dict(self._stats)
+        completed = stats["completed"]
+        return {
+            "max_workers": self.max_workers,
+            "queued": stats["queued"],
+            "active": stats["active"],
+            "saturation": stats["active"] / self.max_workers,
+            "completed": completed,
+            "dropped": stats["dropped"],
+            "avg_wait_ms": stats["total_wait_ms"] / completed if completed else 0.0,
+            "max_wait_ms": stats["max_wait_ms"],
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
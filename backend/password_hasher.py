@@ -0,0 +1,34 @@
+"""
+Password hashing for Tour de Taxa
+Runs bcrypt in a bounded thread pool so a login doesn't stall the event loop
+"""
+from passlib.context import CryptContext
+from typing import Dict, Any
+import os
+
+from instrumented_pool import InstrumentedPool
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt releases the GIL, so threads give real parallelism up to the cap.
+# Calls beyond the cap wait in the executor queue instead of piling onto the CPU.
+MAX_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+
+_pool = InstrumentedPool(MAX_WORKERS, thread_name_prefix="bcrypt")
+
+
+async def hash_password(password: str) -> str:
+    return await _pool.run(pwd_context.hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _pool.run(pwd_context.verify, plain_password, hashed_password)
+
+
+def get_stats() -> Dict[str, Any]:
+    """Pool size and queueing metrics"""
+    return _pool.stats()
+
+
+def shutdown():
+    _pool.shutdown()
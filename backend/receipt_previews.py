@@ -0,0 +1,152 @@
+"""
+Receipt previews for Tour de Taxa
+Renders JPEG thumbnails and first-page previews of receipts in a process pool
+and caches them in receipt storage next to the original file
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, Dict, Tuple
+import asyncio
+import logging
+import mimetypes
+import multiprocessing
+import os
+import tempfile
+
+from storage_backends import get_storage
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Rendering is CPU bound and PDF/image decoders hold the GIL, hence processes
+MAX_WORKERS = int(os.environ.get('RECEIPT_PREVIEW_WORKERS', 2))
+
+VARIANTS: Dict[str, Tuple[int, int]] = {
+    "thumb": (240, 240),
+    "preview": (1200, 1600),
+}
+JPEG_QUALITY = 80
+
+# What _render decodes: PDF through pypdfium2, the rest through PIL's built-in plugins.
+# Other image types (HEIC, SVG, ...) get no preview rather than a failed render.
+PREVIEW_MEDIA_TYPES = {"application/pdf", "image/jpeg", "image/png", "image/gif", "image/bmp", "image/webp"}
+
+# Receipts whose render failed, so thumbnail requests don't re-render them every time
+_failed = TTLCache(
+    max_size=int(os.environ.get('RECEIPT_PREVIEW_FAILED_MAX_SIZE', 10000)),
+    ttl_seconds=float(os.environ.get('RECEIPT_PREVIEW_RETRY_SECONDS', 3600))
+)
+
+_executor: Optional[ProcessPoolExecutor] = None
+# Renders in flight per storage key, so concurrent requests share one render
+_pending: Dict[str, asyncio.Future] = {}
+_tasks: set = set()
+
+
+def preview_key(key: str, variant: str) -> str:
+    return f"{key}.{variant}.jpg"
+
+
+def can_preview(filename: str) -> bool:
+    return mimetypes.guess_type(filename)[0] in PREVIEW_MEDIA_TYPES
+
+
+def _render(source: str, is_pdf: bool, out_dir: str) -> Dict[str, str]:
+    # Runs in a worker process; imported here so the API process doesn't load the decoders
+    from PIL import Image
+
+    if is_pdf:
+        import pypdfium2
+
+        pdf = pypdfium2.PdfDocument(source)
+        try:
+            page = pdf[0]
+            # Scale the first page so its longest side covers the largest variant
+            scale = max(max(VARIANTS["preview"]) / max(page.get_size()), 0.1)
+            image = page.render(scale=scale).to_pil()
+        finally:
+            pdf.close()
+    else:
+        image = Image.open(source)
+        image.draft("RGB", VARIANTS["preview"])
+
+    image = image.convert("RGB")
+    rendered = {}
+    for variant, size in VARIANTS.items():
+        copy = image.copy()
+        copy.thumbnail(size)
+        rendered[variant] = os.path.join(out_dir, f"{variant}.jpg")
+        copy.save(rendered[variant], "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return rendered
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn: forking a process that runs Motor's threads is not safe
+        _executor = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+async def _generate(key: str, filename: str):
+    storage = get_storage()
+    is_pdf = mimetypes.guess_type(filename)[0] == "application/pdf"
+    with tempfile.TemporaryDirectory(prefix="preview-") as work_dir:
+        source = storage.local_path(key)
+        if source is None:
+            # Remote backend: render from a local copy
+            source = Path(work_dir) / "source"
+            await storage.fetch(key, source)
+        rendered = await asyncio.get_running_loop().run_in_executor(
+            _get_executor(), _render, str(source), is_pdf, work_dir
+        )
+        for variant, path in rendered.items():
+            await storage.put_file(preview_key(key, variant), Path(path))
+
+
+async def generate(key: str, filename: str) -> bool:
+    """Render all preview variants for a stored receipt. Returns False if the
+    file type has no preview or rendering failed; a failed receipt is not
+    tried again until RECEIPT_PREVIEW_RETRY_SECONDS have passed."""
+    if not can_preview(filename) or _failed.get(key):
+        return False
+    if key not in _pending:
+        _pending[key] = asyncio.ensure_future(_generate(key, filename))
+        _pending[key].add_done_callback(lambda _: _pending.pop(key, None))
+    try:
+        await asyncio.shield(_pending[key])
+    except Exception as e:
+        logger.warning(f"Could not render preview of {filename}: {e}")
+        _failed.set(key, True)
+        return False
+    return True
+
+
+async def _schedule(key: str, filename: str):
+    if await get_storage().stat(preview_key(key, "thumb")) is None:
+        await generate(key, filename)
+
+
+def schedule(key: str, filename: str):
+    """Start rendering previews in the background after an upload"""
+    if can_preview(filename):
+        task = asyncio.get_running_loop().create_task(_schedule(key, filename))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+
+async def get_preview(key: str, filename: str, variant: str) -> Optional[str]:
+    """Storage key of a receipt's cached preview, rendered on demand if it
+    isn't there yet"""
+    storage = get_storage()
+    target = preview_key(key, variant)
+    if await storage.stat(target) is not None:
+        return target
+    if await generate(key, filename) and await storage.stat(target) is not None:
+        return target
+    return None
+
+
+def shutdown():
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
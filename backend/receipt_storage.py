@@ -0,0 +1,347 @@
+"""
+Receipt storage for Tour de Taxa
+Streams uploaded receipt files to disk in chunks off the event loop and keeps
+them in a content-addressed blob store, one file per distinct SHA-256 with a
+reference count in the receipt_blobs collection. Blobs are kept in the
+configured storage backend (see storage_backends). The receipts collection
+indexes every transaction's receipt so listings and existence checks never
+touch storage
+"""
+from fastapi import UploadFile
+from pymongo import ReturnDocument
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional, Dict, Any, List
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+from storage_backends import get_storage
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_RECEIPT_BYTES = int(os.environ.get('RECEIPT_MAX_BYTES', 25 * 1024 * 1024))
+
+# Receipts uploaded before the blob store were saved by path under here
+UPLOAD_ROOT = Path("/app")
+# Uploads are spooled here until their hash is known. With local storage keep
+# it on the same filesystem so storing a blob is a rename.
+INCOMING_DIR = Path(os.environ.get('RECEIPT_SPOOL_DIR', '/app/uploads/incoming'))
+# How long an upload waits for a concurrent delete of the same blob to finish
+DELETE_WAIT_SECONDS = 30
+
+
+class ReceiptTooLarge(ValueError):
+    """Raised when an upload exceeds MAX_RECEIPT_BYTES"""
+
+
+def _open_temp(directory: Path):
+    directory.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    return os.fdopen(fd, "wb"), tmp_path
+
+
+def _write_chunk(f, digest, chunk: bytes):
+    digest.update(chunk)
+    f.write(chunk)
+
+
+def _commit(f, tmp_path: str, dest: Path):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(tmp_path, dest)
+
+
+def _discard(f, tmp_path: str):
+    f.close()
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+async def save_upload(upload: UploadFile, dest: Path, max_bytes: int = MAX_RECEIPT_BYTES) -> Dict[str, Any]:
+    """Write an upload to dest chunk by chunk.
+
+    The file is written to a temporary file in the destination folder and
+    renamed into place once complete, so dest never holds a partial file.
+    Hashing and disk writes run in the default executor. Returns the size
+    and SHA-256 hex digest of the saved file.
+    """
+    loop = asyncio.get_running_loop()
+    f, tmp_path = await loop.run_in_executor(None, _open_temp, dest.parent)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ReceiptTooLarge(f"Filen er for stor (maks {max_bytes // (1024 * 1024)} MB)")
+            await loop.run_in_executor(None, _write_chunk, f, digest, chunk)
+        await loop.run_in_executor(None, _commit, f, tmp_path, dest)
+    except BaseException:
+        # Also runs on cancellation (client gone), so no await here
+        _discard(f, tmp_path)
+        raise
+    return {"size": size, "sha256": digest.hexdigest()}
+
+
+def blob_key(sha256: str) -> str:
+    return f"blobs/{sha256[:2]}/{sha256}"
+
+
+def _strip_api(kvittering_url: str) -> str:
+    # URLs look like /uploads/kvitteringer/Afdeling/2024-2025/filename.pdf,
+    # sometimes with an /api prefix
+    return kvittering_url[4:] if kvittering_url.startswith("/api") else kvittering_url
+
+
+def legacy_path(kvittering_url: str) -> Path:
+    return UPLOAD_ROOT / _strip_api(kvittering_url).lstrip("/")
+
+
+def receipt_key(transaction: Dict[str, Any]) -> Optional[str]:
+    """Storage key of a transaction's receipt: its blob, or the file its URL
+    names for receipts uploaded before the blob store"""
+    if transaction.get("kvittering_sha256"):
+        return blob_key(transaction["kvittering_sha256"])
+    if transaction.get("kvittering_url"):
+        return _strip_api(transaction["kvittering_url"]).removeprefix("/uploads/")
+    return None
+
+
+async def _acquire(db, sha256: str, size: int, incoming: Path):
+    # Count the reference before the file is stored, see release_blob
+    blob = await db.receipt_blobs.find_one_and_update(
+        {"sha256": sha256},
+        {"$inc": {"refcount": 1}, "$setOnInsert": {"size": size}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    # A release that reached zero may be deleting the stored file right now
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + DELETE_WAIT_SECONDS
+    while blob and blob.get("deleting") and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+        blob = await db.receipt_blobs.find_one({"sha256": sha256})
+    if blob and blob.get("deleting"):
+        # The deleting process died; drop its mark so the blob can be released later
+        await db.receipt_blobs.update_one({"sha256": sha256}, {"$unset": {"deleting": ""}})
+
+    storage = get_storage()
+    if await storage.stat(blob_key(sha256)) is None:
+        await storage.put_file(blob_key(sha256), incoming)
+
+
+async def store_blob(db, upload: UploadFile, max_bytes: int = MAX_RECEIPT_BYTES) -> Dict[str, Any]:
+    """Save an upload in the blob store and take a reference to it.
+
+    Returns the size and SHA-256 of the file. The caller must record the hash
+    on the transaction and release any blob it replaces.
+    """
+    incoming = INCOMING_DIR / uuid.uuid4().hex
+    saved = await save_upload(upload, incoming, max_bytes)
+    try:
+        await _acquire(db, saved["sha256"], saved["size"], incoming)
+    finally:
+        # Already consumed unless the blob was stored before
+        incoming.unlink(missing_ok=True)
+    return saved
+
+
+async def release_blob(db, sha256: Optional[str]):
+    """Drop one reference to a blob and delete the file when it was the last one"""
+    if not sha256:
+        return
+    blob = await db.receipt_blobs.find_one_and_update(
+        {"sha256": sha256},
+        {"$inc": {"refcount": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob is None or blob["refcount"] > 0:
+        return
+
+    # Mark the blob while its files are deleted. An upload of the same content
+    # that takes a reference meanwhile waits for the mark to go before storing
+    # the file again, so it can't lose its copy to this delete.
+    claimed = await db.receipt_blobs.find_one_and_update(
+        {"sha256": sha256, "refcount": {"$lte": 0}, "deleting": {"$exists": False}},
+        {"$set": {"deleting": datetime.now(timezone.utc)}}
+    )
+    if not claimed:
+        return
+    storage = get_storage()
+    try:
+        await storage.delete(blob_key(sha256))
+        # Files derived from the blob (previews) are keyed <blob key>.<variant>...
+        await storage.delete_prefix(f"{blob_key(sha256)}.")
+    finally:
+        result = await db.receipt_blobs.delete_one({"sha256": sha256, "refcount": {"$lte": 0}})
+        if not result.deleted_count:
+            await db.receipt_blobs.update_one({"sha256": sha256}, {"$unset": {"deleting": ""}})
+
+
+def _url_folder(kvittering_url: str) -> tuple:
+    # /uploads/kvitteringer/[Afdeling]/[År]/[filename] -> (Afdeling, År, filename)
+    parts = kvittering_url.split("/")
+    return parts[-3], parts[-2], parts[-1]
+
+
+async def _receipt_doc(transaction: Dict[str, Any]) -> Dict[str, Any]:
+    key = receipt_key(transaction)
+    stored = await get_storage().stat(key)
+    if stored is None:
+        raise FileNotFoundError(key)
+    afdeling_navn, regnskabsaar, filename = _url_folder(transaction["kvittering_url"])
+    return {
+        "transaction_id": transaction["id"],
+        "afdeling_id": transaction["afdeling_id"],
+        "afdeling_navn": afdeling_navn,
+        "regnskabsaar": regnskabsaar,
+        "kvittering_url": transaction["kvittering_url"],
+        "filename": filename,
+        "key": key,
+        "sha256": transaction.get("kvittering_sha256"),
+        "size": stored.size,
+        "mtime": datetime.fromtimestamp(stored.mtime, timezone.utc)
+    }
+
+
+async def record_receipt(db, transaction: Dict[str, Any]):
+    """Index a transaction's current receipt. `transaction` must carry the new
+    kvittering_url (and kvittering_sha256 for blobs)."""
+    await db.receipts.update_one(
+        {"transaction_id": transaction["id"]},
+        {"$set": await _receipt_doc(transaction)},
+        upsert=True
+    )
+
+
+async def forget_receipt(db, transaction_id: str):
+    await db.receipts.delete_one({"transaction_id": transaction_id})
+
+
+async def find_receipt(db, kvittering_url: str) -> Optional[Dict[str, Any]]:
+    url = _strip_api(kvittering_url)
+    return await db.receipts.find_one({"kvittering_url": {"$in": [url, f"/api{url}"]}}, {"_id": 0})
+
+
+async def list_receipts(db, afdeling_navn: str, regnskabsaar: str) -> List[Dict[str, Any]]:
+    return await db.receipts.find(
+        {"afdeling_navn": afdeling_navn, "regnskabsaar": regnskabsaar},
+        {"_id": 0, "filename": 1, "size": 1, "kvittering_url": 1}
+    ).sort("filename", 1).to_list(None)
+
+
+async def indexed_receipts(db, afdeling_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Map transaction id to its receipt's storage key and mtime for the given afdelinger"""
+    receipts = {}
+    query = {"afdeling_id": {"$in": afdeling_ids}}
+    async for receipt in db.receipts.find(query, {"_id": 0, "transaction_id": 1, "key": 1, "mtime": 1}):
+        receipts[receipt["transaction_id"]] = receipt
+    return receipts
+
+
+async def storage_totals(db) -> Dict[str, Any]:
+    """Receipt bytes per afdeling, and what the blob store actually holds on disk"""
+    per_afdeling = await db.receipts.aggregate([
+        {"$group": {"_id": "$afdeling_navn", "files": {"$sum": 1}, "bytes": {"$sum": "$size"}}},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
+    blobs = await db.receipt_blobs.aggregate([
+        {"$group": {"_id": None, "blobs": {"$sum": 1}, "bytes": {"$sum": "$size"}}}
+    ]).to_list(None)
+    return {
+        "afdelinger": [{"afdeling_navn": row["_id"], "files": row["files"], "bytes": row["bytes"]} for row in per_afdeling],
+        "files": sum(row["files"] for row in per_afdeling),
+        "bytes": sum(row["bytes"] for row in per_afdeling),
+        "blob_count": blobs[0]["blobs"] if blobs else 0,
+        "blob_bytes": blobs[0]["bytes"] if blobs else 0
+    }
+
+
+async def rebuild_receipts(db) -> Dict[str, int]:
+    """Rebuild the receipts collection from transactions and the stored files"""
+    indexed = missing = 0
+    seen = []
+    query = {"kvittering_url": {"$nin": [None, ""]}}
+    projection = {"_id": 0, "id": 1, "afdeling_id": 1, "kvittering_url": 1, "kvittering_sha256": 1}
+    async for transaction in db.transactions.find(query, projection):
+        try:
+            await record_receipt(db, transaction)
+        except FileNotFoundError:
+            logger.warning(f"Receipt file not found: {receipt_key(transaction)}")
+            missing += 1
+            continue
+        seen.append(transaction["id"])
+        indexed += 1
+    await db.receipts.delete_many({"transaction_id": {"$nin": seen}})
+    return {"indexed": indexed, "missing": missing}
+
+
+async def ensure_receipts(db):
+    """Build the receipts index on first start against an existing database"""
+    outdated = await db.receipts.find_one({}) is None or await db.receipts.find_one({"key": {"$exists": False}})
+    if outdated and await db.transactions.find_one({"kvittering_url": {"$nin": [None, ""]}}):
+        logger.info("Receipt index empty or outdated, building from transactions")
+        await rebuild_receipts(db)
+
+
+def _hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def migrate_legacy(db) -> Dict[str, int]:
+    """Move receipts saved by path on this machine into the blob store"""
+    loop = asyncio.get_running_loop()
+    migrated = missing = 0
+    query = {"kvittering_url": {"$nin": [None, ""]}, "kvittering_sha256": {"$in": [None, ""]}}
+    async for transaction in db.transactions.find(query, {"_id": 0, "id": 1, "kvittering_url": 1}):
+        path = legacy_path(transaction["kvittering_url"])
+        if not path.exists():
+            logger.warning(f"Receipt file not found: {path}")
+            missing += 1
+            continue
+        sha256 = await loop.run_in_executor(None, _hash_file, path)
+        INCOMING_DIR.mkdir(parents=True, exist_ok=True)
+        incoming = INCOMING_DIR / uuid.uuid4().hex
+        await loop.run_in_executor(None, shutil.copyfile, path, incoming)
+        try:
+            await _acquire(db, sha256, path.stat().st_size, incoming)
+        finally:
+            incoming.unlink(missing_ok=True)
+        await db.transactions.update_one({"id": transaction["id"]}, {"$set": {"kvittering_sha256": sha256}})
+        await db.receipts.update_one(
+            {"transaction_id": transaction["id"]},
+            {"$set": {"key": blob_key(sha256), "sha256": sha256}}
+        )
+        path.unlink()
+        migrated += 1
+    return {"migrated": migrated, "missing": missing}
+
+
+if __name__ == "__main__":
+    # Usage: python receipt_storage.py [--reindex]
+    import sys
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    database = client[os.environ['DB_NAME']]
+    if "--reindex" in sys.argv:
+        result = asyncio.run(rebuild_receipts(database))
+        print(f"Indexed {result['indexed']} receipts, {result['missing']} files were missing")
+        sys.exit()
+    result = asyncio.run(migrate_legacy(database))
+    print(f"Moved {result['migrated']} receipts into the blob store, {result['missing']} files were missing")
@@ -1,36 +1,66 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, status, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, status, Query, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import StreamingResponse, RedirectResponse, Response
 from dotenv import load_dotenv
+from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import re
+import json
+import base64
+import asyncio
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError, field_validator, model_validator
+from pymongo import ReturnDocument, UpdateOne
 from typing import List, Optional, Literal
+from functools import partial
 import uuid
 from datetime import datetime, timezone, timedelta
-from passlib.context import CryptContext
 from jose import JWTError, jwt
-import io
-import zipfile
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
 
 # Google Drive imports
 from google_drive_service import (
     get_authorization_url,
     handle_oauth_callback,
     get_drive_service,
-    ensure_folder_structure,
+    with_receipt_folder,
     upload_file_to_drive,
     list_files_in_folder,
-    download_file_from_drive,
+    get_drive_file_info,
+    iter_drive_file,
     delete_file_from_drive,
     check_drive_connection,
-    disconnect_drive
+    disconnect_drive,
+    drive_service_cache
 )
+from index_manager import ensure_indexes, verify_indexes
+import balance_ledger
+import password_hasher
+import drive_client
+from bilagnr_allocator import reserve_bilagnr, bilagnr_number, merge_duplicate_settings
+from bank_import import iter_bank_rows, normalize_date, BankImportError
+from excel_export import build_workbook, export_scope, export_query, load_afdelinger, zip_entries, iter_zip
+import export_cache
+import export_jobs
+from receipt_storage import (
+    store_blob,
+    release_blob,
+    blob_key,
+    record_receipt,
+    forget_receipt,
+    find_receipt,
+    list_receipts,
+    storage_totals,
+    ensure_receipts,
+    ReceiptTooLarge
+)
+import receipt_previews
+from http_files import serve_content
+from storage_backends import get_storage, STREAM_CHUNK_SIZE
+from ttl_cache import TTLCache
+from password_hasher import hash_password, verify_password
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -41,7 +71,6 @@ client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 30
@@ -111,6 +140,8 @@ class TransactionCreate(BaseModel):
     formal: str
     belob: float
     type: Literal["indtaegt", "udgift"]
+    
+    _normalize_bank_dato = field_validator("bank_dato")(normalize_date)
 
 class Transaction(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -124,10 +155,20 @@ class Transaction(BaseModel):
     type: str
     regnskabsaar: Optional[str] = None
     kvittering_url: Optional[str] = None
+    kvittering_sha256: Optional[str] = None
     kvittering_drive_id: Optional[str] = None
     kvittering_drive_link: Optional[str] = None
     kvittering_filename: Optional[str] = None
     oprettet: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    # Sort key for bilagnr, which sorts wrong as a string (B999 after B1000)
+    bilagnr_nr: Optional[int] = None
+    
+    _normalize_bank_dato = field_validator("bank_dato")(normalize_date)
+    
+    @model_validator(mode="after")
+    def _set_bilagnr_nr(self):
+        self.bilagnr_nr = bilagnr_number(self.bilagnr)
+        return self
 
 class AfdelingSaldo(BaseModel):
     afdeling_id: str
@@ -143,13 +184,13 @@ class DashboardStats(BaseModel):
     antal_posteringer: Optional[int] = None
     afdelinger_saldi: Optional[List[AfdelingSaldo]] = None
 
-# Helper functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+# User objects by id, so authenticated requests skip the users lookup
+user_cache = TTLCache(
+    max_size=int(os.environ.get('USER_CACHE_MAX_SIZE', 1000)),
+    ttl_seconds=float(os.environ.get('USER_CACHE_TTL_SECONDS', 60))
+)
 
+# Helper functions
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
@@ -165,10 +206,16 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if user_id is None:
             raise HTTPException(status_code=401, detail="Ugyldig token")
         
+        cached = user_cache.get(user_id)
+        if cached is not None:
+            return cached
+        
         user = await db.users.find_one({"id": user_id}, {"_id": 0})
         if user is None:
             raise HTTPException(status_code=401, detail="Bruger ikke fundet")
-        return User(**user)
+        user_obj = User(**user)
+        user_cache.set(user_obj.id, user_obj)
+        return user_obj
     except JWTError:
         raise HTTPException(status_code=401, detail="Ugyldig token")
 
@@ -176,7 +223,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
 @api_router.post("/auth/login", response_model=Token)
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"username": credentials.username}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await verify_password(credentials.password, user["password"]):
         raise HTTPException(status_code=401, detail="Ugyldigt brugernavn eller adgangskode")
     
     user_obj = User(**user)
@@ -198,12 +245,13 @@ async def create_user(user_data: UserCreate, current_user: User = Depends(get_cu
         raise HTTPException(status_code=400, detail="Brugernavn eksisterer allerede")
     
     user_dict = user_data.model_dump()
-    user_dict["password"] = hash_password(user_dict["password"])
+    user_dict["password"] = await hash_password(user_dict["password"])
     user_obj = User(**{k: v for k, v in user_dict.items() if k != "password"})
     
     doc = user_obj.model_dump()
     doc["password"] = user_dict["password"]
     await db.users.insert_one(doc)
+    await export_cache.bump_version(db, user_obj.id)
     return user_obj
 
 @api_router.get("/admin/users", response_model=List[User])
@@ -220,6 +268,8 @@ async def delete_user(user_id: str, current_user: User = Depends(get_current_use
         raise HTTPException(status_code=403, detail="Kun superbruger kan slette brugere")
     
     result = await db.users.delete_one({"id": user_id})
+    user_cache.invalidate(user_id)
+    await export_cache.bump_version(db, user_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Bruger ikke fundet")
     return {"success": True}
@@ -233,11 +283,12 @@ async def update_user_password(
     if current_user.role != "superbruger":
         raise HTTPException(status_code=403, detail="Kun superbruger kan ændre passwords")
     
-    hashed_password = hash_password(password_update.new_password)
+    hashed_password = await hash_password(password_update.new_password)
     result = await db.users.update_one(
         {"id": user_id},
         {"$set": {"password": hashed_password}}
     )
+    user_cache.invalidate(user_id)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Bruger ikke fundet")
@@ -261,6 +312,8 @@ async def update_user_afdeling(
         {"id": user_id},
         {"$set": {"afdeling_navn": afdeling_update.afdeling_navn}}
     )
+    user_cache.invalidate(user_id)
+    await export_cache.bump_version(db, user_id)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Bruger ikke fundet")
@@ -352,7 +405,9 @@ async def get_all_settings(current_user: User = Depends(get_current_user)):
         settings = await db.settings.find_one({"afdeling_id": afdeling["id"]}, {"_id": 0})
         if not settings:
             settings_obj = SettingsModel(afdeling_id=afdeling["id"])
-            await db.settings.insert_one(settings_obj.model_dump())
+            await db.settings.update_one(
+                {"afdeling_id": afdeling["id"]}, {"$setOnInsert": settings_obj.model_dump()}, upsert=True
+            )
             settings = settings_obj.model_dump()
         
         result.append({
@@ -384,11 +439,13 @@ async def update_afdeling_settings(
     for key, value in update_data.items():
         setattr(settings_obj, key, value)
     
+    # naeste_bilagnr belongs to reserve_bilagnr; writing back the value read above could rewind it
     await db.settings.update_one(
         {"afdeling_id": afdeling_id},
-        {"$set": settings_obj.model_dump()},
+        {"$set": settings_obj.model_dump(exclude={"naeste_bilagnr"})},
         upsert=True
     )
+    await export_cache.bump_version(db, afdeling_id)
     return settings_obj
 
 # Settings routes
@@ -402,7 +459,9 @@ async def get_settings(current_user: User = Depends(get_current_user)):
     if not settings:
         # Create default settings
         settings_obj = SettingsModel(afdeling_id=afdeling_id)
-        await db.settings.insert_one(settings_obj.model_dump())
+        await db.settings.update_one(
+            {"afdeling_id": afdeling_id}, {"$setOnInsert": settings_obj.model_dump()}, upsert=True
+        )
         return settings_obj
     return SettingsModel(**settings)
 
@@ -423,11 +482,13 @@ async def update_settings(settings_update: SettingsUpdate, current_user: User =
     for key, value in update_data.items():
         setattr(settings_obj, key, value)
     
+    # naeste_bilagnr belongs to reserve_bilagnr; writing back the value read above could rewind it
     await db.settings.update_one(
         {"afdeling_id": current_user.id},
-        {"$set": settings_obj.model_dump()},
+        {"$set": settings_obj.model_dump(exclude={"naeste_bilagnr"})},
         upsert=True
     )
+    await export_cache.bump_version(db, current_user.id)
     return settings_obj
 
 # Transaction routes
@@ -436,44 +497,217 @@ async def create_transaction(transaction: TransactionCreate, current_user: User
     if current_user.role != "afdeling":
         raise HTTPException(status_code=403, detail="Kun afdelinger kan oprette posteringer")
     
-    # Get or create settings to get next bilagnr
-    settings = await db.settings.find_one({"afdeling_id": current_user.id}, {"_id": 0})
-    if not settings:
-        settings_obj = SettingsModel(afdeling_id=current_user.id)
-        await db.settings.insert_one(settings_obj.model_dump())
-        naeste_bilagnr = 1
-    else:
-        naeste_bilagnr = settings.get("naeste_bilagnr", 1)
-    
-    # Generate bilagnr
-    bilagnr = f"B{str(naeste_bilagnr).zfill(3)}"
-    
-    # Update next bilagnr in settings
-    await db.settings.update_one(
-        {"afdeling_id": current_user.id},
-        {"$set": {"naeste_bilagnr": naeste_bilagnr + 1}},
-        upsert=True
+    # Reserve the next bilagnr; also creates default settings on first use
+    settings, (bilagnr,) = await reserve_bilagnr(
+        db, current_user.id, SettingsModel(afdeling_id=current_user.id).model_dump()
     )
     
     trans_dict = transaction.model_dump()
     trans_dict["bilagnr"] = bilagnr
     
     # Automatically assign regnskabsaar from settings
-    if settings:
-        trans_dict["regnskabsaar"] = settings.get("regnskabsaar", "2024-2025")
-    else:
-        trans_dict["regnskabsaar"] = "2024-2025"
+    trans_dict["regnskabsaar"] = settings.get("regnskabsaar", "2024-2025")
     
     trans_obj = Transaction(afdeling_id=current_user.id, **trans_dict)
     await db.transactions.insert_one(trans_obj.model_dump())
+    await balance_ledger.record_created(db, trans_obj.model_dump())
+    await export_cache.bump_version(db, current_user.id)
     return trans_obj
 
+IMPORT_BATCH_SIZE = 500
+IMPORT_PREVIEW_ROWS = 50
+
+def parse_bank_statement(file: UploadFile, default_formal: str):
+    """Stream the uploaded CSV and yield (row number, TransactionCreate or error)"""
+    file.file.seek(0)
+    try:
+        for entry in iter_bank_rows(file.file, default_formal):
+            if "error" in entry:
+                yield entry["row"], entry["error"]
+                continue
+            try:
+                yield entry["row"], TransactionCreate(**entry["transaction"])
+            except ValidationError as e:
+                yield entry["row"], "; ".join(err["msg"] for err in e.errors())
+    except BankImportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.post("/transactions/import")
+async def import_transactions(
+    file: UploadFile = File(...),
+    dry_run: bool = False,
+    formal: str = "Diverse",
+    current_user: User = Depends(get_current_user)
+):
+    """Import a bank CSV export as transactions.
+
+    Rows that can't be parsed are skipped and listed in the error report. With
+    dry_run the file is only validated and a preview of the parsed rows returned.
+    """
+    if current_user.role != "afdeling":
+        raise HTTPException(status_code=403, detail="Kun afdelinger kan importere posteringer")
+    
+    # First pass validates and counts without holding the rows in memory
+    errors = []
+    preview = []
+    valid_count = 0
+    for row, parsed in parse_bank_statement(file, formal):
+        if isinstance(parsed, str):
+            errors.append({"row": row, "error": parsed})
+            continue
+        valid_count += 1
+        if len(preview) < IMPORT_PREVIEW_ROWS:
+            preview.append({"row": row, **parsed.model_dump()})
+    
+    if dry_run or valid_count == 0:
+        return {"dry_run": dry_run, "imported": 0, "valid": valid_count, "errors": errors, "preview": preview}
+    
+    # Reserve one contiguous block of bilagnr for the whole statement
+    settings, bilagnumre = await reserve_bilagnr(
+        db, current_user.id, SettingsModel(afdeling_id=current_user.id).model_dump(), count=valid_count
+    )
+    regnskabsaar = settings.get("regnskabsaar", "2024-2025")
+    
+    # Second pass writes in batches
+    imported = 0
+    batch = []
+    for row, parsed in parse_bank_statement(file, formal):
+        if isinstance(parsed, str):
+            continue
+        batch.append(Transaction(
+            afdeling_id=current_user.id,
+            bilagnr=bilagnumre[imported + len(batch)],
+            regnskabsaar=regnskabsaar,
+            **parsed.model_dump()
+        ).model_dump())
+        if len(batch) == IMPORT_BATCH_SIZE:
+            await db.transactions.insert_many(batch)
+            await balance_ledger.record_created_many(db, batch)
+            imported += len(batch)
+            batch = []
+    if batch:
+        await db.transactions.insert_many(batch)
+        await balance_ledger.record_created_many(db, batch)
+        imported += len(batch)
+    await export_cache.bump_version(db, current_user.id)
+    
+    return {
+        "dry_run": False,
+        "imported": imported,
+        "valid": valid_count,
+        "errors": errors,
+        "bilagnr_fra": bilagnumre[0],
+        "bilagnr_til": bilagnumre[-1]
+    }
+
+# Sort parameter -> stored field it sorts on
+TRANSACTION_SORT_FIELDS = {
+    "bilagnr": "bilagnr_nr",
+    "bank_dato": "bank_dato",
+    "tekst": "tekst",
+    "formal": "formal",
+    "belob": "belob",
+    "type": "type"
+}
+# Free text sorts alphabetically with Danish rules, ignoring case first. Only
+# used for these fields so the other sorts can use the (simple collation) indexes.
+TEXT_SORT_COLLATION = {"locale": "da"}
+TEXT_SORT_FIELDS = {"tekst", "formal"}
+TRANSACTION_PAGE_SIZE = 200
+TRANSACTION_PAGE_MAX = 1000
+
+def encode_cursor(sort_value, transaction_id: str) -> str:
+    """Encode the keyset position of the last returned row as an opaque cursor"""
+    raw = json.dumps([sort_value, transaction_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Ugyldig cursor")
+    # Only plain values may reach the query; a dict here would be read as operators
+    if (
+        not isinstance(decoded, list) or len(decoded) != 2
+        or not isinstance(decoded[0], (str, int, float, type(None)))
+        or isinstance(decoded[0], bool)
+        or not isinstance(decoded[1], str)
+    ):
+        raise HTTPException(status_code=400, detail="Ugyldig cursor")
+    return decoded[0], decoded[1]
+
+def keyset_after(sort_field: str, direction: int, last_value, last_id: str) -> dict:
+    """Filter for the rows after (last_value, last_id) in (sort_field, id) order.
+
+    Mongo sorts missing and null values before everything else, but $gt/$lt
+    never match null (nor null anything else), so nulls need their own
+    clauses: ascending they come first, descending they come last.
+    """
+    op = "$lt" if direction == -1 else "$gt"
+    same_value = {sort_field: last_value, "id": {op: last_id}}
+    if last_value is None:
+        # Ascending, every non-null row follows the nulls; descending, nothing does
+        return {"$or": [same_value, {sort_field: {"$ne": None}}]} if direction == 1 else same_value
+    clauses = [{sort_field: {op: last_value}}, same_value]
+    if direction == -1:
+        clauses.append({sort_field: None})
+    return {"$or": clauses}
+
+SORT_KEYS_MIGRATION = "transaction_sort_keys"
+
+async def ensure_transaction_sort_keys(db):
+    """Backfill bilagnr_nr and rewrite DD-MM-YYYY bank dates as YYYY-MM-DD on
+    transactions stored before the sort keys existed. Runs once per database;
+    new transactions get both from the Transaction model."""
+    if await db.migrations.find_one({"name": SORT_KEYS_MIGRATION}):
+        return
+    query = {"$or": [
+        {"bilagnr_nr": {"$exists": False}},
+        {"bank_dato": {"$regex": r"^\d{2}[-./]\d{2}[-./]\d{4}$"}}
+    ]}
+    requests = []
+    afdelinger = set()
+    async for t in db.transactions.find(query, {"_id": 0, "id": 1, "afdeling_id": 1, "bilagnr": 1, "bank_dato": 1}):
+        requests.append(UpdateOne({"id": t["id"]}, {"$set": {
+            "bilagnr_nr": bilagnr_number(t.get("bilagnr")),
+            "bank_dato": normalize_date(t.get("bank_dato") or "")
+        }}))
+        afdelinger.add(t["afdeling_id"])
+        if len(requests) == IMPORT_BATCH_SIZE:
+            await db.transactions.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        await db.transactions.bulk_write(requests, ordered=False)
+    for afdeling_id in afdelinger:
+        await export_cache.bump_version(db, afdeling_id)
+    if afdelinger:
+        logger.info(f"Added sort keys to transactions of {len(afdelinger)} afdelinger")
+    await db.migrations.update_one(
+        {"name": SORT_KEYS_MIGRATION},
+        {"$setOnInsert": {"name": SORT_KEYS_MIGRATION, "done_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
 @api_router.get("/transactions", response_model=List[Transaction])
 async def list_transactions(
+    response: Response,
     afdeling_id: Optional[str] = None,
     regnskabsaar: Optional[str] = None,
+    search: Optional[str] = None,
+    type: Optional[Literal["indtaegt", "udgift"]] = None,
+    formal: Optional[str] = None,
+    missing_receipt: bool = False,
+    sort: str = "-bank_dato",
+    limit: int = Query(TRANSACTION_PAGE_SIZE, ge=1, le=TRANSACTION_PAGE_MAX),
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
+    """List transactions one page at a time.
+
+    Filtering and sorting happen in Mongo. The total number of matching rows is
+    returned in the X-Total-Count header and the cursor for the next page in
+    X-Next-Cursor (absent on the last page).
+    """
     query = {}
     if current_user.role == "afdeling":
         query["afdeling_id"] = current_user.id
@@ -484,13 +718,48 @@ async def list_transactions(
     if regnskabsaar:
         query["regnskabsaar"] = regnskabsaar
     
+    if search:
+        pattern = {"$regex": re.escape(search), "$options": "i"}
+        query["$or"] = [{"bilagnr": pattern}, {"tekst": pattern}]
+    if type:
+        query["type"] = type
+    if formal:
+        query["formal"] = formal
+    if missing_receipt:
+        query["kvittering_url"] = {"$in": [None, ""]}
+        query["kvittering_drive_link"] = {"$in": [None, ""]}
+    
+    # Sort on the requested field with id as tie-breaker so the keyset is unique
+    sort_param = sort.lstrip("-")
+    if sort_param not in TRANSACTION_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail="Ugyldig sortering")
+    sort_field = TRANSACTION_SORT_FIELDS[sort_param]
+    direction = -1 if sort.startswith("-") else 1
+    # The collation also applies to the keyset comparison below
+    collation = TEXT_SORT_COLLATION if sort_param in TEXT_SORT_FIELDS else None
+    
+    page_query = query
+    if cursor:
+        last_value, last_id = decode_cursor(cursor)
+        page_query = {"$and": [query, keyset_after(sort_field, direction, last_value, last_id)]}
+    
     projection = {
         "_id": 0, "id": 1, "afdeling_id": 1, "bilagnr": 1, 
         "bank_dato": 1, "tekst": 1, "formal": 1, "belob": 1, 
-        "type": 1, "regnskabsaar": 1, "kvittering_url": 1, "oprettet": 1,
-        "kvittering_drive_id": 1, "kvittering_drive_link": 1, "kvittering_filename": 1
+        "type": 1, "regnskabsaar": 1, "kvittering_url": 1, "kvittering_sha256": 1, "oprettet": 1,
+        "kvittering_drive_id": 1, "kvittering_drive_link": 1, "kvittering_filename": 1, "bilagnr_nr": 1
     }
-    transactions = await db.transactions.find(query, projection).sort("bank_dato", -1).to_list(1000)
+    # Fetch one extra row to know whether another page follows
+    find_page = db.transactions.find(page_query, projection, collation=collation).sort(
+        [(sort_field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    transactions, total = await asyncio.gather(find_page, db.transactions.count_documents(query))
+    
+    response.headers["X-Total-Count"] = str(total)
+    if len(transactions) > limit:
+        transactions = transactions[:limit]
+        last = transactions[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.get(sort_field), last["id"])
     return [Transaction(**t) for t in transactions]
 
 @api_router.get("/transactions/{transaction_id}", response_model=Transaction)
@@ -521,6 +790,8 @@ async def update_transaction(
     update_data = transaction.model_dump()
     # Bilagnr is already set and should not change
     await db.transactions.update_one({"id": transaction_id}, {"$set": update_data})
+    await balance_ledger.record_updated(db, existing, {**existing, **update_data})
+    await export_cache.bump_version(db, existing["afdeling_id"])
     
     updated = await db.transactions.find_one({"id": transaction_id}, {"_id": 0})
     return Transaction(**updated)
@@ -535,6 +806,11 @@ async def delete_transaction(transaction_id: str, current_user: User = Depends(g
         raise HTTPException(status_code=403, detail="Ingen adgang")
     
     result = await db.transactions.delete_one({"id": transaction_id})
+    if result.deleted_count:
+        await balance_ledger.record_deleted(db, existing)
+        await release_blob(db, existing.get("kvittering_sha256"))
+        await forget_receipt(db, transaction_id)
+        await export_cache.bump_version(db, existing["afdeling_id"])
     return {"success": True}
 
 @api_router.post("/transactions/{transaction_id}/upload")
@@ -561,78 +837,113 @@ async def upload_receipt(
     # Get regnskabsaar from transaction
     regnskabsaar = transaction.get("regnskabsaar", "2024-2025")
     
-    # Create folder structure: /app/uploads/kvitteringer/[Afdeling]/[År]/
-    base_dir = Path("/app/uploads/kvitteringer")
-    upload_dir = base_dir / afdeling_navn / regnskabsaar
-    upload_dir.mkdir(parents=True, exist_ok=True)
-    
     # Generate safe filename
     file_extension = Path(file.filename).suffix
     safe_filename = f"{transaction['bilagnr']}_{uuid.uuid4().hex[:8]}{file_extension}"
-    file_path = upload_dir / safe_filename
     
-    # Save file
-    with open(file_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+    # Save file in the blob store; identical files are only kept once
+    try:
+        saved = await store_blob(db, file)
+    except ReceiptTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     
-    # Store relative path
+    # The URL keeps the /uploads/kvitteringer/[Afdeling]/[År]/ layout for links and export names
     kvittering_url = f"/uploads/kvitteringer/{afdeling_navn}/{regnskabsaar}/{safe_filename}"
-    await db.transactions.update_one(
+    # Swap in one step and release the hash that was actually replaced, so
+    # concurrent uploads each release a different previous receipt
+    replaced = await db.transactions.find_one_and_update(
         {"id": transaction_id},
-        {"$set": {"kvittering_url": kvittering_url}}
+        {"$set": {"kvittering_url": kvittering_url, "kvittering_sha256": saved["sha256"]}},
+        projection={"_id": 0, "id": 1, "kvittering_sha256": 1},
+        return_document=ReturnDocument.BEFORE
     )
+    if replaced is None:
+        # Deleted while the file was uploading
+        await release_blob(db, saved["sha256"])
+        raise HTTPException(status_code=404, detail="Postering ikke fundet")
+    await release_blob(db, replaced.get("kvittering_sha256"))
+    await record_receipt(db, {**transaction, "kvittering_url": kvittering_url, "kvittering_sha256": saved["sha256"]})
+    await export_cache.bump_version(db, transaction["afdeling_id"])
+    receipt_previews.schedule(blob_key(saved["sha256"]), safe_filename)
     
-    return {"success": True, "url": kvittering_url, "filename": safe_filename}
+    return {"success": True, "url": kvittering_url, "filename": safe_filename, "size": saved["size"], "sha256": saved["sha256"]}
 
-@api_router.get("/kvittering/{regnskabsaar}/{afdeling}/{filename}")
-async def download_receipt_alt(
+@api_router.get("/uploads/kvitteringer/{afdeling_navn}/{regnskabsaar}/{filename}")
+@api_router.get("/kvittering/{regnskabsaar}/{afdeling_navn}/{filename}")
+async def download_receipt(
+    request: Request,
+    afdeling_navn: str,
     regnskabsaar: str,
-    afdeling: str,
     filename: str,
     current_user: User = Depends(get_current_user)
 ):
-    """Download a receipt file - alternative endpoint format"""
-    file_path = Path(f"/app/uploads/kvitteringer/{afdeling}/{regnskabsaar}/{filename}")
-    
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Fil ikke fundet")
-    
+    """Download a receipt file. Supports conditional requests and byte ranges."""
     # Check permissions
     if current_user.role == "afdeling":
-        if current_user.afdeling_navn != afdeling:
+        if current_user.afdeling_navn != afdeling_navn:
             raise HTTPException(status_code=403, detail="Ingen adgang")
     
-    from fastapi.responses import FileResponse
-    return FileResponse(
-        path=file_path,
-        filename=filename,
-        media_type="application/octet-stream"
-    )
+    receipt = await find_receipt(db, f"/uploads/kvitteringer/{afdeling_navn}/{regnskabsaar}/{filename}")
+    if not receipt:
+        raise HTTPException(status_code=404, detail="Fil ikke fundet")
+    
+    # Blobs never change, so their hash is a strong validator
+    etag = f'"{receipt["sha256"]}"' if receipt.get("sha256") else None
+    return await stored_file_response(request, receipt["key"], filename, etag=etag)
 
-@api_router.get("/uploads/kvitteringer/{afdeling_navn}/{regnskabsaar}/{filename}")
-async def download_receipt(
-    afdeling_navn: str,
-    regnskabsaar: str,
+async def stored_file_response(
+    request: Request,
+    key: str,
     filename: str,
+    etag: Optional[str] = None,
+    cache_control: str = "private, no-cache",
+    media_type: Optional[str] = None,
+    disposition: str = "inline"
+):
+    """Stream a file from receipt storage"""
+    storage = get_storage()
+    stored = await storage.stat(key)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Fil ikke fundet")
+    return serve_content(
+        request, stored.size, stored.mtime, partial(storage.iter_range, key), filename,
+        etag=etag, cache_control=cache_control, media_type=media_type, disposition=disposition
+    )
+
+RECEIPT_PREVIEW_IMMUTABLE = "private, max-age=31536000, immutable"
+
+@api_router.get("/kvittering/{transaction_id}/preview")
+async def get_receipt_preview(
+    request: Request,
+    transaction_id: str,
+    size: Literal["thumb", "preview"] = "preview",
+    v: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
-    """Download a receipt file"""
-    file_path = Path(f"/app/uploads/kvitteringer/{afdeling_navn}/{regnskabsaar}/{filename}")
-    
-    if not file_path.exists():
+    """JPEG thumbnail or first-page preview of a transaction's receipt.
+
+    Pass the receipt's kvittering_sha256 as `v` to get a response that may be
+    cached for good; a new receipt gets a new hash and so a new URL.
+    """
+    receipt = await db.receipts.find_one({"transaction_id": transaction_id}, {"_id": 0})
+    if not receipt:
         raise HTTPException(status_code=404, detail="Fil ikke fundet")
     
-    # Check permissions
-    if current_user.role == "afdeling":
-        if current_user.afdeling_navn != afdeling_navn:
-            raise HTTPException(status_code=403, detail="Ingen adgang")
+    if current_user.role == "afdeling" and receipt["afdeling_id"] != current_user.id:
+        raise HTTPException(status_code=403, detail="Ingen adgang")
     
-    from fastapi.responses import FileResponse
-    return FileResponse(
-        path=file_path,
-        filename=filename,
-        media_type="application/octet-stream"
+    filename = receipt["filename"]
+    preview = await receipt_previews.get_preview(receipt["key"], filename, size)
+    if not preview:
+        raise HTTPException(status_code=404, detail="Ingen forhåndsvisning for denne filtype")
+    
+    sha256 = receipt.get("sha256")
+    return await stored_file_response(
+        request,
+        preview,
+        f"{Path(filename).stem}_{size}.jpg",
+        etag=f'"{sha256}-{size}"' if sha256 else None,
+        cache_control=RECEIPT_PREVIEW_IMMUTABLE if sha256 and v == sha256 else "private, no-cache"
     )
 
 @api_router.get("/kvitteringer/folder")
@@ -644,19 +955,14 @@ async def get_kvitteringer_folder_info(
     """Get information about kvitteringer folder for Excel export"""
     folder_path = Path(f"/app/uploads/kvitteringer/{afdeling_navn}/{regnskabsaar}")
     
-    if not folder_path.exists():
-        folder_path.mkdir(parents=True, exist_ok=True)
-    
-    # List files in folder
-    files = []
-    if folder_path.exists():
-        for file_path in folder_path.iterdir():
-            if file_path.is_file():
-                files.append({
-                    "filename": file_path.name,
-                    "size": file_path.stat().st_size,
-                    "url": f"/api/uploads/kvitteringer/{afdeling_navn}/{regnskabsaar}/{file_path.name}"
-                })
+    files = [
+        {
+            "filename": receipt["filename"],
+            "size": receipt["size"],
+            "url": f"/api{receipt['kvittering_url'].removeprefix('/api')}"
+        }
+        for receipt in await list_receipts(db, afdeling_navn, regnskabsaar)
+    ]
     
     return {
         "folder_path": str(folder_path),
@@ -673,118 +979,73 @@ async def get_dashboard_stats(
 ):
     # Admin sees all afdelinger with their saldi
     if current_user.role in ["admin", "superbruger"] and not afdeling_id:
-        # Get all afdelinger from the afdelinger collection (not just users)
-        afdelinger = await db.afdelinger.find({}, {"_id": 0}).to_list(100)
-        
-        afdelinger_saldi = []
-        total_indtaegter_all = 0.0
-        total_udgifter_all = 0.0
-        total_startsaldo_all = 0.0
+        # One pipeline over afdelinger resolves the team user, reads its ledger
+        # balances and startsaldo and totals everything in a single round trip.
+        # The joins are plain equality lookups (a team has a handful of users and
+        # one ledger row per year), narrowed with $filter afterwards.
+        balances = "$balances"
+        if regnskabsaar:
+            balances = {"$filter": {
+                "input": "$balances", "as": "b", "cond": {"$eq": ["$$b.regnskabsaar", regnskabsaar]}
+            }}
         
-        for afdeling in afdelinger:
-            # Get transactions for this afdeling (match by navn)
-            # First, find any user with this afdeling_navn to get the afdeling_id used in transactions
-            user_with_afdeling = await db.users.find_one(
-                {"afdeling_navn": afdeling["navn"], "role": "afdeling"}, 
-                {"_id": 0, "id": 1}
-            )
-            
+        pipeline = [
+            # Find any user with this afdeling_navn to get the afdeling_id used in transactions
+            {"$lookup": {"from": "users", "localField": "navn", "foreignField": "afdeling_navn", "as": "users"}},
+            {"$addFields": {"user_id": {"$arrayElemAt": [{"$map": {
+                "input": {"$filter": {"input": "$users", "as": "u", "cond": {"$eq": ["$$u.role", "afdeling"]}}},
+                "as": "u",
+                "in": "$$u.id"
+            }}, 0]}}},
             # Use the afdeling_id from the user, or the afdeling id itself
-            afdeling_id_for_query = user_with_afdeling["id"] if user_with_afdeling else afdeling["id"]
-            
-            # Build match query with optional regnskabsaar filter
-            match_query = {"afdeling_id": afdeling_id_for_query}
-            if regnskabsaar:
-                match_query["regnskabsaar"] = regnskabsaar
-            
-            pipeline = [
-                {"$match": match_query},
-                {
-                    "$group": {
-                        "_id": "$type",
-                        "total": {"$sum": "$belob"}
-                    }
-                }
-            ]
-            
-            results = await db.transactions.aggregate(pipeline).to_list(None)
-            
-            indtaegter = 0.0
-            udgifter = 0.0
-            
-            for result in results:
-                if result["_id"] == "indtaegt":
-                    indtaegter = result["total"]
-                elif result["_id"] == "udgift":
-                    udgifter = result["total"]
-            
-            # Get startsaldo
-            settings = await db.settings.find_one({"afdeling_id": afdeling_id_for_query}, {"_id": 0})
-            startsaldo = settings.get("startsaldo", 0.0) if settings else 0.0
-            
-            aktuelt_saldo = startsaldo + indtaegter - udgifter
-            
-            afdelinger_saldi.append(AfdelingSaldo(
-                afdeling_id=afdeling["id"],
-                afdeling_navn=afdeling["navn"],
-                aktuelt_saldo=aktuelt_saldo,
-                user_id=afdeling_id_for_query if user_with_afdeling else None
-            ))
-            
-            total_indtaegter_all += indtaegter
-            total_udgifter_all += udgifter
-            total_startsaldo_all += startsaldo
+            {"$addFields": {"query_id": {"$ifNull": ["$user_id", "$id"]}}},
+            {"$lookup": {"from": "balances", "localField": "query_id", "foreignField": "afdeling_id", "as": "balances"}},
+            {"$lookup": {"from": "settings", "localField": "query_id", "foreignField": "afdeling_id", "as": "settings"}},
+            {"$addFields": {"balances": balances}},
+            {"$project": {
+                "_id": 0,
+                "afdeling_id": "$id",
+                "afdeling_navn": "$navn",
+                "user_id": 1,
+                "indtaegter": {"$sum": "$balances.indtaegter"},
+                "udgifter": {"$sum": "$balances.udgifter"},
+                "startsaldo": {"$ifNull": [{"$arrayElemAt": ["$settings.startsaldo", 0]}, 0.0]}
+            }},
+            {"$addFields": {
+                "aktuelt_saldo": {"$subtract": [{"$add": ["$startsaldo", "$indtaegter"]}, "$udgifter"]}
+            }},
+            {"$facet": {
+                "afdelinger": [{"$sort": {"afdeling_navn": 1}}],
+                "totals": [{"$group": {
+                    "_id": None,
+                    "indtaegter": {"$sum": "$indtaegter"},
+                    "udgifter": {"$sum": "$udgifter"},
+                    "aktuelt_saldo": {"$sum": "$aktuelt_saldo"}
+                }}]
+            }}
+        ]
+        
+        results = await db.afdelinger.aggregate(pipeline).to_list(1)
+        result = results[0] if results else {"afdelinger": [], "totals": []}
+        totals = result["totals"][0] if result["totals"] else {}
         
-        # Calculate total current balance
-        total_aktuelt_saldo = total_startsaldo_all + total_indtaegter_all - total_udgifter_all
+        afdelinger_saldi = [AfdelingSaldo(**a) for a in result["afdelinger"]]
         
         return DashboardStats(
-            aktuelt_saldo=total_aktuelt_saldo,
-            total_indtaegter=total_indtaegter_all,
-            total_udgifter=total_udgifter_all,
+            aktuelt_saldo=totals.get("aktuelt_saldo", 0.0),
+            total_indtaegter=totals.get("indtaegter", 0.0),
+            total_udgifter=totals.get("udgifter", 0.0),
             afdelinger_saldi=afdelinger_saldi
         )
     else:
         # Single afdeling view
-        query = {}
-        target_afdeling_id = None
-        
-        if current_user.role == "afdeling":
-            target_afdeling_id = current_user.id
-            query["afdeling_id"] = current_user.id
-        elif current_user.role in ["admin", "superbruger"] and afdeling_id:
-            target_afdeling_id = afdeling_id
-            query["afdeling_id"] = afdeling_id
-        
-        # Add regnskabsaar filter if provided
-        if regnskabsaar:
-            query["regnskabsaar"] = regnskabsaar
-        
-        # Use aggregation pipeline for efficient calculation
-        pipeline = [
-            {"$match": query},
-            {
-                "$group": {
-                    "_id": "$type",
-                    "total": {"$sum": "$belob"},
-                    "count": {"$sum": 1}
-                }
-            }
-        ]
-        
-        results = await db.transactions.aggregate(pipeline).to_list(None)
-        
-        total_indtaegter = 0.0
-        total_udgifter = 0.0
-        antal_posteringer = 0
+        target_afdeling_id = current_user.id if current_user.role == "afdeling" else afdeling_id
         
-        for result in results:
-            if result["_id"] == "indtaegt":
-                total_indtaegter = result["total"]
-                antal_posteringer += result["count"]
-            elif result["_id"] == "udgift":
-                total_udgifter = result["total"]
-                antal_posteringer += result["count"]
+        # Totals come from the balance ledger instead of re-summing transactions
+        balance = await balance_ledger.get_balance(db, target_afdeling_id, regnskabsaar)
+        total_indtaegter = balance["indtaegter"]
+        total_udgifter = balance["udgifter"]
+        antal_posteringer = balance["antal_posteringer"]
         
         # Get startsaldo
         startsaldo = 0.0
@@ -802,6 +1063,48 @@ async def get_dashboard_stats(
             antal_posteringer=antal_posteringer
         )
 
+# Diagnostics
+@api_router.get("/admin/diagnostics/indexes")
+async def get_index_diagnostics(current_user: User = Depends(get_current_user)):
+    """Report drift between the declared Mongo indexes and the live database"""
+    if current_user.role not in ["admin", "superbruger"]:
+        raise HTTPException(status_code=403, detail="Kun admins kan se diagnostik")
+    
+    return await verify_indexes(db)
+
+@api_router.get("/admin/diagnostics/cache")
+async def get_cache_diagnostics(current_user: User = Depends(get_current_user)):
+    """Hit/miss counters for the in-process caches"""
+    if current_user.role not in ["admin", "superbruger"]:
+        raise HTTPException(status_code=403, detail="Kun admins kan se diagnostik")
+    
+    return {
+        "users": user_cache.stats(),
+        "password_pool": password_hasher.get_stats(),
+        "drive_pool": drive_client.get_stats(),
+        "exports": export_cache.get_stats(),
+        "drive_services": drive_service_cache.stats()
+    }
+
+@api_router.get("/admin/receipts/storage")
+async def get_receipt_storage(current_user: User = Depends(get_current_user)):
+    """Receipt files and bytes per afdeling, from the receipts index"""
+    if current_user.role not in ["admin", "superbruger"]:
+        raise HTTPException(status_code=403, detail="Kun admins kan se lagerforbrug")
+    
+    return await storage_totals(db)
+
+@api_router.post("/admin/balances/reconcile")
+async def reconcile_balances(
+    dry_run: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """Rebuild the balance ledger from transactions and report any drift"""
+    if current_user.role != "superbruger":
+        raise HTTPException(status_code=403, detail="Kun superbruger kan genberegne saldi")
+    
+    return await balance_ledger.reconcile(db, apply=not dry_run)
+
 # ==================== GOOGLE DRIVE INTEGRATION ====================
 
 @api_router.get("/drive/connect")
@@ -876,23 +1179,23 @@ async def upload_to_drive(
     settings = await db.settings.find_one({"afdeling_id": current_user.id}, {"_id": 0})
     regnskabsaar = transaction.get("regnskabsaar") or (settings.get("regnskabsaar", "2024-2025") if settings else "2024-2025")
     
-    # Ensure folder structure exists
-    folder_id = await ensure_folder_structure(service, current_user.afdeling_navn, regnskabsaar)
-    
     # Generate filename with bilagnr
     file_extension = Path(file.filename).suffix
     safe_filename = f"{transaction['bilagnr']}_{file.filename}"
     
-    # Read file content
-    file_content = await file.read()
+    # Upload to Drive, into Tour de Taxa/Kvitteringer/[Afdeling]/[Regnskabsaar].
+    # Streamed from the upload's spool file, chunk by chunk
+    async def upload(folder_id: str):
+        return await upload_file_to_drive(
+            service,
+            file.file,
+            safe_filename,
+            folder_id,
+            file.content_type
+        )
     
-    # Upload to Drive
-    result = await upload_file_to_drive(
-        service,
-        file_content,
-        safe_filename,
-        folder_id,
-        file.content_type
+    result = await with_receipt_folder(
+        service, current_user.afdeling_navn, regnskabsaar, current_user.id, db, upload
     )
     
     # Update transaction with Drive file info
@@ -930,11 +1233,15 @@ async def list_drive_files(
         settings = await db.settings.find_one({"afdeling_id": current_user.id}, {"_id": 0})
         regnskabsaar = settings.get("regnskabsaar", "2024-2025") if settings else "2024-2025"
     
-    # Get folder ID
-    try:
-        folder_id = await ensure_folder_structure(service, current_user.afdeling_navn, regnskabsaar)
+    # List the receipt folder for the year
+    async def list_folder(folder_id: str):
         files = await list_files_in_folder(service, folder_id)
         return {"files": files, "folder_id": folder_id, "regnskabsaar": regnskabsaar}
+    
+    try:
+        return await with_receipt_folder(
+            service, current_user.afdeling_navn, regnskabsaar, current_user.id, db, list_folder
+        )
     except Exception as e:
         logger.error(f"Failed to list Drive files: {e}")
         return {"files": [], "error": str(e)}
@@ -942,10 +1249,12 @@ async def list_drive_files(
 
 @api_router.get("/drive/download/{file_id}")
 async def download_from_drive(
+    request: Request,
     file_id: str,
     current_user: User = Depends(get_current_user)
 ):
-    """Download a receipt file from Google Drive"""
+    """Download a receipt file from Google Drive. Streamed chunk by chunk;
+    supports conditional requests and byte ranges."""
     if current_user.role != "afdeling":
         raise HTTPException(status_code=403, detail="Kun afdelinger kan downloade kvitteringer")
     
@@ -953,18 +1262,23 @@ async def download_from_drive(
     service = await get_drive_service(current_user.id, db)
     
     try:
-        content, filename, mime_type = await download_file_from_drive(service, file_id)
-        
-        return Response(
-            content=content,
-            media_type=mime_type or "application/octet-stream",
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"'
-            }
-        )
+        info = await get_drive_file_info(service, file_id)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to download file {file_id}: {e}")
         raise HTTPException(status_code=404, detail="Fil ikke fundet eller ingen adgang")
+    
+    return serve_content(
+        request,
+        info["size"],
+        info["mtime"],
+        partial(iter_drive_file, service, file_id),
+        info["filename"],
+        etag=f'"{info["md5"]}"' if info["md5"] else None,
+        media_type=info["mime_type"],
+        disposition="attachment"
+    )
 
 
 @api_router.delete("/drive/file/{file_id}")
@@ -1018,10 +1332,10 @@ async def link_existing_file(
     service = await get_drive_service(current_user.id, db)
     
     try:
-        file_metadata = service.files().get(
+        file_metadata = await service.execute(service.files().get(
             fileId=file_id,
             fields='id, name, webViewLink'
-        ).execute()
+        ))
         
         # Update transaction
         await db.transactions.update_one(
@@ -1039,258 +1353,121 @@ async def link_existing_file(
             "filename": file_metadata.get('name'),
             "web_view_link": file_metadata.get('webViewLink')
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to link file {file_id}: {e}")
         raise HTTPException(status_code=404, detail="Fil ikke fundet eller ingen adgang")
 
 
 # Excel export
+# Larger exports go through /export/jobs; the direct download builds the whole workbook before sending a byte
+INLINE_EXPORT_MAX_TRANSACTIONS = int(os.environ.get('INLINE_EXPORT_MAX_TRANSACTIONS', 20000))
+
+EXPORT_MEDIA_TYPES = {
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".zip": "application/zip"
+}
+
+def export_file_response(entry: export_cache.CachedExport, filename: str) -> StreamingResponse:
+    suffix = entry.path.suffix
+    return StreamingResponse(
+        entry.iter_chunks(STREAM_CHUNK_SIZE),
+        media_type=EXPORT_MEDIA_TYPES[suffix],
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}{suffix}",
+            "Content-Length": str(entry.size)
+        },
+        # iter_chunks closes the entry, unless the client left before the first chunk
+        background=BackgroundTask(entry.close)
+    )
+
 @api_router.get("/export/excel")
 async def export_excel(
     afdeling_id: Optional[str] = None,
     regnskabsaar: Optional[str] = None,
     current_user: User = Depends(get_current_user)
 ):
-    wb = Workbook()
-    receipt_files = []  # Collect receipt files to include in ZIP
-    
-    # If admin and no specific afdeling_id, export all with separate sheets
-    if current_user.role == "admin" and not afdeling_id:
-        # Get all afdelinger
-        afdelinger = await db.users.find({"role": "afdeling"}, {"_id": 0}).to_list(100)
-        
-        # Remove default sheet
-        wb.remove(wb.active)
-        
-        # Create sheet for each afdeling
-        all_transactions = []
-        for afdeling in afdelinger:
-            sheet_receipts = await create_afdeling_sheet(wb, afdeling["id"], afdeling["afdeling_navn"], regnskabsaar)
-            receipt_files.extend(sheet_receipts)
-            
-            # Build query with optional regnskabsaar filter
-            query = {"afdeling_id": afdeling["id"]}
-            if regnskabsaar:
-                query["regnskabsaar"] = regnskabsaar
-            
-            # Collect for combined sheet
-            projection = {
-                "_id": 0, "bilagnr": 1, "bank_dato": 1, 
-                "tekst": 1, "formal": 1, "belob": 1, "type": 1, "afdeling_id": 1
-            }
-            trans = await db.transactions.find(query, projection).sort("bank_dato", 1).to_list(10000)
-            
-            for t in trans:
-                t["afdeling_navn"] = afdeling["afdeling_navn"]
-                all_transactions.append(t)
-        
-        # Create combined sheet
-        ws_combined = wb.create_sheet("Alle hold")
-        ws_combined.append(["Hold", "Bilagnr.", "Bank dato", "Tekst", "Formål", "Beløb", "Type"])
-        
-        # Style headers
-        header_fill = PatternFill(start_color="109848", end_color="109848", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF")
-        for cell in ws_combined[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal="center")
-        
-        # Sort all by date and add data
-        all_transactions.sort(key=lambda x: x["bank_dato"])
-        for t in all_transactions:
-            ws_combined.append([
-                t["afdeling_navn"],
-                t["bilagnr"],
-                t["bank_dato"],
-                t["tekst"],
-                t["formal"],
-                t["belob"],
-                t["type"]
-            ])
-        
-        auto_adjust_columns(ws_combined)
-    else:
-        # Single afdeling export
-        target_afdeling_id = current_user.id if current_user.role == "afdeling" else afdeling_id
-        
-        # Get afdeling name
-        afdeling_user = await db.users.find_one({"id": target_afdeling_id}, {"_id": 0})
-        afdeling_navn = afdeling_user.get("afdeling_navn", "Bogføring") if afdeling_user else "Bogføring"
-        
-        wb.remove(wb.active)
-        sheet_receipts = await create_afdeling_sheet(wb, target_afdeling_id, afdeling_navn, regnskabsaar)
-        receipt_files.extend(sheet_receipts)
+    """Build and download an export in the request.
+
+    An xlsx file is a ZIP whose directory comes last, so the workbook is
+    complete before the first byte goes out; only the receipts ZIP around it
+    streams. Exports above INLINE_EXPORT_MAX_TRANSACTIONS are refused here
+    and have to use the background jobs under /export/jobs.
+    """
+    # If admin and no specific afdeling_id, export all with separate sheets plus a combined one
+    scope = export_scope(current_user.role, current_user.id, afdeling_id, regnskabsaar)
+    
+    # Serve an unchanged export from the cache
+    cache_key = await export_cache.cache_key(db, scope)
+    cached = await export_cache.lookup(cache_key)
+    if cached:
+        return export_file_response(cached, scope["filename"])
+    
+    if await db.transactions.count_documents(export_query(scope)) > INLINE_EXPORT_MAX_TRANSACTIONS:
+        raise HTTPException(
+            status_code=413,
+            detail="Eksporten er for stor til direkte download, brug baggrundseksport (POST /api/export/jobs)"
+        )
     
-    # Save Excel to bytes
-    excel_output = io.BytesIO()
-    wb.save(excel_output)
-    excel_output.seek(0)
+    afdelinger = await load_afdelinger(db, scope)
+    excel_path, receipt_files = await build_workbook(db, afdelinger, regnskabsaar, combined=scope["combined"])
     
-    # If there are receipt files, create a ZIP
+    # If there are receipt files, stream a ZIP with the workbook and receipts
     if receipt_files:
-        zip_output = io.BytesIO()
-        year_suffix = f"_{regnskabsaar}" if regnskabsaar else ""
-        
-        with zipfile.ZipFile(zip_output, 'w', zipfile.ZIP_DEFLATED) as zf:
-            # Add Excel file with regnskabsår in name
-            excel_filename = f"tour_de_taxa_bogforing{year_suffix}.xlsx"
-            zf.writestr(excel_filename, excel_output.read())
-            
-            # Add receipt files in folder with regnskabsår
-            for receipt in receipt_files:
-                file_path = Path(receipt["path"])
-                if file_path.exists():
-                    # Organize in subfolders: kvitteringer_[regnskabsaar]/[afdeling]/[filename]
-                    folder_name = f"kvitteringer{year_suffix}"
-                    archive_path = f"{folder_name}/{receipt['afdeling']}/{file_path.name}"
-                    zf.write(file_path, archive_path)
-        
-        zip_output.seek(0)
-        
-        zip_filename = f"tour_de_taxa_bogforing{year_suffix}.zip"
+        entries = zip_entries(excel_path, receipt_files, scope)
         return StreamingResponse(
-            zip_output,
-            media_type="application/zip",
-            headers={"Content-Disposition": f"attachment; filename={zip_filename}"}
+            export_cache.tee(iter_zip(entries, cleanup=[excel_path]), cache_key, ".zip"),
+            media_type=EXPORT_MEDIA_TYPES[".zip"],
+            headers={"Content-Disposition": f"attachment; filename={scope['filename']}.zip"},
+            # iter_zip deletes the workbook when it ends, but never runs if the client leaves before the first chunk
+            background=BackgroundTask(Path(excel_path).unlink, missing_ok=True)
         )
-    else:
-        # No receipts, just return Excel
-        year_suffix = f"_{regnskabsaar}" if regnskabsaar else ""
-        excel_filename = f"tour_de_taxa_bogforing{year_suffix}.xlsx"
-        return StreamingResponse(
-            excel_output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename={excel_filename}"}
-        )
-
-async def create_afdeling_sheet(wb, afdeling_id, afdeling_navn, regnskabsaar=None):
-    """Create a sheet for a specific afdeling with startsaldo and aktuel saldo.
-    Returns list of receipt files for this afdeling."""
-    receipt_files = []
-    
-    # Clean sheet name - remove invalid characters and limit to 31 chars
-    clean_name = afdeling_navn.replace("/", "-").replace("\\", "-").replace("[", "").replace("]", "")
-    clean_name = clean_name.replace("*", "").replace("?", "").replace(":", "")[:31]
-    ws = wb.create_sheet(clean_name)
     
-    # Get settings for startsaldo
-    settings = await db.settings.find_one({"afdeling_id": afdeling_id}, {"_id": 0})
-    startsaldo = settings.get("startsaldo", 0.0) if settings else 0.0
-    
-    # Build query with optional regnskabsaar filter
-    query = {"afdeling_id": afdeling_id}
-    if regnskabsaar:
-        query["regnskabsaar"] = regnskabsaar
-    
-    # Get transactions with receipt info
-    projection = {
-        "_id": 0, "bilagnr": 1, "bank_dato": 1, 
-        "tekst": 1, "formal": 1, "belob": 1, "type": 1,
-        "kvittering_url": 1, "kvittering_filename": 1
-    }
-    transactions = await db.transactions.find(query, projection).sort("bank_dato", 1).to_list(10000)
-    
-    # Collect receipt files
-    kvit_regnskabsaar = regnskabsaar if regnskabsaar else (settings.get("regnskabsaar", "2024-2025") if settings else "2024-2025")
-    for t in transactions:
-        if t.get("kvittering_url"):
-            # Extract path from URL like /uploads/kvitteringer/Afdeling/2024-2025/filename.pdf
-            # or /api/uploads/kvitteringer/Afdeling/2024-2025/filename.pdf
-            try:
-                url = t["kvittering_url"]
-                # Remove /api prefix if present
-                if url.startswith("/api"):
-                    url = url[4:]
-                # Build full path
-                file_path = Path(f"/app{url}")
-                if file_path.exists():
-                    receipt_files.append({
-                        "path": str(file_path),
-                        "afdeling": afdeling_navn,
-                        "bilagnr": t.get("bilagnr", "unknown")
-                    })
-                else:
-                    logger.warning(f"Receipt file not found: {file_path}")
-            except Exception as e:
-                logger.warning(f"Could not process receipt file: {e}")
-    
-    # Calculate sums
-    total_indtaegter = sum(t["belob"] for t in transactions if t["type"] == "indtaegt")
-    total_udgifter = sum(t["belob"] for t in transactions if t["type"] == "udgift")
-    aktuel_saldo = startsaldo + total_indtaegter - total_udgifter
-    
-    # Add startsaldo row
-    ws.append(["Startsaldo", "", "", "", startsaldo, ""])
-    ws[1][0].font = Font(bold=True)
-    ws[1][4].font = Font(bold=True)
-    
-    # Add kvitteringer folder info
-    kvit_folder_path = f"kvitteringer/{afdeling_navn}/"
-    ws.append(["Kvitteringer mappe:", kvit_folder_path, "", "", "", ""])
-    ws[2][0].font = Font(bold=True, color="0066CC")
-    ws[2][1].font = Font(color="0066CC")
-    
-    # Add empty row
-    ws.append([])
-    
-    # Headers - added "Kvittering" column
-    headers = ["Bilagnr.", "Bank dato", "Tekst", "Formål", "Beløb", "Type", "Kvittering"]
-    ws.append(headers)
-    
-    # Style headers
-    header_fill = PatternFill(start_color="109848", end_color="109848", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF")
-    header_row = ws[4]  # Changed from 3 to 4 due to kvitteringer row
-    for cell in header_row:
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal="center")
-    
-    # Add data with receipt filename
-    for t in transactions:
-        receipt_name = ""
-        if t.get("kvittering_url"):
-            try:
-                receipt_name = t["kvittering_url"].split("/")[-1]
-            except:
-                pass
-        ws.append([
-            t["bilagnr"],
-            t["bank_dato"],
-            t["tekst"],
-            t["formal"],
-            t["belob"],
-            t["type"],
-            receipt_name
-        ])
-    
-    # Add empty row
-    ws.append([])
-    
-    # Add aktuel saldo row
-    last_row = ws.max_row + 1
-    ws.append(["Aktuel saldo", "", "", "", aktuel_saldo, "", ""])
-    ws[last_row][0].font = Font(bold=True, color="109848")
-    ws[last_row][4].font = Font(bold=True, color="109848")
-    
-    auto_adjust_columns(ws)
-    
-    return receipt_files
-
-def auto_adjust_columns(ws):
-    """Auto-adjust column widths"""
-    for column in ws.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(cell.value)
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        ws.column_dimensions[column_letter].width = adjusted_width
+    # No receipts, just return Excel
+    return export_file_response(await export_cache.store(excel_path, cache_key, ".xlsx"), scope["filename"])
+
+# Background export jobs
+async def get_export_job(job_id: str, current_user: User) -> dict:
+    job = await export_jobs.get_job(db, job_id)
+    if not job or (job["user_id"] != current_user.id and current_user.role not in ["admin", "superbruger"]):
+        raise HTTPException(status_code=404, detail="Eksportjob ikke fundet")
+    return job
+
+@api_router.post("/export/jobs", status_code=202)
+async def create_export_job(
+    afdeling_id: Optional[str] = None,
+    regnskabsaar: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    scope = export_scope(current_user.role, current_user.id, afdeling_id, regnskabsaar)
+    job = await export_jobs.enqueue(db, current_user.id, scope)
+    return export_jobs.job_status(job)
+
+@api_router.get("/export/jobs/{job_id}")
+async def get_export_job_status(job_id: str, current_user: User = Depends(get_current_user)):
+    return export_jobs.job_status(await get_export_job(job_id, current_user))
+
+@api_router.get("/export/jobs/{job_id}/download")
+async def download_export_job(request: Request, job_id: str, current_user: User = Depends(get_current_user)):
+    job = await get_export_job(job_id, current_user)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail="Eksporten er ikke færdig endnu")
+    expired = HTTPException(status_code=410, detail="Eksportfilen er udløbet, start en ny eksport")
+    key = export_jobs.artifact_key(job)
+    if key is None:
+        raise expired
+    # Any replica can serve it: the file lives in shared storage, not in this node's export cache
+    suffix = Path(key).suffix
+    try:
+        return await stored_file_response(
+            request, key, f"{job['scope']['filename']}{suffix}",
+            media_type=EXPORT_MEDIA_TYPES[suffix], disposition="attachment"
+        )
+    except HTTPException as e:
+        if e.status_code == 404:
+            raise expired
+        raise
 
 # Include router
 app.include_router(api_router)
@@ -1301,6 +1478,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count", "X-Next-Cursor", "ETag", "Content-Range", "Content-Disposition"],
 )
 
 logging.basicConfig(
@@ -1309,6 +1487,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def provision_indexes():
+    removed = await merge_duplicate_settings(db)
+    if removed:
+        logger.warning(f"Removed {removed} duplicate settings documents")
+    result = await ensure_indexes(db)
+    if result["failed"]:
+        logger.warning(f"Index provisioning incomplete: {result['failed']}")
+    await balance_ledger.ensure_ledger(db)
+    await ensure_receipts(db)
+    await ensure_transaction_sort_keys(db)
+
+@app.on_event("startup")
+async def start_export_workers():
+    export_jobs.start(db)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await export_jobs.stop()
+    client.close()
+    password_hasher.shutdown()
+    drive_client.shutdown()
+    receipt_previews.shutdown()
\ No newline at end of file
@@ -0,0 +1,247 @@
+"""
+Storage backends for Tour de Taxa
+Where receipt files live: a local directory or an S3-compatible bucket,
+chosen with RECEIPT_STORAGE. Files are addressed by relative keys such as
+blobs/ab/ab12... so the same keys work on both
+"""
+from abc import ABC, abstractmethod
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from functools import partial
+from pathlib import Path
+from typing import Optional, Iterator, BinaryIO, NamedTuple
+import asyncio
+import boto3
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Read size for streaming stored files and exports
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def move_file(source, dest: Path):
+    """Rename source to dest, atomically replacing it. Across filesystems the
+    file is copied next to dest and then renamed, so dest is never partial."""
+    try:
+        os.replace(source, dest)
+    except OSError:
+        fd, tmp_path = tempfile.mkstemp(dir=dest.parent, suffix=".part")
+        os.close(fd)
+        try:
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, dest)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        os.unlink(source)
+
+
+class StoredObject(NamedTuple):
+    size: int
+    mtime: float
+
+
+class StorageBackend(ABC):
+    """Receipt file storage.
+
+    The blocking methods (open, iter_range) are meant for threads, e.g. sync
+    generators handed to StreamingResponse. The async methods run their
+    blocking work in the default executor.
+    """
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+    @abstractmethod
+    async def put_file(self, key: str, source: Path):
+        """Store a finished local file under key. The source file is consumed."""
+
+    @abstractmethod
+    async def stat(self, key: str) -> Optional[StoredObject]:
+        """Size and mtime of a stored file, None if it doesn't exist"""
+
+    @abstractmethod
+    async def delete(self, key: str):
+        """Delete a stored file; a missing file is not an error"""
+
+    @abstractmethod
+    async def delete_prefix(self, prefix: str):
+        """Delete every stored file whose key starts with prefix"""
+
+    @abstractmethod
+    async def fetch(self, key: str, dest: Path):
+        """Copy a stored file to a local path"""
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        """Open a stored file for reading. Raises FileNotFoundError if missing."""
+
+    @abstractmethod
+    def iter_range(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        """Yield bytes start..end (inclusive) of a stored file in chunks"""
+
+    def local_path(self, key: str) -> Optional[Path]:
+        """Path of the file on this machine, for backends that have one"""
+        return None
+
+
+class LocalStorage(StorageBackend):
+    def __init__(self, root: Path):
+        self.root = root
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def _put(self, key: str, source: Path):
+        dest = self._path(key)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        move_file(source, dest)
+
+    async def put_file(self, key: str, source: Path):
+        await self._run(self._put, key, source)
+
+    def _stat(self, key: str) -> Optional[StoredObject]:
+        try:
+            stat = os.stat(self._path(key))
+        except FileNotFoundError:
+            return None
+        return StoredObject(stat.st_size, stat.st_mtime)
+
+    def _delete_prefix(self, prefix: str):
+        base = self._path(prefix)
+        for path in base.parent.glob(f"{base.name}*"):
+            path.unlink(missing_ok=True)
+
+    async def stat(self, key: str) -> Optional[StoredObject]:
+        return await self._run(self._stat, key)
+
+    async def delete(self, key: str):
+        await self._run(self._path(key).unlink, missing_ok=True)
+
+    async def delete_prefix(self, prefix: str):
+        await self._run(self._delete_prefix, prefix)
+
+    async def fetch(self, key: str, dest: Path):
+        await self._run(shutil.copyfile, self._path(key), dest)
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self._path(key), "rb")
+
+    def iter_range(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        remaining = end - start + 1
+        with self.open(key) as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def local_path(self, key: str) -> Optional[Path]:
+        return self._path(key)
+
+
+class S3Storage(StorageBackend):
+    """S3 or any S3-compatible service (MinIO, Ceph, ...) via S3_ENDPOINT_URL.
+
+    Credentials come from the usual boto3 sources (AWS_ACCESS_KEY_ID etc.).
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 part_size: int = 8 * 1024 * 1024):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        # boto3 clients are thread safe, one is shared by all executor threads
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        # Files above part_size go up as multipart uploads, part by part from disk
+        self.transfer_config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size)
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    @staticmethod
+    def _missing(error: ClientError) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def _put(self, key: str, source: Path):
+        self.client.upload_file(str(source), self.bucket, self._key(key), Config=self.transfer_config)
+        os.unlink(source)
+
+    async def put_file(self, key: str, source: Path):
+        await self._run(self._put, key, source)
+
+    async def stat(self, key: str) -> Optional[StoredObject]:
+        try:
+            head = await self._run(self.client.head_object, Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+        return StoredObject(head["ContentLength"], head["LastModified"].timestamp())
+
+    async def delete(self, key: str):
+        await self._run(self.client.delete_object, Bucket=self.bucket, Key=self._key(key))
+
+    def _delete_prefix(self, prefix: str):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            objects = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True})
+
+    async def delete_prefix(self, prefix: str):
+        await self._run(self._delete_prefix, prefix)
+
+    async def fetch(self, key: str, dest: Path):
+        await self._run(self.client.download_file, self.bucket, self._key(key), str(dest), Config=self.transfer_config)
+
+    def _get(self, key: str, **kwargs):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key), **kwargs)["Body"]
+        except ClientError as e:
+            if self._missing(e):
+                raise FileNotFoundError(key)
+            raise
+
+    def open(self, key: str) -> BinaryIO:
+        return self._get(key)
+
+    def iter_range(self, key: str, start: int, end: int) -> Iterator[bytes]:
+        if end < start:
+            return
+        body = self._get(key, Range=f"bytes={start}-{end}")
+        try:
+            yield from body.iter_chunks(STREAM_CHUNK_SIZE)
+        finally:
+            body.close()
+
+
+_storage: Optional[StorageBackend] = None
+
+
+def get_storage() -> StorageBackend:
+    """The configured backend: RECEIPT_STORAGE=local (default) or s3"""
+    global _storage
+    if _storage is None:
+        kind = os.environ.get('RECEIPT_STORAGE', 'local')
+        if kind == "s3":
+            _storage = S3Storage(
+                bucket=os.environ['S3_BUCKET'],
+                prefix=os.environ.get('S3_PREFIX', ''),
+                endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None,
+                part_size=int(os.environ.get('S3_PART_SIZE', 8 * 1024 * 1024))
+            )
+        elif kind == "local":
+            _storage = LocalStorage(Path(os.environ.get('RECEIPT_STORAGE_DIR', '/app/uploads')))
+        else:
+            raise ValueError(f"Unknown RECEIPT_STORAGE: {kind}")
+        logger.info(f"Receipt storage: {type(_storage).__name__}")
+    return _storage
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Login storm benchmark: measures latency of GET /api/auth/me while many
+concurrent logins run bcrypt on the server.
+
+Usage: python backend_bench.py [base_url] [username] [password]
+"""
+
+import requests
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+LOGIN_WORKERS = 32
+PROBE_INTERVAL = 0.05
+DURATION = 20
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8001"
+    username = sys.argv[2] if len(sys.argv) > 2 else "admin"
+    password = sys.argv[3] if len(sys.argv) > 3 else "admin123"
+    api_url = f"{base_url}/api"
+
+    response = requests.post(f"{api_url}/auth/login", json={"username": username, "password": password})
+    response.raise_for_status()
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    stop = threading.Event()
+    login_count = [0]
+
+    def storm():
+        session = requests.Session()
+        while not stop.is_set():
+            session.post(f"{api_url}/auth/login", json={"username": username, "password": password})
+            login_count[0] += 1
+
+    def probe(samples):
+        session = requests.Session()
+        while not stop.is_set():
+            started = time.perf_counter()
+            session.get(f"{api_url}/auth/me", headers=headers)
+            samples.append((time.perf_counter() - started) * 1000)
+            time.sleep(PROBE_INTERVAL)
+
+    # Baseline without load
+    baseline = []
+    stop.clear()
+    probe_thread = threading.Thread(target=probe, args=(baseline,))
+    probe_thread.start()
+    time.sleep(DURATION / 4)
+    stop.set()
+    probe_thread.join()
+
+    # Same probe during the login storm
+    under_load = []
+    stop.clear()
+    with ThreadPoolExecutor(max_workers=LOGIN_WORKERS + 1) as pool:
+        for _ in range(LOGIN_WORKERS):
+            pool.submit(storm)
+        pool.submit(probe, under_load)
+        time.sleep(DURATION)
+        stop.set()
+
+    print(f"🔐 {login_count[0]} logins in {DURATION}s with {LOGIN_WORKERS} concurrent clients")
+    for label, samples in (("Baseline", baseline), ("Under login storm", under_load)):
+        print(f"   {label}: /auth/me p50={percentile(samples, 50):.1f}ms "
+              f"p99={percentile(samples, 99):.1f}ms (n={len(samples)})")
+
+    stats = requests.get(f"{api_url}/admin/diagnostics/cache", headers=headers)
+    if stats.ok:
+        print(f"   Password pool: {stats.json().get('password_pool')}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
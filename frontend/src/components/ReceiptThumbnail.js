@@ -0,0 +1,37 @@
+import { useEffect, useState } from 'react';
+import { FileImage } from 'lucide-react';
+import { api } from '@/App';
+
+// Small preview of a transaction's receipt. The hash in the URL makes the
+// response cacheable for good, so the browser only fetches it once.
+export default function ReceiptThumbnail({ transaction }) {
+  const [src, setSrc] = useState(null);
+
+  useEffect(() => {
+    if (!transaction.kvittering_sha256) return undefined;
+    let objectUrl = null;
+    let cancelled = false;
+
+    api
+      .get(`/kvittering/${transaction.id}/preview`, {
+        params: { size: 'thumb', v: transaction.kvittering_sha256 },
+        responseType: 'blob',
+      })
+      .then((res) => {
+        if (cancelled) return;
+        objectUrl = window.URL.createObjectURL(res.data);
+        setSrc(objectUrl);
+      })
+      .catch(() => {
+        // No preview for this file type; the icon is shown instead
+      });
+
+    return () => {
+      cancelled = true;
+      if (objectUrl) window.URL.revokeObjectURL(objectUrl);
+    };
+  }, [transaction.id, transaction.kvittering_sha256]);
+
+  if (!src) return <FileImage size={18} />;
+  return <img src={src} alt="Kvittering" className="h-8 w-8 object-cover rounded border border-slate-200" />;
+}
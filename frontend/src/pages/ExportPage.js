@@ -7,8 +7,11 @@ import { Label } from '@/components/ui/label';
 import { Download, Calendar } from 'lucide-react';
 import { toast } from 'sonner';
 
+const EXPORT_POLL_INTERVAL = 1500;
+
 export default function ExportPage({ user }) {
   const [loading, setLoading] = useState(false);
+  const [progress, setProgress] = useState(0);
   const [afdelinger, setAfdelinger] = useState([]);
   const [selectedAfdeling, setSelectedAfdeling] = useState('all');
   const [regnskabsaarList, setRegnskabsaarList] = useState([]);
@@ -47,10 +50,32 @@ export default function ExportPage({ user }) {
     }
   };
 
+  const downloadJob = async (job) => {
+    const token = localStorage.getItem('token');
+    const response = await fetch(`${api.defaults.baseURL}/export/jobs/${job.id}/download`, {
+      method: 'GET',
+      headers: {
+        'Authorization': `Bearer ${token}`,
+      },
+    });
+
+    if (!response.ok) throw new Error('Download fejlede');
+
+    const blob = await response.blob();
+    const url = window.URL.createObjectURL(blob);
+    const a = document.createElement('a');
+    a.href = url;
+    a.download = job.filename;
+    document.body.appendChild(a);
+    a.click();
+    window.URL.revokeObjectURL(url);
+    document.body.removeChild(a);
+  };
+
   const handleExport = async () => {
     setLoading(true);
+    setProgress(0);
     try {
-      const token = localStorage.getItem('token');
       const params = new URLSearchParams();
       
       if (isAdmin && selectedAfdeling !== 'all') {
@@ -62,38 +87,20 @@ export default function ExportPage({ user }) {
         params.append('regnskabsaar', selectedRegnskabsaar);
       }
       
-      const response = await fetch(`${api.defaults.baseURL}/export/excel?${params}`, {
-        method: 'GET',
-        headers: {
-          'Authorization': `Bearer ${token}`,
-        },
-      });
-
-      if (!response.ok) throw new Error('Export fejlede');
-
-      // Get filename from Content-Disposition header or use default
-      const contentDisposition = response.headers.get('Content-Disposition');
-      let filename = `tour_de_taxa_bogforing_${selectedRegnskabsaar || 'alle'}.xlsx`;
-      
-      if (contentDisposition) {
-        const filenameMatch = contentDisposition.match(/filename[^;=\n]*=((['"]).*?\2|[^;\n]*)/);
-        if (filenameMatch && filenameMatch[1]) {
-          filename = filenameMatch[1].replace(/['"]/g, '');
-        }
+      // The export is built in the background; poll until it is ready
+      let job = (await api.post(`/export/jobs?${params}`)).data;
+      while (job.status === 'queued' || job.status === 'running') {
+        await new Promise((resolve) => setTimeout(resolve, EXPORT_POLL_INTERVAL));
+        job = (await api.get(`/export/jobs/${job.id}`)).data;
+        setProgress(job.percent);
       }
 
-      const blob = await response.blob();
-      const url = window.URL.createObjectURL(blob);
-      const a = document.createElement('a');
-      a.href = url;
-      a.download = filename;
-      document.body.appendChild(a);
-      a.click();
-      window.URL.revokeObjectURL(url);
-      document.body.removeChild(a);
+      if (job.status !== 'done') throw new Error(job.error || 'Export fejlede');
+
+      await downloadJob(job);
 
       // Show appropriate message based on file type
-      if (filename.endsWith('.zip')) {
+      if (job.filename.endsWith('.zip')) {
         toast.success(`ZIP-fil for ${selectedRegnskabsaar} downloadet!`);
       } else {
         toast.success(`Excel-fil for ${selectedRegnskabsaar} downloadet!`);
@@ -183,7 +190,7 @@ export default function ExportPage({ user }) {
             disabled={loading}
             className="bg-[#109848] hover:bg-[#0d7a3a] text-white shadow-sm transition-all active:scale-95 w-full sm:w-auto"
           >
-            {loading ? 'Eksporterer...' : (
+            {loading ? `Eksporterer... ${progress}%` : (
               <>
                 <Download size={18} className="mr-2" />
                 Download Excel + Kvitteringer
@@ -8,9 +8,10 @@ import { Checkbox } from '@/components/ui/checkbox';
 import { Label } from '@/components/ui/label';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
 import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '@/components/ui/table';
-import { Plus, Edit, Trash2, Search, FileImage, Users, Calendar, ArrowUpDown, ArrowUp, ArrowDown, FileX } from 'lucide-react';
+import { Plus, Edit, Trash2, Search, Users, Calendar, ArrowUpDown, ArrowUp, ArrowDown, FileX } from 'lucide-react';
 import { toast } from 'sonner';
 import { formatCurrencyWithUnit } from '@/utils/formatNumber';
+import ReceiptThumbnail from '@/components/ReceiptThumbnail';
 
 const FORMAL_OPTIONS = [
   'Ryttermøder',
@@ -43,8 +44,11 @@ const formatDate = (dateStr) => {
 
 export default function TransactionsPage({ user }) {
   const [transactions, setTransactions] = useState([]);
-  const [filteredTransactions, setFilteredTransactions] = useState([]);
+  const [totalCount, setTotalCount] = useState(0);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [hasLoaded, setHasLoaded] = useState(false);
   const [searchTerm, setSearchTerm] = useState('');
   const [typeFilter, setTypeFilter] = useState('all');
   const [formalFilter, setFormalFilter] = useState('all');
@@ -73,14 +77,13 @@ export default function TransactionsPage({ user }) {
   }, [isAdmin]);
 
   useEffect(() => {
-    if (selectedRegnskabsaar) {
-      if (isAdmin && afdelinger.length > 0) {
-        fetchTransactions();
-      } else if (!isAdmin) {
-        fetchTransactions();
-      }
-    }
-  }, [afdelinger, urlAfdelingId, urlAfdelingNavn, selectedAfdelingFilter, selectedRegnskabsaar, isAdmin]);
+    if (!selectedRegnskabsaar) return;
+    if (isAdmin && afdelinger.length === 0) return;
+    // Debounce so typing in the search field doesn't fire a request per keystroke
+    const timer = setTimeout(() => fetchTransactions(), searchTerm ? 300 : 0);
+    return () => clearTimeout(timer);
+  }, [afdelinger, urlAfdelingId, urlAfdelingNavn, selectedAfdelingFilter, selectedRegnskabsaar, isAdmin,
+      searchTerm, typeFilter, formalFilter, sortColumn, sortDirection, showMissingReceipts]);
 
   const fetchRegnskabsaar = async () => {
     try {
@@ -97,10 +100,6 @@ export default function TransactionsPage({ user }) {
     }
   };
 
-  useEffect(() => {
-    applyFilters();
-  }, [transactions, searchTerm, typeFilter, formalFilter, sortColumn, sortDirection, showMissingReceipts]);
-
   const fetchAfdelinger = async () => {
     try {
       // Get afdelinger from dashboard stats (includes user_id)
@@ -134,8 +133,12 @@ export default function TransactionsPage({ user }) {
     }
   };
 
-  const fetchTransactions = async () => {
-    setLoading(true);
+  const fetchTransactions = async (cursor = null) => {
+    if (cursor) {
+      setLoadingMore(true);
+    } else {
+      setLoading(true);
+    }
     try {
       let url = '/transactions';
       const params = new URLSearchParams();
@@ -155,96 +158,41 @@ export default function TransactionsPage({ user }) {
         }
       }
       
+      // Filtering and sorting are done server-side
+      if (searchTerm) {
+        params.append('search', searchTerm);
+      }
+      if (typeFilter !== 'all') {
+        params.append('type', typeFilter);
+      }
+      if (formalFilter !== 'all') {
+        params.append('formal', formalFilter);
+      }
+      if (showMissingReceipts) {
+        params.append('missing_receipt', 'true');
+      }
+      params.append('sort', `${sortDirection === 'desc' ? '-' : ''}${sortColumn}`);
+      if (cursor) {
+        params.append('cursor', cursor);
+      }
+      
       if (params.toString()) {
         url += `?${params.toString()}`;
       }
       
       const res = await api.get(url);
-      setTransactions(res.data);
+      setTransactions(cursor ? (prev) => [...prev, ...res.data] : res.data);
+      setTotalCount(parseInt(res.headers['x-total-count'], 10) || res.data.length);
+      setNextCursor(res.headers['x-next-cursor'] || null);
     } catch (error) {
       toast.error('Kunne ikke hente posteringer');
     } finally {
       setLoading(false);
+      setLoadingMore(false);
+      setHasLoaded(true);
     }
   };
 
-  const applyFilters = () => {
-    let filtered = [...transactions];
-
-    if (searchTerm) {
-      filtered = filtered.filter(
-        (t) =>
-          t.bilagnr.toLowerCase().includes(searchTerm.toLowerCase()) ||
-          t.tekst.toLowerCase().includes(searchTerm.toLowerCase())
-      );
-    }
-
-    if (typeFilter !== 'all') {
-      filtered = filtered.filter((t) => t.type === typeFilter);
-    }
-
-    if (formalFilter !== 'all') {
-      filtered = filtered.filter((t) => t.formal === formalFilter);
-    }
-
-    // Filter for missing receipts
-    if (showMissingReceipts) {
-      filtered = filtered.filter((t) => !t.kvittering_url && !t.kvittering_drive_link);
-    }
-
-    // Apply sorting
-    filtered.sort((a, b) => {
-      let aVal = a[sortColumn];
-      let bVal = b[sortColumn];
-      
-      // Handle bilagnr sorting (extract number from B001, B002, etc.)
-      if (sortColumn === 'bilagnr') {
-        const aNum = parseInt(aVal.replace(/\D/g, '')) || 0;
-        const bNum = parseInt(bVal.replace(/\D/g, '')) || 0;
-        return sortDirection === 'asc' ? aNum - bNum : bNum - aNum;
-      }
-      
-      // Handle date sorting
-      if (sortColumn === 'bank_dato') {
-        // Convert DD-MM-YYYY or YYYY-MM-DD to sortable format
-        const parseDate = (dateStr) => {
-          if (!dateStr) return 0;
-          if (dateStr.includes('-') && dateStr.length === 10) {
-            const parts = dateStr.split('-');
-            if (parts[0].length === 4) {
-              // YYYY-MM-DD format
-              return new Date(dateStr).getTime();
-            } else {
-              // DD-MM-YYYY format
-              return new Date(`${parts[2]}-${parts[1]}-${parts[0]}`).getTime();
-            }
-          }
-          return 0;
-        };
-        aVal = parseDate(aVal);
-        bVal = parseDate(bVal);
-      }
-      
-      // Handle number sorting (beløb)
-      if (sortColumn === 'belob') {
-        aVal = parseFloat(aVal) || 0;
-        bVal = parseFloat(bVal) || 0;
-      }
-      
-      // Default string comparison
-      if (typeof aVal === 'string') {
-        aVal = aVal.toLowerCase();
-        bVal = (bVal || '').toLowerCase();
-      }
-      
-      if (aVal < bVal) return sortDirection === 'asc' ? -1 : 1;
-      if (aVal > bVal) return sortDirection === 'asc' ? 1 : -1;
-      return 0;
-    });
-
-    setFilteredTransactions(filtered);
-  };
-
   const handleSort = (column) => {
     if (sortColumn === column) {
       setSortDirection(sortDirection === 'asc' ? 'desc' : 'asc');
@@ -283,7 +231,8 @@ export default function TransactionsPage({ user }) {
     return afdelingerMap[afdelingId] || 'Ukendt';
   };
 
-  if (loading && !isAdmin) {
+  // Only block the whole page on the first load; refetches keep the filters mounted
+  if (loading && !hasLoaded && !isAdmin) {
     return <div className="p-8">Indlæser...</div>;
   }
 
@@ -416,14 +365,14 @@ export default function TransactionsPage({ user }) {
           <CardTitle className="text-xl font-semibold">
             Posteringsoversigt
             <span className="ml-2 text-base font-normal text-slate-500">
-              ({filteredTransactions.length} {filteredTransactions.length === 1 ? 'postering' : 'posteringer'})
+              ({totalCount} {totalCount === 1 ? 'postering' : 'posteringer'})
             </span>
           </CardTitle>
         </CardHeader>
         <CardContent className="p-0">
           {loading ? (
             <div className="p-8 text-center text-slate-500">Indlæser posteringer...</div>
-          ) : filteredTransactions.length === 0 ? (
+          ) : transactions.length === 0 ? (
             <div className="p-8 text-center text-slate-500">
               {isAdmin && selectedAfdelingFilter === 'all' 
                 ? 'Vælg et hold for at se posteringer, eller skift til "Alle hold" for at se alle'
@@ -511,7 +460,7 @@ export default function TransactionsPage({ user }) {
                   </TableRow>
                 </TableHeader>
                 <TableBody>
-                  {filteredTransactions.map((transaction) => (
+                  {transactions.map((transaction) => (
                     <TableRow
                       key={transaction.id}
                       className="hover:bg-slate-50/50 transition-colors border-b border-slate-100 last:border-0"
@@ -555,7 +504,7 @@ export default function TransactionsPage({ user }) {
                             className="inline-flex items-center justify-center p-1 rounded hover:bg-blue-50 text-blue-600"
                             title="Download kvittering"
                           >
-                            <FileImage size={18} />
+                            <ReceiptThumbnail transaction={transaction} />
                           </a>
                         ) : (
                           <span className="text-slate-300">-</span>
@@ -589,6 +538,18 @@ export default function TransactionsPage({ user }) {
                   ))}
                 </TableBody>
               </Table>
+              {nextCursor && (
+                <div className="p-4 text-center border-t border-slate-100">
+                  <Button
+                    variant="outline"
+                    onClick={() => fetchTransactions(nextCursor)}
+                    disabled={loadingMore}
+                    data-testid="load-more-button"
+                  >
+                    {loadingMore ? 'Indlæser...' : `Indlæs flere (${transactions.length} af ${totalCount})`}
+                  </Button>
+                </div>
+              )}
             </div>
           )}
         </CardContent>
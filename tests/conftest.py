@@ -0,0 +1,39 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# server.py reads these at import; the client connects lazily and tests swap in a mock db
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tour_de_taxa_test")
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()["tour_de_taxa_test"]
+
+
+@pytest.fixture
+def server_db(db, monkeypatch):
+    """The server module with its db swapped for the mock"""
+    import server
+    monkeypatch.setattr(server, "db", db)
+    return db
+
+
+@pytest.fixture
+def seed_transactions():
+    """Async helper that adds the afdeling user a1 (Hold 1) with `count` transactions"""
+    async def seed(db, count):
+        await db.users.insert_one({"id": "a1", "username": "a1", "role": "afdeling", "afdeling_navn": "Hold 1"})
+        await db.transactions.insert_many([
+            {"id": f"t{n}", "afdeling_id": "a1", "regnskabsaar": "2024-2025", "bilagnr": f"B{n:03d}",
+             "bank_dato": "2024-10-01", "tekst": "x", "formal": "y", "belob": 1.0, "type": "udgift"}
+            for n in range(count)
+        ])
+    return seed
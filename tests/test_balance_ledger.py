@@ -0,0 +1,92 @@
+import asyncio
+
+import balance_ledger
+
+
+def _transaction(afdeling_id, regnskabsaar, type_, belob):
+    return {"afdeling_id": afdeling_id, "regnskabsaar": regnskabsaar, "type": type_, "belob": belob}
+
+
+def test_reconcile_corrects_drifted_balances_and_drops_stale_ones(db):
+    async def scenario():
+        await db.transactions.insert_many([
+            _transaction("a1", "2024", "indtaegt", 100.0),
+            _transaction("a1", "2024", "udgift", 40.0),
+            _transaction("a2", "2024", "udgift", 10.0),
+        ])
+        await db.balances.insert_many([
+            {"afdeling_id": "a1", "regnskabsaar": "2024", "indtaegter": 90.0, "udgifter": 40.0, "antal_posteringer": 2},
+            {"afdeling_id": "a3", "regnskabsaar": "2023", "indtaegter": 5.0, "udgifter": 0.0, "antal_posteringer": 1},
+        ])
+        untouched_id = (await db.balances.find_one({"afdeling_id": "a1"}))["_id"]
+
+        result = await balance_ledger.reconcile(db)
+
+        assert result["checked"] == 2
+        assert {(d["afdeling_id"], d["regnskabsaar"]) for d in result["drift"]} == {
+            ("a1", "2024"), ("a2", "2024"), ("a3", "2023")
+        }
+        balances = {b["afdeling_id"]: b async for b in db.balances.find({})}
+        assert set(balances) == {"a1", "a2"}
+        # Corrected in place rather than deleted and reinserted
+        assert balances["a1"]["_id"] == untouched_id
+        assert balances["a1"]["indtaegter"] == 100.0
+        assert balances["a2"]["udgifter"] == 10.0
+
+    asyncio.run(scenario())
+
+
+def test_reconcile_dry_run_changes_nothing(db):
+    async def scenario():
+        await db.transactions.insert_one(_transaction("a1", "2024", "indtaegt", 100.0))
+        result = await balance_ledger.reconcile(db, apply=False)
+        assert len(result["drift"]) == 1
+        assert await db.balances.count_documents({}) == 0
+
+    asyncio.run(scenario())
+
+
+def test_ensure_ledger_survives_concurrent_build(db):
+    async def scenario():
+        await db.balances.create_index([("afdeling_id", 1), ("regnskabsaar", 1)], unique=True)
+        await db.transactions.insert_many([
+            _transaction("a1", "2024", "indtaegt", 100.0),
+            _transaction("a2", "2024", "udgift", 10.0),
+        ])
+        await asyncio.gather(balance_ledger.ensure_ledger(db), balance_ledger.ensure_ledger(db))
+        assert await db.balances.count_documents({}) == 2
+
+    asyncio.run(scenario())
+
+
+def test_corrections_keep_writes_made_while_reconciling(db):
+    async def scenario():
+        await db.transactions.insert_many([
+            _transaction("a1", "2024", "indtaegt", 100.0),
+            _transaction("a3", "2023", "udgift", 5.0),
+        ])
+        await db.balances.insert_many([
+            {"afdeling_id": "a1", "regnskabsaar": "2024", "indtaegter": 90.0, "udgifter": 0.0, "antal_posteringer": 1},
+            {"afdeling_id": "a2", "regnskabsaar": "2024", "indtaegter": 5.0, "udgifter": 0.0, "antal_posteringer": 1},
+        ])
+        report = await balance_ledger.reconcile(db, apply=False)
+        actual = {(b["afdeling_id"], b["regnskabsaar"]): b async for b in db.balances.find({}, {"_id": 0})}
+
+        # Transactions written after reconcile read the ledger, before it applies
+        for transaction in (_transaction("a1", "2024", "udgift", 20.0), _transaction("a2", "2024", "indtaegt", 1.0)):
+            await db.transactions.insert_one(transaction)
+            await balance_ledger.record_created(db, transaction)
+
+        await db.balances.bulk_write(balance_ledger._corrections(report["drift"], actual), ordered=False)
+
+        balances = {b["afdeling_id"]: b async for b in db.balances.find({}, {"_id": 0})}
+        assert balances["a1"] == {"afdeling_id": "a1", "regnskabsaar": "2024",
+                                  "indtaegter": 100.0, "udgifter": 20.0, "antal_posteringer": 2}
+        assert balances["a3"]["udgifter"] == 5.0
+        # No longer stale, so it is kept and left for the next run to correct
+        assert balances["a2"]["antal_posteringer"] == 2
+        remaining = (await balance_ledger.reconcile(db))["drift"]
+        assert [d["afdeling_id"] for d in remaining] == ["a2"]
+        assert await balance_ledger.get_balance(db, "a2") == {"indtaegter": 1.0, "udgifter": 0.0, "antal_posteringer": 1}
+
+    asyncio.run(scenario())
@@ -0,0 +1,70 @@
+import io
+
+import pytest
+
+from bank_import import iter_bank_rows, parse_amount, parse_date, BankImportError
+
+
+def _rows(text, encoding="utf-8"):
+    return list(iter_bank_rows(io.BytesIO(text.encode(encoding)), "Diverse"))
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("-1.234,56", -1234.56),
+    ("1234.56", 1234.56),
+    ("1,234.56", 1234.56),
+    ("250,00 kr.", 250.0),
+    ("1.000.000", 1000000.0),
+    ("1.234", 1234.0),
+    ("-12.500", -12500.0),
+    ("1.5", 1.5),
+    ("12,5", 12.5),
+    ("1,000,000", 1000000.0),
+    ("1\xa0234,50 kr", 1234.5),
+])
+def test_parse_amount(value, expected):
+    assert parse_amount(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "kr.", "abc", "1.2.3", "12.34.567"])
+def test_parse_amount_rejects(value):
+    with pytest.raises(ValueError):
+        parse_amount(value)
+
+
+@pytest.mark.parametrize("value", ["31-12-2024", "31.12.2024", "31/12/2024", "2024-12-31", "2024/12/31"])
+def test_parse_date_formats(value):
+    assert parse_date(value) == "2024-12-31"
+
+
+@pytest.mark.parametrize("delimiter", [";", ",", "\t"])
+def test_delimiter_detected_from_header(delimiter):
+    header = delimiter.join(["Dato", "Tekst", "Beløb"])
+    row = delimiter.join(["02-01-2025", "Kontingent", '"1.200,00"'])
+    rows = _rows(f"{header}\n{row}\n")
+    assert rows == [{"row": 2, "transaction": {
+        "bank_dato": "2025-01-02", "tekst": "Kontingent", "formal": "Diverse", "belob": 1200.0, "type": "indtaegt"
+    }}]
+
+
+def test_cp1252_file_is_decoded():
+    rows = _rows("Bogføringsdato;Posteringstekst;Beløb;Formål\n03-01-2025;Købmand Søndergård;-89,95;Fælles\n", "cp1252")
+    assert rows[0]["transaction"]["tekst"] == "Købmand Søndergård"
+    assert rows[0]["transaction"]["formal"] == "Fælles"
+    assert rows[0]["transaction"]["type"] == "udgift"
+    assert rows[0]["transaction"]["belob"] == 89.95
+
+
+def test_bad_rows_are_reported_and_blank_rows_skipped():
+    rows = _rows("Dato;Tekst;Beløb\n01-13-2025;Forkert dato;10\n\n02-01-2025;Mangler\n02-01-2025;OK;5\n")
+    assert [r["row"] for r in rows] == [2, 4, 5]
+    assert "datoformat" in rows[0]["error"]
+    assert rows[1]["error"] == "For få kolonner"
+    assert rows[2]["transaction"]["belob"] == 5.0
+
+
+def test_missing_columns_rejected():
+    with pytest.raises(BankImportError):
+        _rows("Dato;Beskrivelse\n01-01-2025;x\n")
+    with pytest.raises(BankImportError):
+        _rows("")
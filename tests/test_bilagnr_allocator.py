@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import bilagnr_allocator
+from bilagnr_allocator import reserve_bilagnr, bilagnr_number, format_bilagnr
+
+DEFAULTS = {"startsaldo": 0.0, "regnskabsaar": "2024-2025", "naeste_bilagnr": 1}
+
+
+def test_format_and_number_round_trip():
+    assert format_bilagnr(7) == "B007"
+    assert format_bilagnr(1204) == "B1204"
+    assert bilagnr_number("B1204") == 1204
+    assert bilagnr_number("B007") == 7
+    assert bilagnr_number("manuel") is None
+    assert bilagnr_number(None) is None
+
+
+def test_first_reservation_creates_settings_with_defaults(db):
+    async def scenario():
+        settings, numbers = await reserve_bilagnr(db, "a1", DEFAULTS)
+        assert numbers == ["B001"]
+        assert settings["naeste_bilagnr"] == 2
+        assert settings["regnskabsaar"] == "2024-2025"
+
+    asyncio.run(scenario())
+
+
+def test_batch_reservation_is_consecutive(db):
+    async def scenario():
+        await db.settings.insert_one({"afdeling_id": "a1", "regnskabsaar": "2023-2024", "naeste_bilagnr": 41})
+        settings, numbers = await reserve_bilagnr(db, "a1", DEFAULTS, count=3)
+        assert numbers == ["B041", "B042", "B043"]
+        # Existing settings are not overwritten by the defaults
+        assert settings["regnskabsaar"] == "2023-2024"
+        _, numbers = await reserve_bilagnr(db, "a1", DEFAULTS)
+        assert numbers == ["B044"]
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_reservations_never_repeat(db):
+    async def scenario():
+        results = await asyncio.gather(*[reserve_bilagnr(db, "a1", DEFAULTS, count=2) for _ in range(20)])
+        numbers = [n for _, reserved in results for n in reserved]
+        assert sorted(numbers, key=bilagnr_number) == [format_bilagnr(n) for n in range(1, 41)]
+
+    asyncio.run(scenario())
+
+
+def test_count_must_be_positive(db):
+    with pytest.raises(ValueError):
+        asyncio.run(reserve_bilagnr(db, "a1", DEFAULTS, count=0))
+
+
+def test_merge_duplicate_settings_keeps_highest_counter(db):
+    async def scenario():
+        await db.settings.insert_many([
+            {"afdeling_id": "a1", "naeste_bilagnr": 5},
+            {"afdeling_id": "a1", "naeste_bilagnr": 12},
+            {"afdeling_id": "a2", "naeste_bilagnr": 3},
+        ])
+        assert await bilagnr_allocator.merge_duplicate_settings(db) == 1
+        remaining = {s["afdeling_id"]: s["naeste_bilagnr"] async for s in db.settings.find({})}
+        assert remaining == {"a1": 12, "a2": 3}
+
+    asyncio.run(scenario())
+
+
+def test_settings_update_does_not_rewind_counter(server_db):
+    import server
+
+    async def scenario():
+        user = server.User(id="a1", username="a1", afdeling_navn="A1", role="afdeling")
+        await server_db.settings.insert_one(server.SettingsModel(afdeling_id="a1").model_dump())
+        # Reservations that land between the endpoint's read and its write
+        await reserve_bilagnr(server_db, "a1", DEFAULTS, count=5)
+        await server.update_settings(server.SettingsUpdate(startsaldo=250.0), current_user=user)
+        settings = await server_db.settings.find_one({"afdeling_id": "a1"})
+        assert settings["startsaldo"] == 250.0
+        assert settings["naeste_bilagnr"] == 6
+
+    asyncio.run(scenario())
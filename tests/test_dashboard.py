@@ -0,0 +1,60 @@
+import asyncio
+
+import server
+
+ADMIN = server.User(id="admin1", username="admin", role="admin")
+
+
+def seed(db):
+    async def scenario():
+        await db.afdelinger.insert_many([
+            {"id": "af1", "navn": "Hold A"},
+            {"id": "af2", "navn": "Hold B"},
+            {"id": "af3", "navn": "Hold C"},
+        ])
+        await db.users.insert_many([
+            # An admin sharing the team name must not be taken for the team user
+            {"id": "admin2", "username": "leder", "afdeling_navn": "Hold A", "role": "admin"},
+            {"id": "u1", "username": "hold_a", "afdeling_navn": "Hold A", "role": "afdeling"},
+        ])
+        await db.balances.insert_many([
+            {"afdeling_id": "u1", "regnskabsaar": "2024-2025", "indtaegter": 100.0, "udgifter": 30.0, "antal_posteringer": 2},
+            {"afdeling_id": "u1", "regnskabsaar": "2023-2024", "indtaegter": 10.0, "udgifter": 0.0, "antal_posteringer": 1},
+            # Hold B has no team user, so its transactions are filed under the afdeling id
+            {"afdeling_id": "af2", "regnskabsaar": "2024-2025", "indtaegter": 0.0, "udgifter": 25.0, "antal_posteringer": 1},
+        ])
+        await db.settings.insert_one({"afdeling_id": "u1", "startsaldo": 50.0})
+
+    asyncio.run(scenario())
+
+
+def test_admin_dashboard_totals_every_afdeling(server_db):
+    seed(server_db)
+    stats = asyncio.run(server.get_dashboard_stats(current_user=ADMIN))
+
+    saldi = {a.afdeling_navn: a for a in stats.afdelinger_saldi}
+    assert list(saldi) == ["Hold A", "Hold B", "Hold C"]
+    assert saldi["Hold A"].user_id == "u1"
+    assert saldi["Hold A"].aktuelt_saldo == 130.0
+    assert saldi["Hold B"].user_id is None
+    assert saldi["Hold B"].aktuelt_saldo == -25.0
+    assert saldi["Hold C"].aktuelt_saldo == 0.0
+    assert stats.total_indtaegter == 110.0
+    assert stats.total_udgifter == 55.0
+    assert stats.aktuelt_saldo == 105.0
+
+
+def test_admin_dashboard_filters_regnskabsaar(server_db):
+    seed(server_db)
+    stats = asyncio.run(server.get_dashboard_stats(regnskabsaar="2024-2025", current_user=ADMIN))
+
+    saldi = {a.afdeling_navn: a.aktuelt_saldo for a in stats.afdelinger_saldi}
+    assert saldi == {"Hold A": 120.0, "Hold B": -25.0, "Hold C": 0.0}
+    assert stats.total_indtaegter == 100.0
+    assert stats.total_udgifter == 55.0
+
+
+def test_admin_dashboard_without_afdelinger(server_db):
+    stats = asyncio.run(server.get_dashboard_stats(current_user=ADMIN))
+    assert stats.afdelinger_saldi == []
+    assert stats.aktuelt_saldo == stats.total_indtaegter == stats.total_udgifter == 0.0
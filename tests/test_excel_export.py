@@ -0,0 +1,76 @@
+import asyncio
+import os
+
+from openpyxl import Workbook, load_workbook
+
+import excel_export
+from excel_export import SheetWriter, Styled, build_workbook
+
+
+def _transaction(n, afdeling_id, bank_dato, tekst="Kontingent"):
+    return {
+        "id": f"{afdeling_id}-{n}", "afdeling_id": afdeling_id, "regnskabsaar": "2024-2025",
+        "bilagnr": f"B{n:03d}", "bank_dato": bank_dato, "tekst": tekst, "formal": "Diverse",
+        "belob": 10.0, "type": "indtaegt"
+    }
+
+
+def test_sheet_writer_sizes_columns_from_sample(tmp_path, monkeypatch):
+    monkeypatch.setattr(excel_export, "WIDTH_SAMPLE_ROWS", 3)
+    wb = Workbook(write_only=True)
+    writer = SheetWriter(wb.create_sheet("Test"))
+    writer.append([Styled("Bilagnr.", "header"), "x"])
+    writer.append(["B001", 12345.5])
+    # Past the sample, written straight through
+    writer.append(["B002", "a" * 200])
+    writer.append(["B003", "b" * 200])
+    writer.close()
+    path = tmp_path / "test.xlsx"
+    wb.save(path)
+
+    ws = load_workbook(path)["Test"]
+    assert [row[0] for row in ws.iter_rows(values_only=True)] == ["Bilagnr.", "B001", "B002", "B003"]
+    assert ws.column_dimensions["A"].width == len("Bilagnr.") + excel_export.COLUMN_PADDING
+    assert ws.column_dimensions["B"].width == excel_export.MAX_COLUMN_WIDTH
+    assert ws["A1"].font.bold
+
+
+def test_sheet_writer_short_sheet_flushed_on_close(tmp_path):
+    wb = Workbook(write_only=True)
+    writer = SheetWriter(wb.create_sheet("Test"))
+    writer.append(["kort", 1])
+    writer.close()
+    path = tmp_path / "test.xlsx"
+    wb.save(path)
+    ws = load_workbook(path)["Test"]
+    assert list(ws.iter_rows(values_only=True)) == [("kort", 1)]
+    assert ws.column_dimensions["A"].width == len("kort") + excel_export.COLUMN_PADDING
+
+
+def test_build_workbook_combined(db):
+    async def scenario():
+        await db.settings.insert_one({"afdeling_id": "a1", "startsaldo": 100.0})
+        await db.transactions.insert_many([
+            _transaction(1, "a1", "2024-10-05"),
+            _transaction(2, "a1", "2024-11-01"),
+            _transaction(1, "a2", "2024-10-20"),
+        ])
+        afdelinger = [{"id": "a1", "afdeling_navn": "Hold 1"}, {"id": "a2", "afdeling_navn": "Hold 2"}]
+        path, receipts = await build_workbook(db, afdelinger, "2024-2025", combined=True)
+        try:
+            wb = load_workbook(path)
+        finally:
+            os.unlink(path)
+        assert receipts == []
+        assert wb.sheetnames == ["Hold 1", "Hold 2", "Alle hold"]
+        hold1 = list(wb["Hold 1"].iter_rows(values_only=True))
+        assert hold1[0][4] == 100.0
+        assert hold1[-1][:5] == ("Aktuel saldo", None, None, None, 120.0)
+        combined = [row[:3] for row in wb["Alle hold"].iter_rows(min_row=2, values_only=True)]
+        assert combined == [
+            ("Hold 1", "B001", "2024-10-05"),
+            ("Hold 2", "B001", "2024-10-20"),
+            ("Hold 1", "B002", "2024-11-01"),
+        ]
+
+    asyncio.run(scenario())
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import export_cache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(export_cache, "CACHE_DIR", tmp_path / "exports")
+    monkeypatch.setattr(export_cache, "MAX_BYTES", 100)
+    return tmp_path
+
+
+def _source(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b"x" * size)
+    return str(path)
+
+
+def store(source, key, suffix):
+    return asyncio.run(export_cache.store(source, key, suffix))
+
+
+def lookup(key):
+    return asyncio.run(export_cache.lookup(key))
+
+
+def test_newest_entry_survives_even_when_over_limit(cache_dir):
+    entry = store(_source(cache_dir, "big", 150), ("afdeling", "a1", None, 1), ".xlsx")
+    entry.close()
+    assert entry.path.exists()
+    cached = lookup(("afdeling", "a1", None, 1))
+    assert cached is not None and cached.size == 150
+    cached.close()
+
+
+def test_entry_being_served_is_not_evicted(cache_dir):
+    old_key, new_key = ("afdeling", "a1", None, 1), ("afdeling", "a2", None, 1)
+    store(_source(cache_dir, "old", 80), old_key, ".xlsx").close()
+    served = lookup(old_key)
+    # An older file's mtime, so the served entry would be first in line for eviction
+    os.utime(served.path, (0, 0))
+
+    store(_source(cache_dir, "new", 80), new_key, ".xlsx").close()
+    assert served.path.exists()
+    assert b"".join(served.iter_chunks(16)) == b"x" * 80
+
+    # No longer in use, so the next store evicts it
+    store(_source(cache_dir, "newer", 10), ("afdeling", "a3", None, 1), ".xlsx").close()
+    assert not served.path.exists()
+    assert export_cache.get_stats()["serving"] == 0
+
+
+def test_missing_file_is_a_miss(cache_dir):
+    key = ("afdeling", "a1", None, 1)
+    entry = store(_source(cache_dir, "f", 10), key, ".zip")
+    entry.close()
+    entry.path.unlink()
+    assert lookup(key) is None
+    assert export_cache.open_entry(entry.path) is None
+
+
+def test_tee_only_caches_complete_streams(cache_dir):
+    key = ("alle", None, None, 1)
+    assert b"".join(export_cache.tee(iter([b"ab", b"cd"]), key, ".zip")) == b"abcd"
+    cached = lookup(key)
+    assert b"".join(cached.iter_chunks(1)) == b"abcd"
+
+    aborted = export_cache.tee(iter([b"ab", b"cd"]), ("alle", None, None, 2), ".zip")
+    next(aborted)
+    aborted.close()
+    assert lookup(("alle", None, None, 2)) is None
+    assert not list((cache_dir / "exports").glob("*.part"))
+
+
+def test_cancelled_lookup_releases_its_entry(cache_dir, monkeypatch):
+    key = ("afdeling", "a1", None, 1)
+    store(_source(cache_dir, "f", 10), key, ".xlsx").close()
+    opened = []
+    real_lookup = export_cache._lookup
+
+    def slow_lookup(key):
+        time.sleep(0.05)
+        opened.append(real_lookup(key))
+        return opened[-1]
+
+    monkeypatch.setattr(export_cache, "_lookup", slow_lookup)
+
+    async def scenario():
+        task = asyncio.ensure_future(export_cache.lookup(key))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert opened[0].file.closed
+    assert export_cache.get_stats()["serving"] == 0
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import export_cache
+
+ADMIN = {"id": "admin", "username": "admin", "role": "admin"}
+
+
+@pytest.fixture
+def server(server_db, tmp_path, monkeypatch):
+    import server
+    monkeypatch.setattr(export_cache, "CACHE_DIR", tmp_path / "exports")
+    return server
+
+
+def test_large_export_is_sent_to_jobs(server, server_db, monkeypatch, seed_transactions):
+    monkeypatch.setattr(server, "INLINE_EXPORT_MAX_TRANSACTIONS", 2)
+
+    async def scenario():
+        await seed_transactions(server_db, 3)
+        with pytest.raises(HTTPException) as excinfo:
+            await server.export_excel(afdeling_id=None, regnskabsaar=None, current_user=server.User(**ADMIN))
+        assert excinfo.value.status_code == 413
+
+    asyncio.run(scenario())
+
+
+def test_small_export_is_served_and_cached(server, server_db, monkeypatch, seed_transactions):
+    monkeypatch.setattr(server, "INLINE_EXPORT_MAX_TRANSACTIONS", 3)
+
+    async def scenario():
+        await seed_transactions(server_db, 3)
+        user = server.User(**ADMIN)
+        response = await server.export_excel(afdeling_id="a1", regnskabsaar=None, current_user=user)
+        assert response.media_type.endswith("spreadsheetml.sheet")
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        assert len(body) == int(response.headers["Content-Length"])
+        # Served from the cache now, even above the limit
+        monkeypatch.setattr(server, "INLINE_EXPORT_MAX_TRANSACTIONS", 0)
+        cached = await server.export_excel(afdeling_id="a1", regnskabsaar=None, current_user=user)
+        assert cached.headers["Content-Length"] == response.headers["Content-Length"]
+        # Never sent; the response's background task still releases the entry
+        await cached.background()
+        assert export_cache.get_stats()["serving"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_unsent_zip_export_removes_its_workbook(server, server_db, tmp_path, monkeypatch, seed_transactions):
+    workbook = tmp_path / "export_unsent.xlsx"
+
+    async def build_workbook(db, afdelinger, regnskabsaar, combined):
+        workbook.write_bytes(b"xlsx")
+        receipt = {"key": "Hold 1/r.pdf", "mtime": 0.0, "name": "r.pdf", "afdeling": "Hold 1", "bilagnr": "B001"}
+        return str(workbook), [receipt]
+
+    monkeypatch.setattr(server, "build_workbook", build_workbook)
+
+    async def scenario():
+        await seed_transactions(server_db, 1)
+        response = await server.export_excel(afdeling_id="a1", regnskabsaar=None, current_user=server.User(**ADMIN))
+        assert response.media_type == "application/zip"
+        # Dropped without reading a byte, so iter_zip never started
+        await response.background()
+        assert not workbook.exists()
+
+    asyncio.run(scenario())
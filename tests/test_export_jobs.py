@@ -0,0 +1,119 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+import export_cache
+import export_jobs
+import storage_backends
+from excel_export import export_scope
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(export_cache, "CACHE_DIR", tmp_path / "exports")
+    backend = storage_backends.LocalStorage(tmp_path / "storage")
+    monkeypatch.setattr(storage_backends, "_storage", backend)
+    return backend
+
+
+async def _start(db, job):
+    # _claim's stale-job clause compares aware datetimes, which mongomock can't match
+    await db.export_jobs.update_one({"id": job["id"]}, {"$set": {"status": "running"}})
+    return await export_jobs.get_job(db, job["id"])
+
+
+def test_job_file_goes_to_storage(db, storage, seed_transactions):
+    async def scenario():
+        await seed_transactions(db, 3)
+        scope = export_scope("afdeling", "a1")
+        first = await export_jobs.enqueue(db, "a1", scope)
+        await export_jobs._run(db, await _start(db, first))
+        done = await export_jobs.get_job(db, first["id"])
+        assert done["status"] == "done"
+        key = export_jobs.artifact_key(done)
+        assert key == f"exports/{first['id']}.xlsx"
+        stored = await storage.stat(key)
+        assert stored is not None and stored.size > 0
+
+        # The same export again is copied from the local cache under its own key
+        second = await export_jobs.enqueue(db, "a1", scope)
+        await export_jobs._run(db, await _start(db, second))
+        key2 = export_jobs.artifact_key(await export_jobs.get_job(db, second["id"]))
+        assert key2 != key
+        assert (await storage.stat(key2)).size == stored.size
+        assert export_cache.get_stats()["serving"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_heartbeat_keeps_long_job_fresh(db, storage, monkeypatch):
+    monkeypatch.setattr(export_jobs, "HEARTBEAT_SECONDS", 0.01)
+
+    async def slow_build(db_, job):
+        await asyncio.sleep(0.1)
+        return "exports/slow.xlsx"
+
+    monkeypatch.setattr(export_jobs, "_build", slow_build)
+
+    async def scenario():
+        job = await export_jobs.enqueue(db, "a1", export_scope("afdeling", "a1"))
+        claimed = await _start(db, job)
+        run = asyncio.create_task(export_jobs._run(db, claimed))
+        await asyncio.sleep(0.05)
+        running = await export_jobs.get_job(db, job["id"])
+        assert running["status"] == "running"
+        assert running["updated_at"] > claimed["updated_at"]
+        await run
+
+    asyncio.run(scenario())
+
+
+def test_expired_files_are_removed(db, storage, seed_transactions):
+    async def scenario():
+        await seed_transactions(db, 3)
+        job = await export_jobs.enqueue(db, "a1", export_scope("afdeling", "a1"))
+        await export_jobs._run(db, await _start(db, job))
+        key = export_jobs.artifact_key(await export_jobs.get_job(db, job["id"]))
+
+        assert await export_jobs.remove_expired_files(db) == 0
+        old = export_jobs._now() - timedelta(seconds=export_jobs.FILE_TTL_SECONDS + 60)
+        await db.export_jobs.update_one({"id": job["id"]}, {"$set": {"finished_at": old}})
+        assert await export_jobs.remove_expired_files(db) == 1
+        assert await storage.stat(key) is None
+        assert export_jobs.artifact_key(await export_jobs.get_job(db, job["id"])) is None
+
+    asyncio.run(scenario())
+
+
+def test_download_serves_from_storage(server_db, storage, seed_transactions):
+    from fastapi.testclient import TestClient
+    import server
+
+    async def prepare():
+        await seed_transactions(server_db, 3)
+        job = await export_jobs.enqueue(server_db, "a1", export_scope("afdeling", "a1"))
+        await export_jobs._run(server_db, await _start(server_db, job))
+        return job
+
+    job = asyncio.run(prepare())
+    # Another replica has its own, empty export cache
+    for path in export_cache.CACHE_DIR.iterdir():
+        path.unlink()
+
+    server.app.dependency_overrides[server.get_current_user] = lambda: server.User(
+        id="a1", username="a1", role="afdeling"
+    )
+    try:
+        client = TestClient(server.app)
+        response = client.get(f"/api/export/jobs/{job['id']}/download")
+        assert response.status_code == 200
+        assert response.headers["content-disposition"].startswith("attachment;")
+        assert response.content[:2] == b"PK"
+        ranged = client.get(f"/api/export/jobs/{job['id']}/download", headers={"Range": "bytes=0-1"})
+        assert ranged.status_code == 206 and ranged.content == b"PK"
+
+        asyncio.run(storage.delete(export_jobs.artifact_key(asyncio.run(export_jobs.get_job(server_db, job["id"])))))
+        assert client.get(f"/api/export/jobs/{job['id']}/download").status_code == 410
+    finally:
+        server.app.dependency_overrides.clear()
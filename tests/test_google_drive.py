@@ -0,0 +1,296 @@
+import asyncio
+import io
+import itertools
+import re
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
+
+import httplib2
+import pytest
+from fastapi import HTTPException
+from googleapiclient.errors import HttpError
+
+import google_drive_service
+from drive_client import DriveClient
+
+
+def _http_error(status):
+    return HttpError(SimpleNamespace(status=status, reason="error"), b"{}")
+
+
+class FakeRequest:
+    def __init__(self, run):
+        self.run = run
+
+    def execute(self):
+        return self.run()
+
+
+class FakeFiles:
+    """The part of the Drive files() resource the service uses, backed by dicts"""
+
+    def __init__(self):
+        self.folders = {}
+        self.ids = itertools.count(1)
+        self.created = []
+        self.metadata = {}
+        self.http = FakeHttp({})
+        # Exceptions (or None for success) for the upload's next_chunk calls, in order
+        self.upload_failures = []
+
+    def list(self, q, **kwargs):
+        match = re.match(r"name='([^']*)'.*?(?:and '([^']*)' in parents)?$", q)
+
+        def run():
+            return {"files": [
+                {"id": folder_id} for folder_id, (name, parent) in self.folders.items()
+                if name == match[1] and parent == match[2]
+            ]}
+        return FakeRequest(run)
+
+    def get(self, fileId, fields):
+        return FakeRequest(lambda: self.metadata[fileId])
+
+    def get_media(self, fileId):
+        return SimpleNamespace(uri=f"https://drive.test/files/{fileId}", http=self.http)
+
+    def create(self, body, media_body=None, **kwargs):
+        if media_body is not None:
+            self.upload = FakeUpload(body, media_body, self.upload_failures)
+            return self.upload
+
+        def run():
+            folder_id = f"folder{next(self.ids)}"
+            self.folders[folder_id] = (body["name"], (body.get("parents") or [None])[0])
+            self.created.append(body["name"])
+            return {"id": folder_id}
+        return FakeRequest(run)
+
+
+class FakeUpload:
+    """A resumable upload request: each next_chunk sends one chunk of the
+    media, unless a scripted failure for that call comes first"""
+
+    def __init__(self, body, media, failures):
+        self.body = body
+        self.media = media
+        self.failures = failures
+        self.received = b""
+        self.calls = 0
+
+    def next_chunk(self):
+        self.calls += 1
+        failure = self.failures.pop(0) if self.failures else None
+        if failure:
+            raise failure
+        self.received += self.media.getbytes(len(self.received), self.media.chunksize())
+        if len(self.received) < self.media.size():
+            return SimpleNamespace(progress=lambda: len(self.received) / self.media.size()), None
+        return None, {"id": "file1", "name": self.body["name"], "webViewLink": "view", "webContentLink": "download"}
+
+
+class FakeHttp:
+    """Answers ranged GETs for media requests from in-memory file contents"""
+
+    def __init__(self, contents, honour_range=True):
+        self.contents = contents
+        self.honour_range = honour_range
+        self.ranges = []
+
+    def request(self, uri, method, headers):
+        data = self.contents.get(uri.rsplit("/", 1)[-1])
+        if data is None:
+            return SimpleNamespace(status=404, reason="Not Found"), b"{}"
+        start, end = map(int, headers["range"].removeprefix("bytes=").split("-"))
+        self.ranges.append((start, end))
+        if not self.honour_range:
+            return SimpleNamespace(status=200, reason="OK"), data
+        return SimpleNamespace(status=206, reason="Partial Content"), data[start:end + 1]
+
+
+class FakeService:
+    def __init__(self, files):
+        self._files = files
+
+    def files(self):
+        return self._files
+
+
+@pytest.fixture
+def drive(db):
+    asyncio.run(db.drive_credentials.insert_one({"user_id": "u1"}))
+    files = FakeFiles()
+    return DriveClient("u1", FakeService(files)), files
+
+
+def test_concurrent_first_calls_create_each_folder_once(db, drive):
+    service, files = drive
+
+    async def scenario():
+        ids = await asyncio.gather(*[
+            google_drive_service.ensure_folder_structure(service, "Hold A", "2024-2025", "u1", db)
+            for _ in range(5)
+        ])
+        assert len(set(ids)) == 1
+        assert files.created == ["Tour de Taxa", "Kvitteringer", "Hold A", "2024-2025"]
+        # The lock is released again
+        assert "folders_locked_until" not in await db.drive_credentials.find_one({"user_id": "u1"})
+        # Trusted from drive_folders without asking Drive
+        files.list = None
+        assert await google_drive_service.ensure_folder_structure(service, "Hold A", "2024-2025", "u1", db) == ids[0]
+
+    asyncio.run(scenario())
+
+
+def test_folder_lock_held_elsewhere_is_waited_for(db, drive, monkeypatch):
+    service, files = drive
+    monkeypatch.setattr(google_drive_service, "FOLDER_LOCK_SECONDS", 0.5)
+
+    async def scenario():
+        # Another process holds the lock and resolves the folder meanwhile
+        until = datetime.now(timezone.utc) + timedelta(minutes=5)
+        await db.drive_credentials.update_one({"user_id": "u1"}, {"$set": {"folders_locked_until": until}})
+
+        async def other_process():
+            await asyncio.sleep(0.1)
+            await db.drive_folders.insert_one(
+                {"user_id": "u1", "afdeling_navn": "Hold A", "regnskabsaar": "2024-2025", "folder_id": "theirs"}
+            )
+
+        folder_id, _ = await asyncio.gather(
+            google_drive_service.ensure_folder_structure(service, "Hold A", "2024-2025", "u1", db),
+            other_process()
+        )
+        assert folder_id == "theirs"
+        assert files.created == []
+        # Not ours to release
+        assert "folders_locked_until" in await db.drive_credentials.find_one({"user_id": "u1"})
+
+    asyncio.run(scenario())
+
+
+def test_expired_folder_lock_is_taken_over(db, drive):
+    service, files = drive
+
+    async def scenario():
+        # Left behind by a process that died while holding it
+        until = datetime.now(timezone.utc) - timedelta(seconds=1)
+        await db.drive_credentials.update_one({"user_id": "u1"}, {"$set": {"folders_locked_until": until}})
+        started = asyncio.get_running_loop().time()
+        await google_drive_service.ensure_folder_structure(service, "Hold A", "2024-2025", "u1", db)
+        assert asyncio.get_running_loop().time() - started < 1
+        assert len(files.created) == 4
+        assert "folders_locked_until" not in await db.drive_credentials.find_one({"user_id": "u1"})
+
+    asyncio.run(scenario())
+
+
+def test_deleted_cached_folder_is_resolved_again(db, drive):
+    service, files = drive
+
+    async def scenario():
+        first = await google_drive_service.ensure_folder_structure(service, "Hold A", "2024-2025", "u1", db)
+        del files.folders[first]
+
+        async def operation(folder_id):
+            if folder_id not in files.folders:
+                raise _http_error(404)
+            return folder_id
+
+        second = await google_drive_service.with_receipt_folder(service, "Hold A", "2024-2025", "u1", db, operation)
+        assert second != first
+        assert (await db.drive_folders.find_one({"user_id": "u1"}))["folder_id"] == second
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def upload(drive, monkeypatch):
+    service, files = drive
+    monkeypatch.setattr(google_drive_service, "UPLOAD_CHUNK_SIZE", 256 * 1024)
+    monkeypatch.setattr(google_drive_service, "UPLOAD_CHUNK_RETRIES", 3)
+    delays = []
+
+    async def sleep(seconds):
+        delays.append(seconds)
+
+    monkeypatch.setattr(google_drive_service.asyncio, "sleep", sleep)
+    data = bytes(range(256)) * 2500
+
+    def run(*failures):
+        files.upload_failures = list(failures)
+        return asyncio.run(google_drive_service.upload_file_to_drive(
+            service, io.BytesIO(data), "kvittering.pdf", "folder1", "application/pdf"
+        ))
+    return SimpleNamespace(run=run, files=files, data=data, delays=delays)
+
+
+def test_upload_retries_failed_chunks(upload):
+    result = upload.run(None, _http_error(503), None, httplib2.HttpLib2Error("reset"), _http_error(429))
+    assert result["file_id"] == "file1"
+    assert upload.files.upload.received == upload.data
+    # Three chunks plus three retries; the backoff restarts after each success
+    assert upload.files.upload.calls == 6
+    assert upload.delays == [1, 1, 2]
+
+
+def test_upload_gives_up_after_retries(upload):
+    with pytest.raises(HttpError):
+        upload.run(*[_http_error(500)] * 4)
+    assert upload.files.upload.calls == 4
+    assert upload.delays == [1, 2, 4]
+
+
+def test_upload_client_errors_are_not_retried(upload):
+    with pytest.raises(HttpError):
+        upload.run(None, _http_error(403))
+    assert upload.files.upload.calls == 2
+    assert upload.delays == []
+
+
+@pytest.fixture
+def download(drive, monkeypatch):
+    service, files = drive
+    monkeypatch.setattr(google_drive_service, "DOWNLOAD_CHUNK_SIZE", 1000)
+    data = bytes(range(256)) * 10
+    files.http.contents["file1"] = data
+
+    def read(start, end):
+        async def collect():
+            return [chunk async for chunk in google_drive_service.iter_drive_file(service, "file1", start, end)]
+        return asyncio.run(collect())
+    return SimpleNamespace(read=read, files=files, data=data)
+
+
+def test_download_is_fetched_in_ranged_chunks(download):
+    chunks = download.read(100, 2299)
+    assert b"".join(chunks) == download.data[100:2300]
+    assert download.files.http.ranges == [(100, 1099), (1100, 2099), (2100, 2299)]
+
+
+def test_download_slices_a_response_that_ignored_range(download):
+    download.files.http.honour_range = False
+    assert b"".join(download.read(2500, 2559)) == download.data[2500:]
+    assert download.files.http.ranges == [(2500, 2559)]
+
+
+def test_download_of_missing_file_raises(download):
+    download.files.http.contents.clear()
+    with pytest.raises(HttpError):
+        download.read(0, 10)
+
+
+def test_drive_file_info(drive):
+    service, files = drive
+    files.metadata["file1"] = {"name": "kvittering.pdf", "mimeType": "application/pdf", "size": "2560",
+                               "modifiedTime": "2025-01-02T10:00:00.000Z", "md5Checksum": "abc"}
+    files.metadata["doc1"] = {"name": "Notes", "mimeType": "application/vnd.google-apps.document",
+                              "modifiedTime": "2025-01-02T10:00:00.000Z"}
+
+    info = asyncio.run(google_drive_service.get_drive_file_info(service, "file1"))
+    assert info["size"] == 2560 and info["md5"] == "abc"
+    assert info["mtime"] == datetime(2025, 1, 2, 10, tzinfo=timezone.utc).timestamp()
+    # Native Google files have no bytes to download
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(google_drive_service.get_drive_file_info(service, "doc1"))
+    assert error.value.status_code == 404
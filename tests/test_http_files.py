@@ -0,0 +1,92 @@
+import asyncio
+from email.utils import formatdate
+
+import pytest
+from starlette.requests import Request
+
+from http_files import RangeNotSatisfiable, parse_range, serve_content
+
+CONTENT = bytes(range(100))
+MTIME = 1_700_000_000
+STRONG = '"abc123"'
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-9", (0, 9)),
+    ("bytes=90-", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-1000", (0, 99)),
+    ("bytes=50-1000", (50, 99)),
+    ("bytes=0-0", (0, 0)),
+    ("bytes=0-1,5-6", None),
+    ("items=0-1", None),
+    ("bytes=abc-", None),
+    ("bytes=5", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, len(CONTENT)) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=10-5", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, len(CONTENT))
+
+
+@pytest.mark.parametrize("header", ["bytes=0-", "bytes=-5"])
+def test_parse_range_empty_file(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, 0)
+
+
+def _serve(headers, etag=STRONG):
+    request = Request({
+        "type": "http", "method": "GET", "path": "/",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+    })
+
+    def read_range(start, end):
+        yield CONTENT[start:end + 1]
+
+    response = serve_content(request, len(CONTENT), MTIME, read_range, "kvittering.pdf", etag=etag)
+
+    async def body():
+        return b"".join([chunk async for chunk in response.body_iterator]) if hasattr(response, "body_iterator") else b""
+
+    return response, asyncio.run(body())
+
+
+def test_range_request():
+    response, body = _serve({"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 10-19/100"
+    assert body == CONTENT[10:20]
+
+
+def test_unsatisfiable_range():
+    response, _ = _serve({"Range": "bytes=200-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */100"
+
+
+def test_not_modified():
+    response, _ = _serve({"If-None-Match": STRONG})
+    assert response.status_code == 304
+    response, _ = _serve({"If-Modified-Since": formatdate(MTIME, usegmt=True)})
+    assert response.status_code == 304
+
+
+@pytest.mark.parametrize("if_range, etag, status", [
+    (STRONG, STRONG, 206),
+    ('"other"', STRONG, 200),
+    # Weak validators never satisfy If-Range
+    (f"W/{STRONG}", STRONG, 200),
+    ('W/"5f5e1000-64"', 'W/"5f5e1000-64"', 200),
+    (formatdate(MTIME, usegmt=True), STRONG, 206),
+    (formatdate(MTIME - 1, usegmt=True), STRONG, 200),
+])
+def test_if_range(if_range, etag, status):
+    response, body = _serve({"Range": "bytes=0-9", "If-Range": if_range}, etag=etag)
+    assert response.status_code == status
+    assert body == (CONTENT[:10] if status == 206 else CONTENT)
@@ -0,0 +1,45 @@
+import asyncio
+
+from index_manager import ensure_indexes, verify_indexes
+
+
+def test_ensure_indexes_rebuilds_changed_definition(db):
+    async def scenario():
+        # The settings index as deployed before it was made unique
+        await db.settings.create_index([("afdeling_id", 1)], name="afdeling_id")
+        result = await ensure_indexes(db)
+        assert "settings.afdeling_id" in result["created"]
+        assert not result["failed"]
+        assert (await db.settings.index_information())["afdeling_id"].get("unique")
+        assert (await verify_indexes(db))["in_sync"]
+        # Nothing left to do on the next start
+        assert (await ensure_indexes(db))["created"] == []
+
+    asyncio.run(scenario())
+
+
+def test_ensure_indexes_restores_old_index_when_rebuild_fails(db):
+    async def scenario():
+        await db.settings.create_index([("afdeling_id", 1)], name="afdeling_id")
+        # Duplicates block the unique rebuild
+        await db.settings.insert_many([{"afdeling_id": "a1"}, {"afdeling_id": "a1"}])
+        result = await ensure_indexes(db)
+        assert [f["index"] for f in result["failed"]] == ["settings.afdeling_id"]
+        live = (await db.settings.index_information())["afdeling_id"]
+        assert list(live["key"]) == [("afdeling_id", 1)]
+        assert not live.get("unique")
+
+    asyncio.run(scenario())
+
+
+def test_changed_ttl_is_drift(db):
+    async def scenario():
+        await db.export_jobs.create_index([("finished_at", 1)], name="finished_at_ttl", expireAfterSeconds=60)
+        report = await verify_indexes(db)
+        mismatched = report["collections"]["export_jobs"]["mismatched"]
+        assert [m["name"] for m in mismatched] == ["finished_at_ttl"]
+        assert mismatched[0]["actual"]["expireAfterSeconds"] == 60
+        await ensure_indexes(db)
+        assert (await verify_indexes(db))["in_sync"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import drive_client
+from instrumented_pool import InstrumentedPool
+
+
+def test_call_cancelled_while_queued_is_dropped():
+    pool = InstrumentedPool(1, thread_name_prefix="test")
+    release = threading.Event()
+    ran = []
+
+    async def scenario():
+        blocker = asyncio.ensure_future(pool.run(release.wait, 5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(pool.run(ran.append, "late"), 0.05)
+        assert pool.stats()["queued"] == 0
+        release.set()
+        await blocker
+        # Give the worker a chance to pick up the dropped call, should it still be submitted
+        await asyncio.sleep(0.05)
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        pool.shutdown()
+    stats = pool.stats()
+    assert ran == []
+    assert (stats["queued"], stats["active"], stats["completed"], stats["dropped"]) == (0, 0, 1, 1)
+
+
+def test_stats_track_waits():
+    pool = InstrumentedPool(2, thread_name_prefix="test")
+
+    async def scenario():
+        return await asyncio.gather(*[pool.run(time.sleep, 0.02) for _ in range(4)])
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        pool.shutdown()
+    stats = pool.stats()
+    assert stats["completed"] == 4
+    assert stats["max_wait_ms"] > 0
+    assert stats["saturation"] == 0
+
+
+def test_drive_run_limits_per_user_and_forgets_idle_users():
+    running = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(0.02)
+        with lock:
+            running["now"] -= 1
+
+    async def scenario():
+        await asyncio.gather(*[drive_client.run("u1", call) for _ in range(6)])
+
+    asyncio.run(scenario())
+    assert running["max"] == drive_client.PER_USER_LIMIT
+    assert drive_client._user_limits == {}
+    assert drive_client.get_stats()["users_in_flight"] == 0
+
+
+def test_drive_run_timeout(monkeypatch):
+    monkeypatch.setattr(drive_client, "CALL_TIMEOUT_SECONDS", 0.01)
+    timeouts = drive_client.get_stats()["timeouts"]
+    with pytest.raises(drive_client.DriveTimeout):
+        asyncio.run(drive_client.run("u1", time.sleep, 0.1))
+    assert drive_client.get_stats()["timeouts"] == timeouts + 1
+    assert drive_client._user_limits == {}
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+import receipt_previews
+import storage_backends
+import ttl_cache
+from ttl_cache import TTLCache
+
+
+@pytest.fixture
+def failing_render(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_backends, "_storage", storage_backends.LocalStorage(tmp_path / "storage"))
+    monkeypatch.setattr(receipt_previews, "_failed", TTLCache(max_size=10, ttl_seconds=60))
+    renders = []
+
+    async def render(key, filename):
+        renders.append(key)
+        raise ValueError("cannot identify image file")
+
+    monkeypatch.setattr(receipt_previews, "_generate", render)
+    return renders
+
+
+@pytest.mark.parametrize("filename, expected", [
+    ("kvittering.pdf", True),
+    ("kvittering.JPG", True),
+    ("kvittering.png", True),
+    ("kvittering.heic", False),
+    ("kvittering.svg", False),
+    ("kvittering.tiff", False),
+    ("kvittering.docx", False),
+])
+def test_only_decodable_types_have_previews(filename, expected):
+    assert receipt_previews.can_preview(filename) is expected
+
+
+def test_failed_render_is_not_retried(failing_render, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ttl_cache.time, "monotonic", lambda: now[0])
+
+    async def scenario():
+        for _ in range(3):
+            assert await receipt_previews.get_preview("blobs/ab/abc", "kvittering.pdf", "thumb") is None
+        assert failing_render == ["blobs/ab/abc"]
+
+        # Tried again once the failure has expired
+        now[0] += 61
+        assert await receipt_previews.get_preview("blobs/ab/abc", "kvittering.pdf", "thumb") is None
+        assert len(failing_render) == 2
+
+    asyncio.run(scenario())
+
+
+def test_unsupported_type_is_never_rendered(failing_render):
+    assert asyncio.run(receipt_previews.get_preview("blobs/cd/cde", "kvittering.heic", "thumb")) is None
+    assert failing_render == []
@@ -0,0 +1,101 @@
+import asyncio
+import io
+
+import pytest
+from fastapi import UploadFile, HTTPException
+
+import receipt_storage
+import storage_backends
+from receipt_storage import blob_key
+
+USER = {"id": "a1", "username": "a1", "role": "afdeling", "afdeling_navn": "Hold 1"}
+
+
+@pytest.fixture
+def server(server_db, tmp_path, monkeypatch):
+    import server
+    monkeypatch.setattr(storage_backends, "_storage", storage_backends.LocalStorage(tmp_path / "storage"))
+    monkeypatch.setattr(receipt_storage, "INCOMING_DIR", tmp_path / "storage" / "incoming")
+    # Small chunks so concurrent uploads interleave
+    monkeypatch.setattr(receipt_storage, "UPLOAD_CHUNK_SIZE", 4)
+    return server
+
+
+def _upload(data: bytes) -> UploadFile:
+    return UploadFile(file=io.BytesIO(data), filename="kvittering.txt")
+
+
+async def _transaction(db, transaction_id="t1"):
+    await db.transactions.insert_one({
+        "id": transaction_id, "afdeling_id": "a1", "afdeling_navn": "Hold 1", "regnskabsaar": "2024-2025",
+        "bilagnr": "B001", "bank_dato": "2024-10-01", "tekst": "x", "formal": "y", "belob": 1.0, "type": "udgift"
+    })
+
+
+async def _blob(db, data: bytes):
+    import hashlib
+    sha256 = hashlib.sha256(data).hexdigest()
+    return sha256, await db.receipt_blobs.find_one({"sha256": sha256})
+
+
+def test_concurrent_reuploads_with_shared_content(server, server_db):
+    user = server.User(**USER)
+
+    async def scenario():
+        await _transaction(server_db)
+        await server.upload_receipt("t1", _upload(b"old receipt"), current_user=user)
+        results = await asyncio.gather(*[
+            server.upload_receipt("t1", _upload(b"new receipt, same for both"), current_user=user)
+            for _ in range(3)
+        ])
+        assert len({result["sha256"] for result in results}) == 1
+
+        old_sha, old_blob = await _blob(server_db, b"old receipt")
+        new_sha, new_blob = await _blob(server_db, b"new receipt, same for both")
+        # The replaced blob is released exactly once and gone; the new one is held once, by t1
+        assert old_blob is None
+        assert not (await storage_backends.get_storage().stat(blob_key(old_sha)))
+        assert new_blob["refcount"] == 1
+        assert (await server_db.transactions.find_one({"id": "t1"}))["kvittering_sha256"] == new_sha
+        assert await storage_backends.get_storage().stat(blob_key(new_sha))
+
+    asyncio.run(scenario())
+
+
+def test_upload_to_transaction_deleted_meanwhile_releases_blob(server, server_db, monkeypatch):
+    user = server.User(**USER)
+    store_blob = server.store_blob
+
+    async def store_then_delete(db, file):
+        saved = await store_blob(db, file)
+        await db.transactions.delete_one({"id": "t1"})
+        return saved
+
+    monkeypatch.setattr(server, "store_blob", store_then_delete)
+
+    async def scenario():
+        await _transaction(server_db)
+        with pytest.raises(HTTPException) as excinfo:
+            await server.upload_receipt("t1", _upload(b"orphan"), current_user=user)
+        assert excinfo.value.status_code == 404
+        sha256, blob = await _blob(server_db, b"orphan")
+        assert blob is None
+        assert not (await storage_backends.get_storage().stat(blob_key(sha256)))
+
+    asyncio.run(scenario())
+
+
+def test_oversized_upload_is_rejected_without_leftovers(server, server_db):
+    async def scenario():
+        with pytest.raises(receipt_storage.ReceiptTooLarge):
+            await receipt_storage.store_blob(server_db, _upload(b"x" * 13), max_bytes=12)
+        # Rejected after the first chunks were written; the partial temp file is gone
+        assert not list(receipt_storage.INCOMING_DIR.iterdir())
+        assert await server_db.receipt_blobs.count_documents({}) == 0
+
+        # Exactly max_bytes is accepted
+        saved = await receipt_storage.store_blob(server_db, _upload(b"x" * 12), max_bytes=12)
+        assert saved["size"] == 12
+        assert not list(receipt_storage.INCOMING_DIR.iterdir())
+
+    asyncio.run(scenario())
@@ -0,0 +1,117 @@
+import asyncio
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import storage_backends
+from storage_backends import LocalStorage, S3Storage, StorageBackend, move_file
+
+BUCKET = "receipts-test"
+
+
+@pytest.fixture(params=["local", "s3"])
+def storage(request, tmp_path, monkeypatch):
+    if request.param == "local":
+        yield LocalStorage(tmp_path / "storage")
+        return
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BUCKET)
+        # Small parts so the multipart path is exercised
+        yield S3Storage(BUCKET, prefix="tdt", part_size=5 * 1024 * 1024)
+
+
+def _source(tmp_path, data):
+    path = tmp_path / "upload.part"
+    path.write_bytes(data)
+    return path
+
+
+def test_backend_must_implement_every_method():
+    class Partial(StorageBackend):
+        async def stat(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_put_stat_open_and_ranges(storage, tmp_path):
+    data = bytes(range(256)) * 24 * 1024  # 6 MiB, above the part size
+
+    async def scenario():
+        source = _source(tmp_path, data)
+        await storage.put_file("blobs/ab/abc", source)
+        assert not source.exists()
+        stored = await storage.stat("blobs/ab/abc")
+        assert stored.size == len(data)
+        assert await storage.stat("blobs/ab/missing") is None
+
+        with storage.open("blobs/ab/abc") as f:
+            assert f.read(10) == data[:10]
+        assert b"".join(storage.iter_range("blobs/ab/abc", 100, 70_000)) == data[100:70_001]
+        with pytest.raises(FileNotFoundError):
+            storage.open("blobs/ab/missing")
+
+        dest = tmp_path / "copy"
+        await storage.fetch("blobs/ab/abc", dest)
+        assert dest.read_bytes() == data
+
+    asyncio.run(scenario())
+
+
+def test_delete_and_delete_prefix(storage, tmp_path):
+    async def scenario():
+        for key in ("blobs/ab/abc", "blobs/ab/abc.thumb.jpg", "blobs/ab/abc.preview.jpg", "blobs/ab/abd"):
+            await storage.put_file(key, _source(tmp_path, key.encode()))
+        await storage.delete_prefix("blobs/ab/abc.")
+        assert await storage.stat("blobs/ab/abc.thumb.jpg") is None
+        assert await storage.stat("blobs/ab/abc.preview.jpg") is None
+        assert await storage.stat("blobs/ab/abc") is not None
+        await storage.delete("blobs/ab/abc")
+        await storage.delete("blobs/ab/abc")
+        assert await storage.stat("blobs/ab/abc") is None
+        assert await storage.stat("blobs/ab/abd") is not None
+
+    asyncio.run(scenario())
+
+
+def test_s3_keys_are_prefixed(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        storage = S3Storage(BUCKET, prefix="/tdt/")
+        asyncio.run(storage.put_file("blobs/ab/abc", _source(tmp_path, b"x")))
+        keys = [item["Key"] for item in client.list_objects_v2(Bucket=BUCKET)["Contents"]]
+        assert keys == ["tdt/blobs/ab/abc"]
+
+
+def test_local_storage_rejects_keys_outside_root(tmp_path):
+    storage = LocalStorage(tmp_path / "storage")
+    with pytest.raises(ValueError):
+        storage.open("../escape")
+
+
+def test_move_across_filesystems_copies_then_renames(tmp_path, monkeypatch):
+    source = _source(tmp_path, b"receipt")
+    dest_dir = tmp_path / "other"
+    dest_dir.mkdir()
+    real_replace = os.replace
+
+    def replace(src, dst):
+        if str(src) == str(source):
+            raise OSError(18, "Invalid cross-device link")
+        real_replace(src, dst)
+
+    monkeypatch.setattr(storage_backends.os, "replace", replace)
+    move_file(source, dest_dir / "receipt.pdf")
+    assert (dest_dir / "receipt.pdf").read_bytes() == b"receipt"
+    assert not source.exists()
+    assert [p.name for p in dest_dir.iterdir()] == ["receipt.pdf"]
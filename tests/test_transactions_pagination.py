@@ -0,0 +1,128 @@
+import asyncio
+import base64
+import json
+
+import pytest
+from fastapi import HTTPException, Response
+
+import server
+
+AFDELING = server.User(id="a1", username="hold_a", role="afdeling", afdeling_navn="Hold A")
+
+
+def insert_transactions(db, count):
+    docs = []
+    for n in range(1, count + 1):
+        docs.append(server.Transaction(
+            id=f"t{n:05d}",
+            afdeling_id="a1",
+            bilagnr=f"B{str(n).zfill(3)}",
+            bank_dato=f"2025-{(n % 12) + 1:02d}-{(n % 28) + 1:02d}",
+            tekst=("bus" if n % 2 else "Aftensmad") + f" {n}",
+            formal="Diverse",
+            belob=float(n),
+            type="udgift",
+            regnskabsaar="2024-2025"
+        ).model_dump())
+    asyncio.run(db.transactions.insert_many(docs))
+
+
+def list_page(sort, cursor=None, limit=100):
+    response = Response()
+    rows = asyncio.run(server.list_transactions(
+        response, sort=sort, limit=limit, cursor=cursor, current_user=AFDELING
+    ))
+    return rows, response.headers
+
+
+def list_all(sort, limit=100):
+    rows, cursor = [], None
+    while True:
+        page, headers = list_page(sort, cursor, limit)
+        rows.extend(page)
+        cursor = headers.get("x-next-cursor")
+        if not cursor:
+            return rows, int(headers["x-total-count"])
+
+
+def test_bilagnr_sorts_numerically_across_pages(server_db):
+    insert_transactions(server_db, 1204)
+    rows, total = list_all("bilagnr")
+    numbers = [int(t.bilagnr[1:]) for t in rows]
+    assert total == 1204
+    assert numbers == list(range(1, 1205))
+
+
+def test_descending_sort_pages_are_continuous(server_db):
+    insert_transactions(server_db, 250)
+    rows, total = list_all("-bank_dato", limit=40)
+    ids = [t.id for t in rows]
+    assert len(ids) == len(set(ids)) == total == 250
+    keys = [(t.bank_dato, t.id) for t in rows]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_legacy_dates_and_bilagnr_get_sort_keys(server_db):
+    asyncio.run(server_db.transactions.insert_many([
+        {"id": "old1", "afdeling_id": "a1", "bilagnr": "B1000", "bank_dato": "02-01-2025",
+         "tekst": "x", "formal": "f", "belob": 1.0, "type": "udgift"},
+        {"id": "old2", "afdeling_id": "a1", "bilagnr": "B999", "bank_dato": "2024-12-31",
+         "tekst": "y", "formal": "f", "belob": 1.0, "type": "udgift"},
+    ]))
+    asyncio.run(server.ensure_transaction_sort_keys(server_db))
+
+    by_date, _ = list_all("bank_dato")
+    assert [t.id for t in by_date] == ["old2", "old1"]
+    assert by_date[1].bank_dato == "2025-01-02"
+    by_bilagnr, _ = list_all("bilagnr")
+    assert [t.bilagnr for t in by_bilagnr] == ["B999", "B1000"]
+
+
+def _cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+@pytest.mark.parametrize("cursor", [
+    "not-base64!",
+    _cursor({"a": 1, "b": 2}),
+    _cursor([{"$gt": ""}, "t1"]),
+    _cursor(["B001", {"$ne": None}]),
+    _cursor(["B001"]),
+    _cursor([True, "t1"]),
+])
+def test_bad_cursor_is_rejected(server_db, cursor):
+    with pytest.raises(HTTPException) as error:
+        list_page("bilagnr", cursor)
+    assert error.value.status_code == 400
+
+
+def test_unknown_sort_is_rejected(server_db):
+    with pytest.raises(HTTPException) as error:
+        list_page("kvittering_url")
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("sort", ["bilagnr", "-bilagnr"])
+def test_pages_cross_the_null_boundary(server_db, sort):
+    insert_transactions(server_db, 30)
+    # Bilagnr without a number gets no sort key, and those rows sort first
+    asyncio.run(server_db.transactions.update_many(
+        {"id": {"$lte": "t00012"}}, {"$set": {"bilagnr_nr": None}}
+    ))
+    rows, total = list_all(sort, limit=7)
+    ids = [t.id for t in rows]
+    assert len(ids) == len(set(ids)) == total == 30
+    keys = [(t.bilagnr_nr is not None, t.bilagnr_nr or 0, t.id) for t in rows]
+    assert keys == sorted(keys, reverse=sort.startswith("-"))
+
+
+def test_sort_key_backfill_runs_once(server_db):
+    asyncio.run(server.ensure_transaction_sort_keys(server_db))
+    asyncio.run(server_db.transactions.insert_one(
+        {"id": "late", "afdeling_id": "a1", "bilagnr": "B7", "bank_dato": "02-01-2025",
+         "tekst": "x", "formal": "f", "belob": 1.0, "type": "udgift"}
+    ))
+    asyncio.run(server.ensure_transaction_sort_keys(server_db))
+    late = asyncio.run(server_db.transactions.find_one({"id": "late"}))
+    assert late["bank_dato"] == "02-01-2025"
+    assert asyncio.run(server_db.migrations.count_documents({"name": "transaction_sort_keys"})) == 1
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+import server
+import ttl_cache
+from ttl_cache import TTLCache
+
+SUPERBRUGER = server.User(id="s1", username="super", role="superbruger")
+
+
+@pytest.fixture
+def users(server_db, monkeypatch):
+    monkeypatch.setattr(server, "user_cache", TTLCache(max_size=10, ttl_seconds=60))
+    asyncio.run(server_db.users.insert_one(
+        {"id": "u1", "username": "hold_a", "password": "x", "role": "afdeling", "afdeling_navn": "Hold A"}
+    ))
+    return server_db
+
+
+def current_user(user_id="u1"):
+    token = server.create_access_token(data={"sub": user_id})
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    return asyncio.run(server.get_current_user(credentials))
+
+
+def test_repeat_requests_skip_the_users_lookup(users):
+    assert current_user().afdeling_navn == "Hold A"
+    # Changed behind the API's back, so only a fresh lookup would see it
+    asyncio.run(users.users.update_one({"id": "u1"}, {"$set": {"afdeling_navn": "Hold B"}}))
+    assert current_user().afdeling_navn == "Hold A"
+    assert server.user_cache.stats()["hits"] == 1
+
+
+def test_cached_user_expires(users, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ttl_cache.time, "monotonic", lambda: now[0])
+    current_user()
+    asyncio.run(users.users.update_one({"id": "u1"}, {"$set": {"afdeling_navn": "Hold B"}}))
+    now[0] += 61
+    assert current_user().afdeling_navn == "Hold B"
+
+
+def test_admin_changes_invalidate_the_cached_user(users):
+    current_user()
+    asyncio.run(server.update_user_afdeling(
+        "u1", server.UserAfdelingUpdate(afdeling_navn="Hold B"), current_user=SUPERBRUGER
+    ))
+    assert current_user().afdeling_navn == "Hold B"
+
+    asyncio.run(server.delete_user("u1", current_user=SUPERBRUGER))
+    with pytest.raises(HTTPException) as error:
+        current_user()
+    assert error.value.status_code == 401